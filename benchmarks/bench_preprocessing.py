@@ -0,0 +1,133 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server"))
+import preprocessing
+
+
+
+# Benchmark of the query image preprocessing (bytes -> BGR array for DeepFace): the previous path (full-resolution
+# decode, np.array, three channel slices re-stacked with np.stack) against preprocessing.image_bytes_to_bgr, e.g.
+#   python benchmarks/bench_preprocessing.py --megapixels 0.3 2 12 48 --output preprocessing.json
+# For every image size the time per image and per megapixel is reported, with the peak of the NumPy allocations
+# (traced by tracemalloc) and the size of the decoded Pillow image (Pillow's buffers are not traced).
+
+
+
+def legacy_bytes_to_bgr(contents):
+    # the path used before preprocessing.py
+
+    image = Image.open(io.BytesIO(contents))
+    image.load()
+
+    image_np_rgb = np.array(image)
+    return image, np.stack([image_np_rgb[:, :, 2], image_np_rgb[:, :, 1], image_np_rgb[:, :, 0]], axis=-1)
+
+
+def bounded_bytes_to_bgr(contents, max_side):
+    image = preprocessing.decode_image(contents, max_side = max_side)
+    return image, preprocessing.to_bgr_array(image)
+
+
+def make_photo(megapixels, image_format = "JPEG", seed = 0):
+    # a smooth synthetic photo (gradients plus some noise) of about the given size, 4:3, encoded like a phone photo
+
+    width = int(round(np.sqrt(megapixels * 1e6 * 4 / 3)))
+    height = int(round(width * 3 / 4))
+
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 1, width, dtype=np.float32)[None, :]
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    channels = [128 + 100 * np.sin(6 * x + 4 * y + phase) for phase in (0, 2, 4)]
+    pixels = np.stack(channels, axis=-1) + rng.normal(0, 8, (height, width, 1)).astype(np.float32)
+
+    output = io.BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(output, format=image_format, quality=90)
+    return output.getvalue(), (width, height)
+
+
+def measure(func, contents, repeats):
+    # -> (seconds per call, peak traced bytes, decoded image bytes, output shape)
+
+    image, array = func(contents) # warm up (and the first call is the one that is traced)
+    tracemalloc.start()
+    image, array = func(contents)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    decoded_bytes = image.size[0] * image.size[1] * len(image.getbands())
+    shape = array.shape
+    del image, array
+
+    durations = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        func(contents)
+        durations.append(time.perf_counter() - start_time)
+
+    return float(np.median(durations)), peak, decoded_bytes, shape
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the query image preprocessing against the previous full-resolution path.")
+    parser.add_argument("--megapixels", type=float, nargs="+", default=[0.3, 2.0, 12.0, 24.0, 48.0])
+    parser.add_argument("--format", choices=("JPEG", "PNG"), default="JPEG", help="how the test images are encoded")
+    parser.add_argument("--max-side", type=int, default=preprocessing.MAX_IMAGE_SIDE)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", default=None, help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    paths = {
+        "legacy": legacy_bytes_to_bgr,
+        "bounded": lambda contents: bounded_bytes_to_bgr(contents, args.max_side),
+    }
+
+    rows = []
+    for megapixels in args.megapixels:
+        contents, size = make_photo(megapixels, args.format)
+        actual_megapixels = size[0] * size[1] / 1e6
+
+        for name, func in paths.items():
+            seconds, peak, decoded_bytes, shape = measure(func, contents, args.repeats)
+            rows.append({
+                "megapixels": round(actual_megapixels, 2),
+                "size": list(size),
+                "path": name,
+                "output_shape": list(shape),
+                "ms": round(seconds * 1000, 3),
+                "ms_per_megapixel": round(seconds * 1000 / actual_megapixels, 3),
+                "numpy_peak_mb": round(peak / 2**20, 2),
+                "decoded_mb": round(decoded_bytes / 2**20, 2),
+            })
+
+    print(f"{'MP':>6} {'path':<8} {'output':>16} {'ms':>10} {'ms/MP':>8} {'numpy peak MB':>14} {'decoded MB':>11}")
+    for row in rows:
+        output = "x".join(str(side) for side in row["output_shape"])
+        print(f"{row['megapixels']:>6} {row['path']:<8} {output:>16} {row['ms']:>10.2f} {row['ms_per_megapixel']:>8.2f} "
+              f"{row['numpy_peak_mb']:>14.2f} {row['decoded_mb']:>11.2f}")
+
+    if args.output:
+        results = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": vars(args),
+            "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                            "pillow": Image.__version__, "numpy": np.__version__},
+            "results": rows,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f"Results written to {args.output}")
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import platform
+import threading
+import contextlib
+import numpy as np
+from prometheus_client.parser import text_string_to_metric_families
+
+import fakes
+
+
+
+# End-to-end benchmark of server.py without GCP resources: the app runs in-process (uvicorn, in a thread) against
+# the local stand-ins of fakes.py, and is driven over HTTP at a fixed concurrency, e.g.
+#   python benchmarks/bench_server.py --requests 500 --concurrency 16 --output results.json
+#   python benchmarks/bench_server.py --requests 500 --concurrency 16 --compare results.json
+# For every endpoint the latency percentiles, the time to the first result (for the /stream endpoints, the identity
+# line that precedes the images), the throughput and the time spent in every stage of the pipeline are
+# reported, and written as JSON so that runs can be compared. The stage timings are read from the server's /metrics
+# (the face_search_stage_seconds histograms) before and after every run.
+
+ENDPOINTS = ("/embed", "/faceimage", "/embed/stream", "/faceimage/stream")
+
+DEFAULT_ENDPOINTS = ("/embed", "/faceimage")
+
+STAGE_METRIC = "face_search_stage_seconds"
+
+
+
+def summarize(durations):
+    # durations in seconds -> count and milliseconds statistics
+
+    values = np.asarray(durations, dtype=np.float64) * 1000.0
+    if values.size == 0:
+        return {"count": 0}
+
+    return {
+        "count": int(values.size),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+
+
+
+def scrape_stage_histograms(base_url):
+    # {stage: {"buckets": [(upper bound, cumulative count)], "count": n, "sum": seconds}} from GET /metrics
+
+    import httpx
+
+    stages = {}
+    for family in text_string_to_metric_families(httpx.get(f"{base_url}/metrics").text):
+        if family.name != STAGE_METRIC:
+            continue
+        for sample in family.samples:
+            histogram = stages.setdefault(sample.labels["stage"], {"buckets": [], "count": 0, "sum": 0.0})
+            if sample.name.endswith("_bucket"):
+                histogram["buckets"].append((float(sample.labels["le"]), sample.value))
+            elif sample.name.endswith("_count"):
+                histogram["count"] = sample.value
+            elif sample.name.endswith("_sum"):
+                histogram["sum"] = sample.value
+
+    return stages
+
+
+def histogram_quantile(buckets, quantile):
+    # linear interpolation within the bucket holding the quantile, like PromQL's histogram_quantile
+
+    buckets = sorted(buckets)
+    total = buckets[-1][1]
+    rank = quantile * total
+
+    lower_bound, lower_count = 0.0, 0.0
+    for upper_bound, count in buckets:
+        if count >= rank:
+            if upper_bound == float("inf"):
+                return lower_bound
+            if count == lower_count:
+                return upper_bound
+            return lower_bound + (upper_bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+        lower_bound, lower_count = upper_bound, count
+
+    return lower_bound
+
+
+def stage_summary(before, after):
+    # the stage statistics of the requests sent between two scrapes
+
+    summary = {}
+    for name, histogram in sorted(after.items()):
+        previous = before.get(name, {"buckets": [], "count": 0, "sum": 0.0})
+        previous_buckets = dict(previous["buckets"])
+
+        count = histogram["count"] - previous["count"]
+        if count <= 0:
+            continue
+
+        buckets = [(bound, value - previous_buckets.get(bound, 0.0)) for bound, value in histogram["buckets"]]
+        summary[name] = {
+            "count": int(count),
+            "mean_ms": round((histogram["sum"] - previous["sum"]) / count * 1000.0, 3),
+            "p50_ms": round(histogram_quantile(buckets, 0.50) * 1000.0, 3),
+            "p95_ms": round(histogram_quantile(buckets, 0.95) * 1000.0, 3),
+        }
+
+    return summary
+
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+
+def start_app(args, gallery_dir, ids, matrix, centroids):
+    """
+    Imports the server with the stand-ins installed and serves it with uvicorn in a background thread.
+
+    Returns (uvicorn_server, thread, base_url).
+    """
+    os.environ.setdefault("SEARCH_BACKEND", "vertex")
+    os.environ.setdefault("RESULT_CACHE_SIZE", "0" if not args.result_cache else "1024")
+    os.environ.setdefault("EMBEDDING_DIM", str(matrix.shape[1]))
+    os.environ.setdefault("LOG_LEVEL", "DEBUG" if args.verbose else "WARNING")
+
+    sys.modules["deepface"] = fakes.make_fake_deepface(centroids, latency_ms = args.embed_latency_ms,
+                                                       per_image_ms = args.embed_per_image_ms)
+
+    import uvicorn
+    import utils
+    import server
+
+    storage_client = fakes.LocalStorageClient(gallery_dir, latency_ms = args.gcs_latency_ms)
+    index_endpoint = fakes.FakeIndexEndpoint(ids, matrix, latency_ms = args.search_latency_ms)
+    utils.ClientRegistry = lambda project_id, region: fakes.FakeClientRegistry(storage_client, index_endpoint)
+
+    # server.py copies the configuration of utils.py (from utils import *), so both are set
+    for module in (utils, server):
+        module.BUCKET_NAME = "benchmark"
+        module.DATASET_ADD = ""
+
+    port = free_port()
+    uvicorn_server = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=uvicorn_server.run, daemon=True)
+    thread.start()
+
+    while not uvicorn_server.started:
+        if not thread.is_alive():
+            raise RuntimeError("The server did not start")
+        time.sleep(0.05)
+
+    return uvicorn_server, thread, f"http://127.0.0.1:{port}"
+
+
+
+def make_request_factory(endpoint, args, centroids, rng):
+    # returns a function building the keyword arguments of one httpx request to endpoint
+
+    def query_embedding(identity):
+        noise = rng.standard_normal(centroids.shape[1]) / np.sqrt(centroids.shape[1])
+        return (centroids[identity] + args.query_noise * noise).astype(np.float32)
+
+    params = {"image_mode": args.image_mode}
+    if args.thumbnail_size:
+        params["thumbnail_size"] = args.thumbnail_size
+
+    if endpoint.startswith("/embed"):
+        def build():
+            embedding = query_embedding(int(rng.integers(len(centroids))))
+            if args.embed_format == "float32":
+                return {"content": embedding.astype('<f4').tobytes(), "params": params,
+                        "headers": {"Content-Type": "application/x-float32"}}
+            return {"json": dict(params, data=embedding.tolist())}
+        return build
+
+    query_images = [fakes.encode_identity_image(identity) for identity in range(len(centroids))]
+
+    def build():
+        identity = int(rng.integers(len(centroids)))
+        return {"files": {"file": (f"query_{identity}.png", query_images[identity], "image/png")}, "params": params}
+    return build
+
+
+
+async def drive(base_url, endpoint, build_request, num_requests, concurrency, timeout):
+    """
+    Sends num_requests requests with concurrency requests in flight.
+
+    Returns (latencies, first result latencies, status counts, seconds). The first result is the first NDJSON line
+    (the identity) of the streaming endpoints, and the whole response of the others.
+    """
+    import httpx
+
+    latencies = []
+    first_results = []
+    statuses = {}
+    remaining = iter(range(num_requests))
+    streaming = endpoint.endswith("/stream")
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+
+        async def send(request):
+            # returns (status code, time of the first result)
+            if not streaming:
+                response = await client.post(endpoint, **request)
+                await response.aread()
+                return response.status_code, time.perf_counter()
+
+            first_result = None
+            async with client.stream("POST", endpoint, **request) as response:
+                async for line in response.aiter_lines():
+                    if line and first_result is None:
+                        first_result = time.perf_counter()
+            return response.status_code, first_result or time.perf_counter()
+
+        async def worker():
+            for _ in remaining:
+                request = build_request()
+                start_time = time.perf_counter()
+                try:
+                    status, first_result = await send(request)
+                    status = str(status)
+                    first_results.append(first_result - start_time)
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - start_time)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        start_time = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start_time
+
+    return latencies, first_results, statuses, elapsed
+
+
+
+def run_endpoint(base_url, endpoint, args, centroids):
+    rng = np.random.default_rng(args.seed)
+    build_request = make_request_factory(endpoint, args, centroids, rng)
+
+    if args.warmup:
+        asyncio.run(drive(base_url, endpoint, build_request, args.warmup, args.concurrency, args.timeout))
+    stages_before = scrape_stage_histograms(base_url)
+    latencies, first_results, statuses, elapsed = asyncio.run(drive(base_url, endpoint, build_request, args.requests, args.concurrency, args.timeout))
+    stages_after = scrape_stage_histograms(base_url)
+
+    return {
+        "requests": len(latencies),
+        "errors": sum(count for status, count in statuses.items() if status != "200"),
+        "status_counts": statuses,
+        "duration_s": round(elapsed, 3),
+        "requests_per_s": round(len(latencies) / elapsed, 2),
+        "latency": summarize(latencies),
+        "first_result": summarize(first_results),
+        "stages": stage_summary(stages_before, stages_after),
+    }
+
+
+
+def print_results(results):
+    for endpoint, result in results["endpoints"].items():
+        latency = result["latency"]
+        print(f"{endpoint}: {result['requests']} requests, {result['errors']} errors, {result['requests_per_s']} req/s, "
+              f"p50 {latency['p50_ms']} ms, p95 {latency['p95_ms']} ms, p99 {latency['p99_ms']} ms")
+        first_result = result.get("first_result", {})
+        if first_result.get("count"):
+            print(f"    first result   p50 {first_result['p50_ms']} ms, p95 {first_result['p95_ms']} ms")
+        for stage, stats in result["stages"].items():
+            print(f"    {stage:<14} {stats['count']:>6} calls   mean {stats['mean_ms']:>9.3f} ms   p95 {stats['p95_ms']:>9.3f} ms")
+
+
+
+def compare_results(baseline, results):
+    # prints the change of the main metrics against a previous run
+
+    print(f"Compared with {baseline.get('timestamp', 'the baseline')}:")
+    for endpoint, result in results["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(endpoint)
+        if before is None:
+            print(f"{endpoint}: not in the baseline")
+            continue
+
+        metrics = [("req/s", before["requests_per_s"], result["requests_per_s"])]
+        metrics += [(name, before["latency"].get(f"{name}_ms"), result["latency"].get(f"{name}_ms")) for name in ("p50", "p95", "p99")]
+        metrics += [(f"first result {name}", before.get("first_result", {}).get(f"{name}_ms"), result["first_result"].get(f"{name}_ms"))
+                    for name in ("p50", "p95")]
+
+        changes = []
+        for name, old, new in metrics:
+            if old:
+                changes.append(f"{name} {old} -> {new} ({(new - old) / old * 100:+.1f}%)")
+        print(f"{endpoint}: " + ", ".join(changes))
+
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the server end to end against local stand-ins for Vertex AI and GCS.")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=list(DEFAULT_ENDPOINTS))
+    parser.add_argument("--requests", type=int, default=200, help="number of measured requests per endpoint")
+    parser.add_argument("--warmup", type=int, default=20, help="number of requests sent before measuring")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of requests in flight")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--image-mode", choices=("inline", "reference"), default="inline")
+    parser.add_argument("--thumbnail-size", type=int, default=None)
+    parser.add_argument("--embed-format", choices=("json", "float32"), default="json", help="how /embed queries are sent")
+    parser.add_argument("--result-cache", action="store_true", help="keep the result cache enabled (disabled by default)")
+    parser.add_argument("--identities", type=int, default=50)
+    parser.add_argument("--images-per-identity", type=int, default=20)
+    parser.add_argument("--dim", type=int, default=4096)
+    parser.add_argument("--query-noise", type=float, default=0.5)
+    parser.add_argument("--search-latency-ms", type=float, default=5.0, help="added to every vector search call")
+    parser.add_argument("--gcs-latency-ms", type=float, default=10.0, help="added to every GCS download")
+    parser.add_argument("--embed-latency-ms", type=float, default=20.0, help="added to every embedding model call")
+    parser.add_argument("--embed-per-image-ms", type=float, default=5.0, help="added to every embedding model call, per image")
+    parser.add_argument("--data-dir", default=None, help="where the synthetic gallery is written (default: a temporary folder)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="a results JSON file of a previous run to compare with")
+    parser.add_argument("--verbose", action="store_true", help="show the server logs")
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        data_dir = args.data_dir or stack.enter_context(tempfile.TemporaryDirectory(prefix="face-search-bench-"))
+
+        print(f"Building a gallery of {args.identities} x {args.images_per_identity} images in {data_dir}...")
+        ids, matrix, centroids = fakes.build_gallery(data_dir, args.identities, args.images_per_identity, args.dim, seed = args.seed)
+
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(open(os.devnull, 'w')))
+
+        uvicorn_server, thread, base_url = start_app(args, data_dir, ids, matrix, centroids)
+
+        endpoints = {}
+        try:
+            for endpoint in args.endpoints:
+                endpoints[endpoint] = run_endpoint(base_url, endpoint, args, centroids)
+        finally:
+            uvicorn_server.should_exit = True
+            thread.join()
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count()},
+        "endpoints": endpoints,
+    }
+
+    print_results(results)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare_results(json.load(f), results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f"Results written to {args.output}")
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import platform
+import contextlib
+import subprocess
+import numpy as np
+
+import fakes
+from bench_server import summarize, free_port, drive, make_request_factory
+from local_index import save_npy_dir
+
+
+
+# Benchmark of multi-worker serving (server/shared_gallery.py): the server runs with 1, 2, 4... uvicorn worker
+# processes searching an in-process gallery (SEARCH_BACKEND=local), e.g.
+#   python benchmarks/bench_workers.py --workers 1 2 4 8 --output workers.json
+# in two modes:
+#   shared    the gallery is published once to shared memory by shared_gallery.py and memory-mapped by every worker
+#   private   every worker loads its own copy of the gallery (a sharded .npy directory, concatenated in memory)
+# For every run the throughput and latency of /embed are reported (image_mode=reference, so the search is the work
+# being scaled), with the memory of the worker processes read from /proc/<pid>/smaps_rollup (Linux): RSS counts the
+# shared gallery pages in every worker that mapped them, PSS splits them between those workers, and the anonymous
+# memory (the Python heap, and the private copies of the gallery) is the part of the PSS that is each worker's own.
+# With a shared gallery the anonymous memory per worker does not depend on the gallery and the gallery is counted
+# once (shmem); with private copies every worker adds the size of the gallery.
+# The embedding model and GCS are the stand-ins of fakes.py (benchmarks/fake_app.py), with no added latency by default.
+# The throughput can only scale up to the number of cores: the results record it, and runs with more workers than
+# cores are flagged, their speedup says nothing about the scaling of the server.
+
+MODES = ("shared", "private")
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "server")
+
+
+
+def child_pids(pid):
+    pids = []
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children", 'r') as f:
+            pids += [int(child) for child in f.read().split()]
+    return pids
+
+
+def worker_pids(pid):
+    # the uvicorn worker processes started by pid (multiprocessing spawn), or pid itself when it serves alone
+
+    workers = []
+    for child in child_pids(pid):
+        with open(f"/proc/{child}/cmdline", 'rb') as f:
+            if b"spawn_main" in f.read():
+                workers.append(child)
+    return workers or [pid]
+
+
+def memory_of(pid):
+    # RSS, PSS, and the anonymous and shared memory (tmpfs) parts of the PSS of a process, in bytes
+
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup", 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == "kB":
+                values[fields[0].rstrip(":")] = int(fields[1]) * 1024
+
+    return {"rss": values.get("Rss", 0), "pss": values.get("Pss", 0), "anon": values.get("Pss_Anon", 0),
+            "shmem": values.get("Pss_Shmem", 0)}
+
+
+def wait_until_ready(base_url, process, timeout):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The server exited with code {process.returncode}")
+        try:
+            if httpx.get(base_url + "/ready", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+
+    raise RuntimeError(f"The server was not ready after {timeout} s")
+
+
+@contextlib.contextmanager
+def run_server(mode, workers, args, paths):
+    # starts the server in a subprocess and yields (process, base_url)
+
+    port = free_port()
+    env = dict(os.environ,
+               NO_GCE_CHECK="True", WARMUP_EMBEDDING_MODEL="0", RESULT_CACHE_SIZE="0", LOG_LEVEL="WARNING",
+               EMBEDDING_DIM=str(args.dim), SEARCH_BACKEND="local",
+               BENCH_GALLERY_DIR=paths["images"], BENCH_CENTROIDS_PATH=paths["centroids"],
+               BENCH_EMBED_LATENCY_MS=str(args.embed_latency_ms), BENCH_GCS_LATENCY_MS=str(args.gcs_latency_ms),
+               # one BLAS thread per worker, so that the workers are what scales the search
+               OMP_NUM_THREADS=str(args.blas_threads), OPENBLAS_NUM_THREADS=str(args.blas_threads), MKL_NUM_THREADS=str(args.blas_threads),
+               PYTHONPATH=os.pathsep.join([BENCHMARKS_DIR, SERVER_DIR, os.environ.get("PYTHONPATH", "")]))
+
+    if mode == "shared":
+        command = [sys.executable, os.path.join(SERVER_DIR, "shared_gallery.py"), paths["gallery"], "--workers", str(workers),
+                   "--gallery-dir", paths["shared"], "--host", "127.0.0.1", "--port", str(port),
+                   "--app", "fake_app:app", "--app-dir", BENCHMARKS_DIR]
+    else:
+        env["LOCAL_EMBEDDINGS_PATH"] = paths["gallery"]
+        command = [sys.executable, "-m", "uvicorn", "fake_app:app", "--workers", str(workers), "--host", "127.0.0.1",
+                   "--port", str(port), "--app-dir", BENCHMARKS_DIR, "--log-level", "warning"]
+
+    process = subprocess.Popen(command, env=env, stdout=None if args.verbose else subprocess.DEVNULL,
+                               stderr=None if args.verbose else subprocess.DEVNULL)
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        wait_until_ready(base_url, process, args.startup_timeout)
+        yield process, base_url
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def run(mode, workers, args, paths, centroids):
+    with run_server(mode, workers, args, paths) as (process, base_url):
+        rng = np.random.default_rng(args.seed)
+        build_request = make_request_factory("/embed", args, centroids, rng)
+
+        # every worker searches the whole gallery during the warm-up, so all of its pages are mapped when measuring
+        asyncio.run(drive(base_url, "/embed", build_request, max(args.warmup, 4 * workers), args.concurrency, args.timeout))
+        latencies, _, statuses, elapsed = asyncio.run(drive(base_url, "/embed", build_request, args.requests,
+                                                            args.concurrency, args.timeout))
+
+        memory = [memory_of(pid) for pid in worker_pids(process.pid)]
+
+    return {
+        "mode": mode,
+        "workers": workers,
+        "processes": len(memory),
+        "requests": len(latencies),
+        "errors": sum(count for status, count in statuses.items() if status != "200"),
+        "requests_per_s": round(len(latencies) / elapsed, 2),
+        "latency": summarize(latencies),
+        "rss_mb_per_worker": round(np.mean([m["rss"] for m in memory]) / 2**20, 1),
+        "rss_mb_total": round(sum(m["rss"] for m in memory) / 2**20, 1),
+        "pss_mb_total": round(sum(m["pss"] for m in memory) / 2**20, 1),
+        "anon_mb_per_worker": round(np.mean([m["anon"] for m in memory]) / 2**20, 1),
+        "shmem_mb_total": round(sum(m["shmem"] for m in memory) / 2**20, 1),
+    }
+
+
+def print_results(rows, gallery_mb, cpu_count):
+    print(f"Gallery: {gallery_mb:.1f} MB, {cpu_count} CPU cores")
+    print(f"{'mode':<8} {'workers':>7} {'req/s':>9} {'speedup':>8} {'p50 ms':>9} {'p95 ms':>9} {'RSS/worker':>11} "
+          f"{'PSS total':>10} {'anon/worker':>12} {'shmem':>9} {'errors':>7}")
+
+    for row in rows:
+        base = next(r for r in rows if r["mode"] == row["mode"])
+        print(f"{row['mode']:<8} {row['workers']:>7} {row['requests_per_s']:>9.1f} {row['requests_per_s'] / base['requests_per_s']:>7.2f}x "
+              f"{row['latency']['p50_ms']:>9.2f} {row['latency']['p95_ms']:>9.2f} {row['rss_mb_per_worker']:>9.1f}MB "
+              f"{row['pss_mb_total']:>8.1f}MB {row['anon_mb_per_worker']:>10.1f}MB {row['shmem_mb_total']:>7.1f}MB {row['errors']:>7}"
+              + (" *" if row["workers"] > cpu_count else ""))
+
+    if any(row["workers"] > cpu_count for row in rows):
+        print(f"* more workers than CPU cores ({cpu_count}): the workers share the cores, so the speedup does not measure scaling")
+
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the throughput and memory of the server with several uvicorn workers.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="numbers of worker processes to run")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--requests", type=int, default=400, help="number of measured requests per run")
+    parser.add_argument("--warmup", type=int, default=40, help="number of requests sent before measuring (at least 4 per worker)")
+    parser.add_argument("--concurrency", type=int, default=16, help="number of requests in flight")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--identities", type=int, default=100)
+    parser.add_argument("--images-per-identity", type=int, default=100)
+    parser.add_argument("--dim", type=int, default=4096)
+    parser.add_argument("--query-noise", type=float, default=0.5)
+    parser.add_argument("--embed-format", choices=("json", "float32"), default="float32", help="how /embed queries are sent")
+    parser.add_argument("--blas-threads", type=int, default=1, help="BLAS threads per worker")
+    parser.add_argument("--gcs-latency-ms", type=float, default=0.0)
+    parser.add_argument("--embed-latency-ms", type=float, default=0.0)
+    parser.add_argument("--startup-timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="show the server logs")
+    args = parser.parse_args()
+
+    # the requests are built like the ones of bench_server.py, in reference mode: no image is fetched
+    args.image_mode = "reference"
+    args.thumbnail_size = None
+
+    with tempfile.TemporaryDirectory(prefix="face-search-workers-") as data_dir, \
+         tempfile.TemporaryDirectory(prefix="face-search-shared-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None) as shared_dir:
+
+        print(f"Building a gallery of {args.identities} x {args.images_per_identity} embeddings of dimension {args.dim}...")
+        rng = np.random.default_rng(args.seed)
+        centroids = rng.standard_normal((args.identities, args.dim)).astype(np.float32)
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+        labels = np.repeat(np.arange(args.identities), args.images_per_identity)
+        noise = rng.standard_normal((labels.shape[0], args.dim), dtype=np.float32) * np.float32(0.5 / np.sqrt(args.dim))
+        matrix = centroids[labels] + noise
+        del noise
+        ids = [f"{label}_person{label}_{i % args.images_per_identity}.jpg" for i, label in enumerate(labels)]
+
+        paths = {
+            "images": os.path.join(data_dir, "images"),
+            "centroids": os.path.join(data_dir, "centroids.npy"),
+            "gallery": os.path.join(data_dir, "gallery_npy"),
+            "shared": os.path.join(shared_dir, "gallery"),
+        }
+        os.makedirs(paths["images"])
+        np.save(paths["centroids"], centroids)
+        # two shards: the private mode concatenates them in every worker, the shared mode publishes them as one
+        save_npy_dir(ids, matrix, paths["gallery"], shard_rows = len(ids) // 2 + 1)
+        gallery_mb = matrix.nbytes / 2**20
+        del matrix
+
+        rows = []
+        for mode in args.modes:
+            for workers in args.workers:
+                print(f"Running {mode} with {workers} workers...")
+                rows.append(run(mode, workers, args, paths, centroids))
+
+    cpu_count = os.cpu_count() or 1
+    print_results(rows, gallery_mb, cpu_count)
+
+    if args.output:
+        results = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": vars(args),
+            "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": cpu_count},
+            "gallery_mb": round(gallery_mb, 1),
+            "results": rows,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f"Results written to {args.output}")
+
+
+
+if __name__ == "__main__":
+    main()
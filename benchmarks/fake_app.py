@@ -0,0 +1,35 @@
+import os
+import sys
+import numpy as np
+
+import fakes
+
+
+
+# The server app wired to the stand-ins of fakes.py, as a module that uvicorn worker processes can import
+# ("fake_app:app", see bench_workers.py): every worker installs the stand-ins itself, from the environment
+#   BENCH_GALLERY_DIR       the folder of gallery images served as the GCS bucket
+#   BENCH_CENTROIDS_PATH    a .npy of the identity centroids, used by the fake embedding model
+#   BENCH_GCS_LATENCY_MS / BENCH_EMBED_LATENCY_MS / BENCH_EMBED_PER_IMAGE_MS   the latencies added to every call
+# The search itself is not faked: the workers run the server's own backend (SEARCH_BACKEND, e.g. local).
+
+def env_float(name):
+    return float(os.environ.get(name, "0"))
+
+
+sys.modules["deepface"] = fakes.make_fake_deepface(np.load(os.environ["BENCH_CENTROIDS_PATH"]),
+                                                   latency_ms = env_float("BENCH_EMBED_LATENCY_MS"),
+                                                   per_image_ms = env_float("BENCH_EMBED_PER_IMAGE_MS"))
+
+import utils
+import server
+
+_storage_client = fakes.LocalStorageClient(os.environ["BENCH_GALLERY_DIR"], latency_ms = env_float("BENCH_GCS_LATENCY_MS"))
+utils.ClientRegistry = lambda project_id, region: fakes.FakeClientRegistry(_storage_client, None)
+
+# server.py copies the configuration of utils.py (from utils import *), so both are set
+for module in (utils, server):
+    module.BUCKET_NAME = "benchmark"
+    module.DATASET_ADD = ""
+
+app = server.app
@@ -0,0 +1,198 @@
+import io
+import os
+import sys
+import time
+import types
+import hashlib
+import numpy as np
+from collections import namedtuple
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server"))
+from local_index import LocalExactIndex
+
+
+
+# local stand-ins for the services the server talks to, so that it can be benchmarked without GCP resources:
+#   LocalStorageClient   the GCS calls used by utils.py, served from a local folder
+#   FakeIndexEndpoint    MatchingEngineIndexEndpoint.find_neighbors, answered by exact search over the gallery
+#   make_fake_deepface   a 'deepface' module whose represent() maps a query image to the embedding of its identity
+# Each of them can add a fixed latency per call, to emulate the network round trip of the real service.
+
+
+
+class LocalBlob:
+    def __init__(self, path, latency_ms = 0):
+        self.path = path
+        self.latency = latency_ms / 1000.0
+
+        self.size = None
+        self.etag = None
+        self.md5_hash = None
+        self.content_type = "image/png" if path.endswith(".png") else "image/jpeg"
+
+
+    def reload(self):
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        self.size = len(content)
+        self.etag = self.md5_hash = hashlib.md5(content).hexdigest()
+
+
+    def download_as_bytes(self):
+        time.sleep(self.latency)
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+
+    def download_as_text(self):
+        return self.download_as_bytes().decode()
+
+
+    def open(self, mode = "rb", chunk_size = None):
+        time.sleep(self.latency)
+        return open(self.path, mode)
+
+
+
+class LocalBucket:
+    def __init__(self, root, latency_ms = 0):
+        self.root = root
+        self.latency_ms = latency_ms
+
+
+    def blob(self, blob_name):
+        return LocalBlob(os.path.join(self.root, blob_name), self.latency_ms)
+
+
+    def get_blob(self, blob_name):
+        blob = self.blob(blob_name)
+        if not os.path.isfile(blob.path):
+            return None
+        time.sleep(blob.latency)
+        blob.reload()
+        return blob
+
+
+
+class LocalStorageClient:
+    # every bucket name maps to the same local folder
+
+    def __init__(self, root, latency_ms = 0):
+        self.root = root
+        self.latency_ms = latency_ms
+
+
+    def bucket(self, bucket_name):
+        return LocalBucket(self.root, self.latency_ms)
+
+
+
+Neighbor = namedtuple("Neighbor", ["id", "distance"])
+
+
+class FakeIndexEndpoint:
+    # answers find_neighbors like a deployed DOT_PRODUCT_DISTANCE index, with exact search over the gallery
+
+    def __init__(self, ids, matrix, latency_ms = 0):
+        self.index = LocalExactIndex(ids, matrix)
+        self.latency = latency_ms / 1000.0
+
+
+    def find_neighbors(self, deployed_index_id = None, queries = None, num_neighbors = 10, **kwargs):
+        time.sleep(self.latency)
+        return [[Neighbor(neighbor_id, score) for neighbor_id, score in neighbors]
+                for neighbors in self.index.search_batch(np.asarray(queries, dtype=np.float32), num_neighbors)]
+
+
+
+class FakeClientRegistry:
+    # replaces utils.ClientRegistry: the same interface, backed by the stand-ins above
+
+    def __init__(self, storage_client, index_endpoint):
+        self._storage_client = storage_client
+        self._index_endpoint = index_endpoint
+
+
+    def storage_client(self):
+        return self._storage_client
+
+
+    def index_endpoint(self, index_endpoint_name):
+        return self._index_endpoint
+
+
+    def close(self):
+        pass
+
+
+
+def encode_identity_image(identity, size = 160):
+    # a lossless query image whose first pixel encodes the identity, read back by the fake embedding model
+
+    pixels = np.random.default_rng(identity).integers(0, 256, (size, size, 3), dtype=np.uint8)
+    pixels[0, 0] = (identity % 256, identity // 256, 0)
+
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format="PNG")
+    return output.getvalue()
+
+
+def make_fake_deepface(centroids, latency_ms = 0, per_image_ms = 0, noise = 0.5, seed = 0):
+    """
+    Returns a module that can stand in for 'deepface' (sys.modules["deepface"] = ...).
+
+    represent() takes one BGR array or a list of them, and returns, per image, the embedding of the identity encoded
+    in its first pixel (see encode_identity_image) plus some noise. A call sleeps latency_ms + per_image_ms per image.
+    """
+    rng = np.random.default_rng(seed)
+
+    def represent(img_path, model_name = "VGG-Face", **kwargs):
+        images = img_path if isinstance(img_path, list) else [img_path]
+        time.sleep((latency_ms + per_image_ms * len(images)) / 1000.0)
+
+        results = []
+        for image in images:
+            blue, green, red = np.asarray(image)[0, 0][:3]
+            centroid = centroids[(int(red) + 256 * int(green)) % len(centroids)]
+            embedding = centroid + noise * rng.standard_normal(centroid.shape[0]) / np.sqrt(centroid.shape[0])
+            results.append([{"embedding": embedding.astype(np.float32).tolist()}])
+
+        return results if isinstance(img_path, list) else results[0]
+
+    def build_model(model_name = "VGG-Face", **kwargs):
+        return model_name
+
+    module = types.ModuleType("deepface")
+    module.DeepFace = types.SimpleNamespace(represent=represent, build_model=build_model)
+    return module
+
+
+
+def build_gallery(root, num_identities = 50, images_per_identity = 20, dim = 4096, image_size = 250, noise = 0.5, seed = 0):
+    """
+    Writes a synthetic gallery to root: JPEG images named like the ones of make_dataset.py
+    ("<label>_<identity>_<file>"), one cluster of embeddings per identity.
+
+    Returns (ids, matrix, centroids).
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(root, exist_ok=True)
+
+    centroids = rng.standard_normal((num_identities, dim)).astype(np.float32)
+    centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+
+    ids = []
+    rows = []
+    for label in range(num_identities):
+        for i in range(images_per_identity):
+            image_id = f"{label}_person{label}_{i}.jpg"
+            path = os.path.join(root, image_id)
+            if not os.path.exists(path):
+                pixels = rng.integers(0, 256, (image_size, image_size, 3), dtype=np.uint8)
+                Image.fromarray(pixels).save(path, format="JPEG", quality=90)
+
+            ids.append(image_id)
+            rows.append(centroids[label] + noise * rng.standard_normal(dim) / np.sqrt(dim))
+
+    return ids, np.asarray(rows, dtype=np.float32), centroids
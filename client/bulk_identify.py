@@ -0,0 +1,314 @@
+import os
+import io
+import sys
+import csv
+import json
+import time
+import tarfile
+import zipfile
+import argparse
+import threading
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# the image preprocessing is shared with the server (server/preprocessing.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server"))
+from preprocessing import image_bytes_to_bgr
+
+
+
+# Headless bulk identification: every image of a folder or of a .zip/.tar archive is identified by the server, e.g.
+#   python client/bulk_identify.py photos/ results.csv --server-url http://localhost:8080
+#   python client/bulk_identify.py photos.zip results.jsonl --server-url http://localhost:8080 --endpoint embed_batch
+# Endpoints:
+#   faceimage     the images are uploaded and embedded by the server
+#   embed         the images are embedded here (one DeepFace model, batches of --batch-size images), one /embed
+#                 request per image
+#   embed_batch   the images are embedded here, and every batch is identified with one /embed_batch request
+# Requests go through one requests.Session (pooled keep-alive connections), at most --concurrency of them in flight;
+# embedding the next batch overlaps with the requests of the previous one. The results (file, identity, code, number
+# of accepted neighbors, timings) are written as CSV or JSONL (by the extension of the output file), and a throughput
+# summary is printed at the end.
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+ENDPOINTS = ("faceimage", "embed", "embed_batch")
+
+RESULT_FIELDS = ["file", "status", "identity", "code", "num_neighbors", "embed_ms", "request_ms", "error"]
+
+
+
+def iter_images(source):
+    """
+    Yields (name, image bytes) for every image of a folder (recursively, in sorted order) or of a .zip / .tar(.gz)
+    archive, without extracting the archive to disk.
+    """
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for file_name in sorted(files):
+                if file_name.lower().endswith(IMAGE_EXTENSIONS):
+                    path = os.path.join(root, file_name)
+                    with open(path, 'rb') as f:
+                        yield os.path.relpath(path, source), f.read()
+
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                    yield info.filename, archive.read(info)
+
+    elif tarfile.is_tarfile(source):
+        with tarfile.open(source) as archive:
+            for member in archive:
+                if member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield member.name, archive.extractfile(member).read()
+
+    else:
+        raise ValueError(f"{source} is neither a folder nor a .zip/.tar archive")
+
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def make_session(pool_size):
+    # one pooled session shared by all the request threads: connections are kept alive and reused
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+
+class Embedder:
+    # the DeepFace model, built once, and the batched embedding of decoded images
+
+    def __init__(self, model_name = "VGG-Face"):
+        from deepface import DeepFace
+
+        self.DeepFace = DeepFace
+        self.model_name = model_name
+        DeepFace.build_model(model_name)
+
+
+    def embed(self, images):
+        """
+        Embeds a batch of image bytes. Returns a list with, for every image, its embedding (float32 array) or the
+        exception raised for it (undecodable image, no face detected...).
+        """
+        arrays = []
+        for contents in images:
+            try:
+                arrays.append(image_bytes_to_bgr(contents))
+            except Exception as e:
+                arrays.append(e)
+
+        valid = [i for i, array in enumerate(arrays) if not isinstance(array, Exception)]
+        results = list(arrays)
+
+        if len(valid) > 1:
+            try:
+                faces = self.DeepFace.represent([arrays[i] for i in valid], model_name = self.model_name)
+                if len(faces) == len(valid) and all(isinstance(f, list) and f for f in faces):
+                    for i, image_faces in zip(valid, faces):
+                        results[i] = np.asarray(image_faces[0]['embedding'], dtype=np.float32)
+                    return results
+            except Exception:
+                pass # one of the images has no face, or this DeepFace version does not batch: embed them one by one
+
+        for i in valid:
+            try:
+                results[i] = np.asarray(self.DeepFace.represent(arrays[i], model_name = self.model_name)[0]['embedding'], dtype=np.float32)
+            except Exception as e:
+                results[i] = e
+
+        return results
+
+
+
+def post_faceimage(session, base_url, name, contents, timeout):
+    response = session.post(base_url.rstrip("/") + "/faceimage", files={"file": (os.path.basename(name), contents)},
+                            params={"image_mode": "reference"}, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+
+def post_embed(session, base_url, embedding, timeout):
+    response = session.post(base_url.rstrip("/") + "/embed", data=np.asarray(embedding, dtype='<f4').tobytes(),
+                            headers={"Content-Type": "application/x-float32"}, params={"image_mode": "reference"},
+                            timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+
+def post_embed_batch(session, base_url, embeddings, timeout):
+    response = session.post(base_url.rstrip("/") + "/embed_batch", json={"data": [embedding.tolist() for embedding in embeddings]},
+                            timeout=timeout)
+    response.raise_for_status()
+    return response.json()["results"]
+
+
+def make_result(name, response = None, error = None, embed_ms = None, request_ms = None):
+    if error is not None:
+        if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+            error = f"{error} - {error.response.text[:200]}"
+        return {"file": name, "status": "error", "identity": None, "code": None, "num_neighbors": None,
+                "embed_ms": embed_ms, "request_ms": request_ms, "error": str(error)}
+
+    return {"file": name, "status": "ok", "identity": response.get("identity"), "code": response.get("code"),
+            "num_neighbors": len(response.get("returned_image_ids") or []),
+            "embed_ms": embed_ms, "request_ms": request_ms, "error": None}
+
+
+
+class ResultWriter:
+    # writes the results as CSV or JSONL, as they complete (from any thread)
+
+    def __init__(self, output_path):
+        self.file = open(output_path, 'w', newline='')
+        self.jsonl = output_path.lower().endswith((".jsonl", ".json"))
+        self.writer = None if self.jsonl else csv.DictWriter(self.file, fieldnames=RESULT_FIELDS)
+        if self.writer is not None:
+            self.writer.writeheader()
+        self.lock = threading.Lock()
+        self.results = []
+
+
+    def write(self, results):
+        with self.lock:
+            for result in results:
+                if self.jsonl:
+                    self.file.write(json.dumps(result) + '\n')
+                else:
+                    self.writer.writerow(result)
+                self.results.append(result)
+
+
+    def close(self):
+        self.file.close()
+
+
+
+def identify_images(args, writer):
+    session = make_session(args.concurrency)
+    embedder = Embedder(args.model) if args.endpoint != "faceimage" else None
+
+    def timed_call(func, *call_args):
+        start_time = time.perf_counter()
+        return func(*call_args), round((time.perf_counter() - start_time) * 1000, 3)
+
+    def send_faceimage(name, contents):
+        try:
+            response, request_ms = timed_call(post_faceimage, session, args.server_url, name, contents, args.timeout)
+            return [make_result(name, response, request_ms = request_ms)]
+        except Exception as e:
+            return [make_result(name, error = e)]
+
+    def send_embed(name, embedding, embed_ms):
+        try:
+            response, request_ms = timed_call(post_embed, session, args.server_url, embedding, args.timeout)
+            return [make_result(name, response, embed_ms = embed_ms, request_ms = request_ms)]
+        except Exception as e:
+            return [make_result(name, error = e, embed_ms = embed_ms)]
+
+    def send_embed_batch(names, embeddings, embed_ms):
+        try:
+            responses, request_ms = timed_call(post_embed_batch, session, args.server_url, embeddings, args.timeout)
+            return [make_result(name, response, embed_ms = embed_ms, request_ms = request_ms)
+                    for name, response in zip(names, responses)]
+        except Exception as e:
+            return [make_result(name, error = e, embed_ms = embed_ms) for name in names]
+
+    pending = set()
+
+    def submit(executor, func, *call_args):
+        # at most args.concurrency requests in flight; the results are written as they complete
+        while len(pending) >= args.concurrency:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                writer.write(future.result())
+        pending.add(executor.submit(func, *call_args))
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for batch in iter_batches(iter_images(args.source), args.batch_size):
+            if embedder is None:
+                for name, contents in batch:
+                    submit(executor, send_faceimage, name, contents)
+                continue
+
+            start_time = time.perf_counter()
+            embeddings = embedder.embed([contents for _, contents in batch])
+            embed_ms = round((time.perf_counter() - start_time) * 1000 / len(batch), 3) # per image
+
+            failed = [make_result(name, error = embedding, embed_ms = embed_ms)
+                      for (name, _), embedding in zip(batch, embeddings) if isinstance(embedding, Exception)]
+            writer.write(failed)
+            embedded = [(name, embedding) for (name, _), embedding in zip(batch, embeddings) if not isinstance(embedding, Exception)]
+
+            if args.endpoint == "embed_batch":
+                if embedded:
+                    submit(executor, send_embed_batch, [name for name, _ in embedded], [embedding for _, embedding in embedded], embed_ms)
+            else:
+                for name, embedding in embedded:
+                    submit(executor, send_embed, name, embedding, embed_ms)
+
+        for future in pending:
+            writer.write(future.result())
+
+    session.close()
+
+
+def summarize(results, elapsed):
+    request_ms = np.asarray([r["request_ms"] for r in results if r["request_ms"] is not None], dtype=np.float64)
+    ok = [r for r in results if r["status"] == "ok"]
+    identified = sum(1 for r in ok if r["code"] == 1)
+
+    print(f"Processed {len(results)} images in {elapsed:.2f} s ({len(results) / max(elapsed, 1e-9):.1f} images/s): "
+          f"{identified} identified, {len(ok) - identified} unknown, {len(results) - len(ok)} errors.")
+    if request_ms.size:
+        print(f"Request latency: mean {request_ms.mean():.1f} ms, p50 {np.percentile(request_ms, 50):.1f} ms, "
+              f"p95 {np.percentile(request_ms, 95):.1f} ms")
+
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Identify every image of a folder or archive with the face search server.")
+    parser.add_argument("source", help="a folder of images, or a .zip / .tar(.gz) archive of images")
+    parser.add_argument("output", help="the results file, CSV or JSONL (by its extension)")
+    parser.add_argument("--server-url", default="http://localhost:8080", help="the base URL of the server")
+    parser.add_argument("--endpoint", choices=ENDPOINTS, default="embed_batch", help="how the images are identified (see the top of this file)")
+    parser.add_argument("--batch-size", type=int, default=16, help="number of images embedded together")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of requests in flight")
+    parser.add_argument("--model", default="VGG-Face", help="the DeepFace model, the same as the server's")
+    parser.add_argument("--timeout", type=float, default=60.0, help="timeout of every request, in seconds")
+    args = parser.parse_args()
+
+    writer = ResultWriter(args.output)
+    start_time = time.perf_counter()
+    try:
+        identify_images(args, writer)
+    finally:
+        writer.close()
+
+    summarize(writer.results, time.perf_counter() - start_time)
+    print(f"Results written to {args.output}")
+
+
+
+if __name__ == "__main__":
+    main()
@@ -7,35 +7,45 @@ import time
 import base64
 from deepface import DeepFace
 import numpy as np
+from urllib.parse import urljoin
+import sys
+import json
+
+# the image preprocessing is shared with the server (server/preprocessing.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server"))
+from preprocessing import image_bytes_to_bgr
 
 
 DEFAULT_SERVER_URL = "http://localhost:8080/embed" # Example local URL
 
 REQUEST_TIMEOUT = 20.0  # Increased timeout for potential upload + processing + network latency
 
+DEFAULT_THUMBNAIL_SIZE = 320 # the server returns previews of at most this many pixels per side (0 = full-size originals)
 
-def Pil_to_array(image_pil):
-    # make the image in the compatible format to be passed to DeepFace
+EMBEDDING_MODEL = "VGG-Face" # the DeepFace model used for /embed queries, the same as the server's
 
-    # Convert the Pillow image to a NumPy array
-    image_np_rgb = np.array(image_pil)
 
-    # Extract the individual color channels (R, G, B)
-    red_channel = image_np_rgb[:, :, 0]
-    green_channel = image_np_rgb[:, :, 1]
-    blue_channel = image_np_rgb[:, :, 2]
+@st.cache_resource
+def get_session():
+    # one HTTP session for the whole app, so that the connection to the server is kept alive across reruns
+    return requests.Session()
 
-    # Stack the channels in BGR order
-    return np.stack([blue_channel, green_channel, red_channel], axis=-1)
 
+@st.cache_resource
+def load_embedding_model(model_name = EMBEDDING_MODEL):
+    # build the DeepFace model once, not on every Streamlit rerun
+    return DeepFace.build_model(model_name)
 
 
 def display_images(images_data, title="Returned Images"):
     """
-    Display a grid of images (base64 encoded strings) using Streamlit.
+    Display a grid of images (base64 encoded strings or image URLs) using Streamlit.
+
+    Image URLs are handed to the browser as is, so it fetches them in parallel and can serve them
+    from its own (or a proxy's) HTTP cache.
 
     Args:
-        images_data (list): A list of base64 encoded image strings.
+        images_data (list): A list of base64 encoded image strings or http(s) URLs.
         title (str, optional): The title to display above the images. Defaults to "Returned Images".
     """
     st.header(title)
@@ -45,7 +55,9 @@ def display_images(images_data, title="Returned Images"):
 
     images_bytes = []
     for item in images_data:
-        if isinstance(item, str):
+        if isinstance(item, str) and item.startswith(('http://', 'https://')):
+            images_bytes.append(item)
+        elif isinstance(item, str):
              try:
                  missing_padding = len(item) % 4
                  if missing_padding:
@@ -76,7 +88,7 @@ def display_images(images_data, title="Returned Images"):
         cols = st.columns(num_cols)
         for i, img_bytes in enumerate(images_bytes):
             try:
-                image = Image.open(BytesIO(img_bytes))
+                image = img_bytes if isinstance(img_bytes, str) else Image.open(BytesIO(img_bytes))
                 with cols[i % num_cols]:
                     st.image(image, use_container_width=True) 
             except Exception as e:
@@ -84,7 +96,45 @@ def display_images(images_data, title="Returned Images"):
 
 
 
-def upload_and_get_images(image_bytes, pil_image , filename="uploaded_image.jpg", server_url=""):
+def resolve_image_urls(result_data, server_url):
+    # the server returns image URLs relative to itself (image_mode "reference"); make them absolute
+    if result_data.get('returned_image_urls'):
+        result_data['returned_image_urls'] = [urljoin(server_url, url) for url in result_data['returned_image_urls']]
+    return result_data
+
+
+
+def post_to_server(url, on_event=None, **request_kwargs):
+    # posts a query and returns the JSON result. With on_event, the streaming variant of the endpoint (url + "/stream")
+    # is used: every NDJSON event is passed to on_event as it arrives, and the result is assembled from them.
+
+    if on_event is None:
+        response = get_session().post(url, timeout=REQUEST_TIMEOUT, **request_kwargs)
+        response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
+        return response.json()
+
+    result_data = {}
+    images = {}
+    with get_session().post(url + "/stream", timeout=REQUEST_TIMEOUT, stream=True, **request_kwargs) as response:
+        if not response.ok:
+            response.content # read the error detail before the connection is released
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if event["event"] == "identity":
+                result_data = {key: value for key, value in event.items() if key != "event"}
+            elif event["event"] == "image":
+                images[event["index"]] = event["image"]
+            on_event(event)
+
+    result_data["returned_images"] = [images[index] for index in sorted(images)]
+    return result_data
+
+
+
+def upload_and_get_images(image_bytes, pil_image , filename="uploaded_image.jpg", server_url="", thumbnail_size=DEFAULT_THUMBNAIL_SIZE, by_reference=False, on_event=None):
     """
     Uploads image bytes to the specified server URL's /face endpoint using POST
     and expects a JSON response containing returned images and a code.
@@ -94,6 +144,10 @@ def upload_and_get_images(image_bytes, pil_image , filename="uploaded_image.jpg"
         pil_image: (Image): the image as PIL Image
         filename (str): The filename to use for the upload.
         server_url (str): The full URL of the server endpoint.
+        thumbnail_size (int): ask the server for previews of at most this many pixels per side (0 = full-size originals).
+        by_reference (bool): ask the server for image URLs instead of inline base64 images.
+        on_event (callable): if set, the response is streamed, and on_event is called with every event
+                             (the identity first, then every image as soon as the server has it).
 
     Returns:
         tuple: (status, data) where status is one of ['success', 'timeout', 'error']
@@ -107,33 +161,41 @@ def upload_and_get_images(image_bytes, pil_image , filename="uploaded_image.jpg"
 
     endpoint = server_url.split("/")[-1]
 
+    thumbnail_params = {"thumbnail_size": int(thumbnail_size)} if thumbnail_size else {}
+    if by_reference:
+        thumbnail_params["image_mode"] = "reference"
 
 
     try:
         if endpoint == "embed": # when the client wants to send the embedding as query
 
             try:
-                img_array = Pil_to_array(pil_image)
-                img_embd = DeepFace.represent(img_array)[0]['embedding']
-                payload = {"data": img_embd}
+                # decoded at a bounded resolution, straight into BGR (as DeepFace expects)
+                img_array = image_bytes_to_bgr(image_bytes)
+                load_embedding_model(EMBEDDING_MODEL)
+                img_embd = DeepFace.represent(img_array, model_name=EMBEDDING_MODEL)[0]['embedding']
 
                 st.write(f"***** {len(img_embd)} *********")
 
                 if not isinstance(img_embd, list):
                     return "error during embedding, the output is not a list", "error during embedding, the output is not a list"
 
+                # the embedding is sent as raw little-endian float32 values rather than JSON text
+                payload = np.asarray(img_embd, dtype='<f4').tobytes()
+
             except Exception as e:
                 return f"error during embedding: {e}", f"error during embedding: {e}"
 
 
-            response = requests.post(
+            result_data = post_to_server(
                 server_url,
-                json=payload,  
-                timeout=REQUEST_TIMEOUT,
+                on_event=on_event,
+                data=payload,
+                headers={"Content-Type": "application/x-float32"},
+                params=thumbnail_params,
             )
 
-            response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-            result_data = response.json()
+            result_data = resolve_image_urls(result_data, server_url)
             return "success", result_data 
 
 
@@ -143,15 +205,14 @@ def upload_and_get_images(image_bytes, pil_image , filename="uploaded_image.jpg"
             
             data_payload = {"file": (filename, image_bytes)}
             
-            response = requests.post(
+            result_data = post_to_server(
                 server_url,
+                on_event=on_event,
                 files=data_payload,
-                timeout=REQUEST_TIMEOUT
+                params=thumbnail_params,
             )
 
-            response.raise_for_status() 
-
-            result_data = response.json()
+            result_data = resolve_image_urls(result_data, server_url)
             return "success", result_data 
 
         else:
@@ -162,6 +223,7 @@ def upload_and_get_images(image_bytes, pil_image , filename="uploaded_image.jpg"
     except requests.exceptions.Timeout:
         return "timeout", f"Request timed out after {REQUEST_TIMEOUT} seconds."
     except requests.exceptions.HTTPError as http_err:
+        response = http_err.response
         error_detail = response.text
         try:
             error_json = response.json()
@@ -207,6 +269,12 @@ def main():
         st.session_state.error_message = None
     if 'image' not in st.session_state:
         st.session_state.image = None
+    if 'thumbnail_size' not in st.session_state:
+        st.session_state.thumbnail_size = DEFAULT_THUMBNAIL_SIZE
+    if 'by_reference' not in st.session_state:
+        st.session_state.by_reference = False
+    if 'stream_results' not in st.session_state:
+        st.session_state.stream_results = True
 
 
 
@@ -220,6 +288,24 @@ def main():
             help="Enter the full URL of the backend server endpoint."
         )
         st.caption(f"Current endpoint: {st.session_state.server_url}")
+        st.session_state.thumbnail_size = st.number_input(
+            "Returned image size (px)",
+            min_value=0,
+            max_value=4096,
+            value=st.session_state.thumbnail_size,
+            step=32,
+            help="The server returns previews of at most this many pixels per side. Use 0 to get the full-size originals."
+        )
+        st.session_state.by_reference = st.checkbox(
+            "Load images by URL",
+            value=st.session_state.by_reference,
+            help="The server returns image URLs instead of embedding the images in its response; the browser then fetches and caches them."
+        )
+        st.session_state.stream_results = st.checkbox(
+            "Stream results",
+            value=st.session_state.stream_results,
+            help="Show the detected identity as soon as the server has it, and every image as soon as it is downloaded, instead of waiting for the complete response."
+        )
         st.markdown("---") # Separator
 
     
@@ -271,12 +357,33 @@ def main():
             st.warning("Please upload an image first.")
             st.rerun()
         else:
+            on_event = None
+            if st.session_state.stream_results:
+                # the partial results are shown in the results column while they arrive; the complete result
+                # replaces them on the next rerun
+                with col2:
+                    progress = st.empty()
+                streamed = {"identity": None, "images": []}
+
+                def on_event(event):
+                    if event["event"] == "identity":
+                        streamed["identity"] = event.get("identity", "N/A")
+                    elif event["event"] == "image":
+                        streamed["images"].append(event["image"])
+                    with progress.container():
+                        st.markdown(f"**Detected Identity:** `{streamed['identity']}`")
+                        if streamed["images"]:
+                            display_images(streamed["images"], title="Similar Faces Found:")
+
             with st.spinner(f"⏳ Searching for similar faces via {st.session_state.server_url}..."):
                 status, data = upload_and_get_images(
                     st.session_state.uploaded_image_bytes,
                     st.session_state.image,
                     st.session_state.uploaded_filename,
-                    server_url=st.session_state.server_url
+                    server_url=st.session_state.server_url,
+                    thumbnail_size=st.session_state.thumbnail_size,
+                    by_reference=st.session_state.by_reference,
+                    on_event=on_event
                 )
 
                 if status == 'success':
@@ -313,7 +420,7 @@ def main():
                 st.session_state.show_results = False
 
             elif response_code == 1:
-                if st.session_state.result_data and 'returned_images' in st.session_state.result_data and st.session_state.result_data['returned_images']:
+                if st.session_state.result_data and (st.session_state.result_data.get('returned_images') or st.session_state.result_data.get('returned_image_urls')):
                      st.session_state.show_results = True # Flag to show images below
                 else:
                     st.warning("⚠️ Server indicated success (code=1), but no images were returned.")
@@ -334,7 +441,7 @@ def main():
 
         # --- Show Results Area (Images) ---
         if st.session_state.request_state == 'received' and st.session_state.show_results:
-            images_to_display = st.session_state.result_data.get('returned_images', [])
+            images_to_display = st.session_state.result_data.get('returned_images') or st.session_state.result_data.get('returned_image_urls', [])
             if images_to_display:
                 display_images(images_to_display, title="Similar Faces Found:")
 
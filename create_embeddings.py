@@ -4,7 +4,42 @@ import shutil
 import json
 import base64
 import sys
-from deepface import DeepFace
+import time
+import hashlib
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+
+def format_embedding_lines(ids, matrix):
+    """
+    Formats embeddings as Vertex AI JSON lines ({"id": ..., "embedding": [...]}).
+
+    Every row is formatted by a single %-format of all its values, which is several times faster than json.dumps
+    of a list of floats. '%.9g' keeps every float32 value exact and writes shorter lines than the float64 repr.
+    It would also write nan and inf, which are not valid JSON, so rows with non-finite values are rejected
+    (see finite_rows to drop them beforehand).
+
+    Returns a list of str, one line (ending with a newline) per id.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim != 2 or matrix.shape[0] != len(ids):
+        raise ValueError(f"Got {len(ids)} ids for embeddings of shape {matrix.shape}")
+
+    finite = finite_rows(matrix)
+    if not finite.all():
+        bad_ids = [str(image_id) for image_id, ok in zip(ids, finite) if not ok]
+        raise ValueError(f"Embeddings with non-finite values: {', '.join(bad_ids)}")
+
+    row_format = '{"id": %s, "embedding": [' + ', '.join(['%.9g'] * matrix.shape[1]) + ']}\n'
+
+    return [row_format % ((json.dumps(str(image_id)),) + tuple(row)) for image_id, row in zip(ids, matrix.tolist())]
+
+
+def finite_rows(matrix):
+    # a boolean mask of the rows of matrix whose values are all finite (no nan or inf)
+    return np.isfinite(matrix).all(axis=1)
 
 
 
@@ -22,10 +57,43 @@ def create_embeddings_jsonl(image_data, output_filename):
     """
     print(f"Starting to write embeddings to {output_filename}...")
     count = 0
+
+    # the common case, an id and an embedding only, takes the fast formatting path: every embedding is checked on its
+    # own (a float32 vector with finite values), then consecutive ones of the same dimension are formatted by one
+    # format_embedding_lines call per FORMAT_BATCH_ROWS items
+    batch_ids, batch_rows = [], []
+
+    def write_batch(f):
+        if not batch_ids:
+            return 0
+        try:
+            f.writelines(format_embedding_lines(batch_ids, np.stack(batch_rows)))
+            return len(batch_ids)
+        finally:
+            batch_ids.clear()
+            batch_rows.clear()
+
     with open(output_filename, 'w') as f:
         for item in image_data:
             try:
 
+                if not any(key in item for key in ('restricts', 'numeric_restricts', 'crowding_tag')) and \
+                   isinstance(item['embedding'], (np.ndarray, list)):
+                    row = np.asarray(item['embedding'], dtype=np.float32)
+                    if row.ndim != 1:
+                        raise ValueError(f"the embedding has shape {row.shape}, expected a vector")
+                    if not np.isfinite(row).all():
+                        print(f"Warning: Skipping item {item['id']} due to non-finite values in its embedding")
+                        continue
+
+                    if batch_rows and (len(batch_rows) >= FORMAT_BATCH_ROWS or row.shape != batch_rows[0].shape):
+                        count += write_batch(f)
+                    batch_ids.append(item['id'])
+                    batch_rows.append(row)
+                    continue
+
+                count += write_batch(f)
+
                 json_object = {
                     "id": str(item['id']), # Ensure ID is a string
                     "embedding": None # Placeholder
@@ -58,49 +126,399 @@ def create_embeddings_jsonl(image_data, output_filename):
             except Exception as e:
                 print(f"Warning: Skipping item {item.get('id', 'UNKNOWN')} due to error: {e}")
 
+        count += write_batch(f)
+
     print(f"Finished writing {count} embeddings to {output_filename}.")
 
 
 
 # this code assuems that all images are stored under dataset_path
+#
+# The images are embedded by a pool of worker processes, each loading the model once and embedding batches of
+# images per call. Embeddings are appended to the output file as soon as a batch is done, and every image written
+# is recorded in a manifest (<output>.manifest.jsonl) with the byte offset the output file reached after its line,
+# its size, mtime and sha256, and the model that embedded it.
+#   --resume       continues a run that stopped (dropping a partially written line, if any)
+#   --incremental  updates the output of a finished run: only new or modified images are embedded, deleted ones
+#                  are dropped, and the changes are also written to a delta folder (see write_delta)
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+EMBEDDING_DIM = 4096 # the dimension of the VGG-Face embeddings; images that cannot be embedded get a zero vector
+HASH_CHUNK_BYTES = 2**20
+FORMAT_BATCH_ROWS = 1024 # the number of embeddings create_embeddings_jsonl formats per call
+
+_MODEL_NAME = None # the model used by the worker process
+DeepFace = None # deepface.DeepFace, imported by the worker processes only (see init_worker)
+
+
+
+def init_worker(model_name):
+    # runs once in every worker process: load the model before the first batch. DeepFace (and TensorFlow) is
+    # imported here and not at the top of this file: the parent process never initializes TensorFlow, and the
+    # workers are spawned rather than forked (see embed_into), so none of them inherits its thread pools
+    global _MODEL_NAME, DeepFace
+    from deepface import DeepFace
+
+    _MODEL_NAME = model_name
+    DeepFace.build_model(model_name)
+
+
+def embed_images(paths):
+    """
+    Embeds a batch of image files in a worker process.
+
+    Returns a list with, for every path, its embedding or None if it could not be embedded. The whole batch is
+    passed to DeepFace at once; if that fails (e.g. no face in one of the images, or a DeepFace version without
+    batch support), the images are embedded one by one.
+    """
+    if len(paths) > 1:
+        try:
+            results = DeepFace.represent(img_path = list(paths), model_name = _MODEL_NAME)
+
+            if len(results) == len(paths) and all(isinstance(faces, list) and faces for faces in results):
+                return [faces[0]['embedding'] for faces in results]
+
+        except Exception:
+            pass
+
+    embeddings = []
+    for path in paths:
+        try:
+            embeddings.append(DeepFace.represent(img_path = path, model_name = _MODEL_NAME)[0]['embedding'])
+        except Exception:
+            embeddings.append(None)
+
+    return embeddings
+
+
+def process_batch(paths):
+    # runs in a worker process: the embeddings of a batch of files, and the manifest fields of every file
+    return embed_images(paths), [describe_file(path) for path in paths]
+
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def describe_file(path):
+    # the manifest fields used to detect a modified image
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": file_sha256(path)}
+
+
+
+def get_manifest_path(output_filename):
+    return output_filename + ".manifest.jsonl"
+
+
+def read_manifest(manifest_path):
+    """
+    Reads the records of a manifest, in the order their lines were written to the output file.
+
+    Returns (records, size): the complete records, and the number of bytes they take in the manifest. A line
+    cut short by a crash (and anything after it) is not returned.
+    """
+    records = []
+    size = 0
+
+    if not os.path.exists(manifest_path):
+        return records, size
+
+    with open(manifest_path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+            size += len(line)
+
+    return records, size
+
+
+def load_manifest(manifest_path):
+    """
+    Reads the manifest of a previous run.
+
+    Returns (done, offset): the ids already written, and the size the output file had after the last of them.
+    A line cut short by a crash is removed from the manifest, so that new records start on a line of their own.
+    """
+    records, manifest_size = read_manifest(manifest_path)
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'ab') as f:
+            f.truncate(manifest_size)
+
+    done = {record['id'] for record in records}
+    offset = records[-1]['offset'] if records else 0
+
+    return done, offset
+
+
+
+def plan_incremental_update(dataset_path, img_names, records, model_name):
+    """
+    Compares the dataset with the manifest of the previous run.
+
+    Returns (unchanged, to_embed, deleted): the manifest records that are still valid (with their mtime refreshed),
+    the names of the new or modified images, and the ids of the images that no longer exist. An image whose mtime
+    changed is only re-embedded if its content (sha256) changed too; every image is re-embedded if the model changed,
+    and so is every image that could not be embedded by the previous run (a status other than "ok").
+    """
+    previous = {record['id']: record for record in records}
+
+    unchanged = []
+    to_embed = []
+    for img_name in img_names:
+        record = previous.get(img_name)
+        path = os.path.join(dataset_path, img_name)
+        stat = os.stat(path)
+
+        if record is not None and record.get('status') == "ok" and record.get('model') == model_name and \
+           record.get('size') == stat.st_size:
+            if record.get('mtime') == stat.st_mtime or record.get('sha256') == file_sha256(path):
+                unchanged.append(dict(record, mtime=stat.st_mtime))
+                continue
+
+        to_embed.append(img_name)
+
+    current = set(img_names)
+    deleted = [record['id'] for record in records if record['id'] not in current]
+
+    return unchanged, to_embed, deleted
+
+
+def copy_unchanged_lines(previous_output, records, unchanged, output_file, manifest_file):
+    """
+    Copies the lines of the unchanged images from the previous output file, byte for byte, and writes their
+    manifest records with the new offsets. Every line of the output is recorded in the manifest, so the line
+    of a record spans from the offset of the previous record to its own offset.
+
+    Returns the size of the output file after the copied lines.
+    """
+    starts = {}
+    previous_offset = 0
+    for record in records:
+        starts[record['id']] = previous_offset
+        previous_offset = record['offset']
+
+    offset = 0
+    with open(previous_output, 'rb') as f:
+        for record in sorted(unchanged, key=lambda record: record['offset']):
+            f.seek(starts[record['id']])
+            line = f.read(record['offset'] - starts[record['id']])
+            output_file.write(line)
+            offset += len(line)
+            manifest_file.write(json.dumps(dict(record, offset=offset)) + '\n')
+
+    return offset
 
-def main():
 
-    dataset_path = sys.argv[1]
+def write_delta(delta_dir, deleted):
+    """
+    Prepares a delta folder for a Vertex AI Vector Search batch update (contentsDeltaUri with isCompleteOverwrite=False):
+      upserts.json       the new and re-embedded images, in the same format as the full output file
+      delete/ids.txt     the ids of the deleted images, one per line
+
+    Returns the opened upserts.json file, to which the new embeddings are appended. The same records can be
+    streamed to a deployed index with upsert_datapoints / remove_datapoints.
+    """
+    os.makedirs(os.path.join(delta_dir, "delete"), exist_ok=True)
+
+    with open(os.path.join(delta_dir, "delete", "ids.txt"), 'w') as f:
+        for img_id in deleted:
+            f.write(img_id + '\n')
+
+    return open(os.path.join(delta_dir, "upserts.json"), 'wb')
+
+
+
+def embed_into(dataset_path, img_names, output_file, manifest_file, offset, model_name, workers, batch_size, delta_file = None,
+               written = None):
+    """
+    Embeds img_names with a pool of worker processes, appending each embedding to output_file (and delta_file)
+    and its record to manifest_file as soon as its batch is done.
+
+    offset (int): the current size of output_file.
+    written (list): if given, the (ids, float32 matrix) of every batch written is appended to it, in file order.
 
-    output_embedding_name = sys.argv[2] #the output embedding file name. it should be .json
+    Returns (success, not_succuess, offset).
+    """
+    batches = [img_names[i:i + batch_size] for i in range(0, len(img_names), batch_size)]
 
     not_succuess = 0
     success = 0
+    start_time = time.perf_counter()
 
-    list_of_dict = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_worker, initargs=(model_name,)) as executor:
 
-    embeddings = {}
+        pending = {}
+        next_batch = 0
 
-    for img_name in os.listdir(dataset_path):
+        while pending or next_batch < len(batches):
 
-        if img_name.endswith(".png") or img_name.endswith(".jpg") or img_name.endswith(".jpeg"):
-        
-            path = os.path.join(dataset_path, img_name)
-            
-            try:
+            # keep a bounded number of batches in flight so results are written as they arrive
+            while next_batch < len(batches) and len(pending) < 2 * workers:
+                batch = batches[next_batch]
+                pending[executor.submit(process_batch, [os.path.join(dataset_path, name) for name in batch])] = batch
+                next_batch += 1
 
-                emb = DeepFace.represent(img_path = path)[0]['embedding']
-                success = success +1
-                
-            except:
-                not_succuess = not_succuess + 1
-                emb = [0 for i in range(4096)]
-            
-            entry = {"id": img_name, "embedding": emb}
-            
-            list_of_dict.append(entry)
-        
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
 
-    print(f"The number of images encoded into embedding: {success} \n The number of images NOT encoded into embedding: {not_succuess}")
+            for future in finished:
+                batch = pending.pop(future)
+                try:
+                    embeddings, file_infos = future.result()
+                except Exception as e:
+                    print(f"Warning: batch starting at {batch[0]} failed: {e}")
+                    embeddings = [None] * len(batch)
+                    file_infos = [{} for _ in batch]
+
+                statuses = []
+                for i, emb in enumerate(embeddings):
+                    if emb is not None and not np.isfinite(emb).all():
+                        print(f"Warning: the embedding of {batch[i]} has non-finite values")
+                        emb = None
+                    if emb is None:
+                        not_succuess = not_succuess + 1
+                        embeddings[i] = [0] * EMBEDDING_DIM
+                        statuses.append("failed")
+                    else:
+                        success = success + 1
+                        statuses.append("ok")
+
+                matrix = np.asarray(embeddings, dtype=np.float32)
+                if written is not None:
+                    written.append((batch, matrix))
+
+                records = []
+                for img_name, status, file_info, line in zip(batch, statuses, file_infos, format_embedding_lines(batch, matrix)):
+                    line = line.encode()
+                    output_file.write(line)
+                    if delta_file is not None:
+                        delta_file.write(line)
+                    offset += len(line)
+                    records.append(dict({"id": img_name, "status": status, "offset": offset, "model": model_name}, **file_info))
 
+                # the embeddings reach the file before the manifest refers to them
+                output_file.flush()
+                for record in records:
+                    manifest_file.write(json.dumps(record) + '\n')
+                manifest_file.flush()
 
-    create_embeddings_jsonl(list_of_dict, output_embedding_name)
+            processed = success + not_succuess
+            elapsed = time.perf_counter() - start_time
+            print(f"Embedded {processed}/{len(img_names)} images ({processed / elapsed:.1f} images/s)")
+
+    return success, not_succuess, offset
+
+
+
+def export_npy_dir(embeddings_path, npy_dir, kept_bytes, written):
+    """
+    Exports the output file as memory-mappable .npy shards (the binary gallery format of server/local_index.py).
+
+    The embeddings of this run are taken as they were written (written: (ids, float32 matrix) per batch, see
+    embed_into), not parsed back from the output file. Only its first kept_bytes, the lines kept from a previous
+    run (--resume, --incremental), are read from it.
+    """
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server"))
+    from local_index import parse_embedding_lines, save_npy_dir
+
+    with open(embeddings_path, 'rb') as f:
+        ids, rows = parse_embedding_lines(f.read(kept_bytes).decode().splitlines())
+
+    matrices = [np.stack(rows)] if rows else []
+    for batch_ids, matrix in written:
+        ids += batch_ids
+        matrices.append(matrix)
+
+    if not matrices:
+        raise ValueError(f"No embeddings to export to {npy_dir}")
+
+    meta = save_npy_dir(ids, np.concatenate(matrices), npy_dir)
+    print(f"Exported {meta['count']} embeddings in {len(meta['shards'])} .npy shards to {npy_dir}")
+
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Embed the images of a dataset folder into a Vertex AI Vector Search .jsonl file.")
+    parser.add_argument("dataset_path", help="the folder holding the images")
+    parser.add_argument("output_embedding_name", help="the output embedding file name. it should be .json")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="number of worker processes")
+    parser.add_argument("--batch-size", type=int, default=16, help="number of images embedded per model call")
+    parser.add_argument("--model", default="VGG-Face", help="the DeepFace model name")
+    parser.add_argument("--resume", action="store_true", help="continue a previous run instead of starting over")
+    parser.add_argument("--incremental", action="store_true", help="only embed the images added or modified since the previous run")
+    parser.add_argument("--manifest", default=None, help="the manifest path (default: <output>.manifest.jsonl)")
+    parser.add_argument("--npy-dir", default=None, help="also export the gallery as memory-mappable .npy shards to this directory")
+    parser.add_argument("--delta-dir", default=None, help="where --incremental writes the changes (default: a 'delta' folder next to the output folder)")
+    args = parser.parse_args()
+
+    output_embedding_name = args.output_embedding_name
+    manifest_path = args.manifest or get_manifest_path(output_embedding_name)
+
+    img_names = sorted(img_name for img_name in os.listdir(args.dataset_path) if img_name.endswith(IMAGE_EXTENSIONS))
+
+    start_time = time.perf_counter()
+
+    # with --npy-dir the embeddings of this run are kept as they are written (see export_npy_dir)
+    written = [] if args.npy_dir else None
+
+    if args.incremental and os.path.exists(manifest_path):
+        records, _ = read_manifest(manifest_path)
+        unchanged, img_names, deleted = plan_incremental_update(args.dataset_path, img_names, records, args.model)
+        print(f"Incremental update: {len(unchanged)} images unchanged, {len(img_names)} new or modified, {len(deleted)} deleted.")
+
+        delta_dir = args.delta_dir or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(output_embedding_name))), "delta")
+
+        # the updated output and manifest are written next to the current ones and only replace them once complete
+        with open(output_embedding_name + ".tmp", 'wb') as output_file, open(manifest_path + ".tmp", 'w') as manifest_file, \
+             write_delta(delta_dir, deleted) as delta_file:
+
+            kept_bytes = copy_unchanged_lines(output_embedding_name, records, unchanged, output_file, manifest_file)
+            success, not_succuess, offset = embed_into(args.dataset_path, img_names, output_file, manifest_file, kept_bytes,
+                                                       args.model, args.workers, args.batch_size, delta_file = delta_file,
+                                                       written = written)
+
+        os.replace(output_embedding_name + ".tmp", output_embedding_name)
+        os.replace(manifest_path + ".tmp", manifest_path)
+        print(f"Wrote the changes to {delta_dir}")
+
+    else:
+        if args.resume:
+            done, offset = load_manifest(manifest_path)
+            # drop whatever was written after the last image recorded in the manifest
+            with open(output_embedding_name, 'ab') as f:
+                f.truncate(offset)
+            img_names = [img_name for img_name in img_names if img_name not in done]
+            print(f"Resuming: {len(done)} images already embedded, {len(img_names)} left.")
+        else:
+            open(output_embedding_name, 'w').close()
+            open(manifest_path, 'w').close()
+
+        with open(output_embedding_name, 'ab') as output_file, open(manifest_path, 'a') as manifest_file:
+            kept_bytes = output_file.tell()
+            success, not_succuess, offset = embed_into(args.dataset_path, img_names, output_file, manifest_file, kept_bytes,
+                                                       args.model, args.workers, args.batch_size, written = written)
+
+
+    elapsed = time.perf_counter() - start_time
+
+    if args.npy_dir:
+        export_npy_dir(output_embedding_name, args.npy_dir, kept_bytes, written)
+
+    print(f"The number of images encoded into embedding: {success} \n The number of images NOT encoded into embedding: {not_succuess}")
+    if img_names:
+        print(f"Embedded {len(img_names)} images in {elapsed:.1f} s ({len(img_names) / elapsed:.1f} images/s) with {args.workers} workers.")
 
 
 
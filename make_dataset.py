@@ -4,6 +4,15 @@ import shutil
 import json
 import base64
 import sys
+import time
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError: # not a POSIX platform: no reflinks, "auto" copies
+    fcntl = None
 
 
 
@@ -25,34 +34,100 @@ def create_folder(folder_name):
 
 
 
+# the ways a sampled image can be materialised in the destination folder. "copy" (the default) copies every image.
+# "reflink" (a copy-on-write clone, e.g. on btrfs or XFS) and "link" (a hardlink) need the source and the destination
+# to be on the same filesystem, and take no extra space or copying; a hardlink is the source file itself, so editing
+# a gallery image edits the dataset too. "auto" tries reflink, then falls back to a copy; it never hardlinks.
+MODES = ("copy", "auto", "link", "reflink")
+
+FICLONE = 0x40049409 # the Linux ioctl that clones a file (reflink)
+
+
+
+def reflink(source_path, destination_path):
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+
+    with open(source_path, 'rb') as src, open(destination_path, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(destination_path)
+            raise
+
+    shutil.copystat(source_path, destination_path)
+
+
+def materialise(source_path, destination_path, mode):
+    # returns the method that was used ("reflink", "link" or "copy")
+
+    if os.path.lexists(destination_path):
+        os.remove(destination_path)
+
+    if mode in ("auto", "reflink"):
+        try:
+            reflink(source_path, destination_path)
+            return "reflink"
+        except OSError:
+            if mode == "reflink":
+                raise
+
+    if mode == "link":
+        os.link(source_path, destination_path)
+        return "link"
+
+    shutil.copy2(source_path, destination_path)
+    return "copy"
+
+
+
 # this code assuems that all images are stored under destination_dataset, where there is a sub-folder for every person
 
 def main():
 
-    destination_dataset = sys.argv[2]
+    parser = argparse.ArgumentParser(description="Sample the images of every identity of a dataset into a flat gallery folder.")
+    parser.add_argument("source_dataset", help="the dataset folder, with one sub-folder per identity")
+    parser.add_argument("destination_dataset", help="the gallery folder to create")
+    parser.add_argument("--num-samples", type=int, default=20, help="number of images sampled per identity")
+    parser.add_argument("--seed", type=int, default=0, help="random seed, the same seed and dataset give the same sample")
+    parser.add_argument("--mode", choices=MODES, default="copy",
+                        help="how the sampled images are materialised (link: hardlinks to the dataset files)")
+    parser.add_argument("--workers", type=int, default=16, help="number of threads materialising the images")
+    args = parser.parse_args()
+
+    destination_dataset = args.destination_dataset
 
-    source_dataset = sys.argv[1]
+    source_dataset = args.source_dataset
 
     create_folder(destination_dataset)
 
 
-    num_sample_per_folder = 20 # to sample from each identity
+    num_sample_per_folder = args.num_samples # to sample from each identity
+
+    rng = np.random.default_rng(args.seed)
 
 
-    folder_list  = os.listdir(source_dataset)
+    # sorted, so that the labels and the sample only depend on the seed and not on the directory order (the labels
+    # can differ from the ones of a gallery made before, which followed the os.listdir order)
+    folder_list  = sorted(f for f in os.listdir(source_dataset) if os.path.isdir(os.path.join(source_dataset, f)))
 
 
     folder_label_map = dict(zip(folder_list,[i for i in range(len(folder_list))]))
 
 
+    tasks = []
 
     for f in folder_list:
         
         cel_folder = os.path.join(source_dataset,f)
 
-        cel_content = os.listdir(cel_folder)
+        cel_content = sorted(os.listdir(cel_folder))
 
-        select_samples = np.random.choice(cel_content, num_sample_per_folder, replace=False).tolist()
+        if len(cel_content) < num_sample_per_folder:
+            print(f"Warning: '{f}' only has {len(cel_content)} images, all of them are used.")
+
+        select_samples = rng.choice(cel_content, min(num_sample_per_folder, len(cel_content)), replace=False).tolist()
 
         for final_f in select_samples:
             dist_img_name = f"{folder_label_map[f]}_{f}_{final_f}"
@@ -61,14 +136,31 @@ def main():
             
             destination_path = os.path.join(destination_dataset,dist_img_name)
             
-            shutil.copy2(source_path, destination_path)
+            tasks.append((f, source_path, dist_img_name, destination_path))
+
+
+    start_time = time.perf_counter()
 
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        methods = list(executor.map(lambda task: materialise(task[1], task[3], args.mode), tasks))
 
 
+    # the manifest lists every image of the gallery with its identity and source, in the same order as the sample
+    with open(os.path.join(destination_dataset, "manifest.jsonl"), 'w') as manifest_file:
+        for (f, source_path, dist_img_name, destination_path), method in zip(tasks, methods):
+            manifest_file.write(json.dumps({"id": dist_img_name, "label": folder_label_map[f], "identity": f,
+                                            "source": source_path, "size": os.path.getsize(destination_path),
+                                            "method": method}) + '\n')
+
     with open( os.path.join(destination_dataset, "label_map.json"), 'w') as f:
           json.dump(folder_label_map, f, indent=4)
 
 
+    counts = Counter(methods)
+    print(f"Materialised {len(tasks)} images of {len(folder_list)} identities in {time.perf_counter() - start_time:.2f} s "
+          f"({', '.join(f'{count} by {method}' for method, count in counts.items())})")
+
+
 
 
 if __name__ == "__main__":
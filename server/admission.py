@@ -0,0 +1,193 @@
+import math
+import time
+import asyncio
+import contextvars
+from contextlib import asynccontextmanager, contextmanager
+from fastapi import HTTPException
+from metrics import ADMISSION_WAIT_SECONDS, ADMISSION_SERVICE_SECONDS, ADMISSION_SHED
+
+
+
+# Admission control of the request pipeline. Every stage (decode, embed, search, fetch) has a StageLimiter that lets
+# at most max_concurrency requests run it and at most max_queue requests wait for it. A request is shed, instead of
+# queued, when
+#   the queue of the stage is full                                   -> 429 Too Many Requests
+#   it could not start the stage before its deadline (estimated
+#   from the queue length and the recent service time, or reached
+#   while waiting)                                                   -> 503 Service Unavailable
+# Both carry a Retry-After header. The deadline of a request is set once per request (set_deadline) and read by
+# every stage it goes through. BodySizeLimit rejects oversized request bodies before they are read.
+
+SERVICE_TIME_SMOOTHING = 0.2 # weight of the newest observation in the moving average of the service time
+
+_DEADLINE = contextvars.ContextVar("request_deadline", default=None)
+
+
+
+class Overloaded(HTTPException):
+    # raised by the limiters; FastAPI turns it into a 429/503 response with a Retry-After header
+
+    def __init__(self, status_code, detail, retry_after):
+        super().__init__(status_code=status_code, detail=detail, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+
+@contextmanager
+def set_deadline(timeout):
+    # the requests handled in this context must be done within timeout seconds (None: no deadline)
+
+    token = _DEADLINE.set(time.monotonic() + timeout if timeout is not None else None)
+    try:
+        yield
+    finally:
+        _DEADLINE.reset(token)
+
+
+def current_deadline():
+    # the monotonic deadline of the current request, or None
+    return _DEADLINE.get()
+
+
+
+class StageLimiter:
+    """
+    Bounds the concurrency of one stage of the pipeline, with a bounded queue and deadline-aware shedding.
+
+    name (str): the stage, used as the metrics label
+    max_concurrency (int): requests running the stage at once (0: unbounded, the limiter only measures)
+    max_queue (int): requests waiting for a slot at once, beyond which requests are shed with a 429
+
+    async with limiter.slot(): ... runs the block once a slot is free. The time spent waiting and the time spent
+    holding the slot are reported separately (face_search_admission_wait_seconds / _service_seconds).
+    """
+
+    def __init__(self, name, max_concurrency, max_queue):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+
+        self._semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency > 0 else None
+        self._waiting = 0
+        self._in_service = 0
+        self._service_time = 0.0 # moving average, in seconds
+        self._shed = {"queue_full": 0, "deadline": 0}
+
+
+    def expected_wait(self):
+        # seconds a request arriving now would wait for a slot, from the queue ahead of it and the recent service time
+
+        if self._semaphore is None or (self._in_service < self.max_concurrency and self._waiting == 0):
+            return 0.0
+
+        return (self._waiting + 1) / self.max_concurrency * self._service_time
+
+
+    def _shed_request(self, status_code, reason, detail):
+        self._shed[reason] += 1
+        ADMISSION_SHED.labels(self.name, reason).inc()
+        raise Overloaded(status_code, detail, retry_after = self.expected_wait() or self._service_time)
+
+
+    def check(self):
+        # raises Overloaded if a request arriving now would be shed; used to reject uploads before they are read
+
+        if self._semaphore is None:
+            return
+
+        if self._waiting >= self.max_queue and self._in_service >= self.max_concurrency:
+            self._shed_request(429, "queue_full", f"The server is busy ({self.name} queue full), retry later.")
+
+        deadline = current_deadline()
+        if deadline is not None and time.monotonic() + self.expected_wait() > deadline:
+            self._shed_request(503, "deadline", f"The server can not {self.name} the request before its deadline, retry later.")
+
+
+    @asynccontextmanager
+    async def slot(self):
+        wait_start = time.perf_counter()
+
+        if self._semaphore is not None:
+            self.check()
+
+            deadline = current_deadline()
+            self._waiting += 1
+            try:
+                if deadline is None:
+                    await self._semaphore.acquire()
+                else:
+                    await asyncio.wait_for(self._semaphore.acquire(), max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                self._shed_request(503, "deadline", f"The request reached its deadline waiting to {self.name}, retry later.")
+            finally:
+                self._waiting -= 1
+
+        service_start = time.perf_counter()
+        ADMISSION_WAIT_SECONDS.labels(self.name).observe(service_start - wait_start)
+        self._in_service += 1
+        try:
+            yield
+        finally:
+            self._in_service -= 1
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+            service_time = time.perf_counter() - service_start
+            ADMISSION_SERVICE_SECONDS.labels(self.name).observe(service_time)
+            self._service_time += SERVICE_TIME_SMOOTHING * (service_time - self._service_time)
+
+
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "waiting": self._waiting,
+            "in_service": self._in_service,
+            "service_time_ms": round(self._service_time * 1000, 3),
+            "shed": dict(self._shed),
+        }
+
+
+
+class BodySizeLimit:
+    """
+    ASGI middleware rejecting request bodies larger than max_bytes with a 413, before the application reads them:
+    a larger Content-Length is refused without reading anything, and a body without one (chunked) is cut off as
+    soon as max_bytes have been received.
+
+    paths (tuple): the paths the limit applies to (None: every request)
+    """
+
+    def __init__(self, app, max_bytes, paths = None):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.paths = paths
+
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.max_bytes or (self.paths and scope["path"] not in self.paths):
+            return await self.app(scope, receive, send)
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            return await self.reject(send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=413, detail=f"The request body is larger than {self.max_bytes} bytes.")
+            return message
+
+        return await self.app(scope, limited_receive, send)
+
+
+    async def reject(self, send):
+        body = f'{{"detail":"The request body is larger than {self.max_bytes} bytes."}}'.encode()
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                                (b"connection", b"close")]})
+        await send({"type": "http.response.body", "body": body})
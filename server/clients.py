@@ -0,0 +1,82 @@
+import threading
+import requests
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import aiplatform
+from google.cloud import storage
+
+
+
+HTTP_POOL_SIZE = 32 # max number of keep-alive connections kept open to GCS
+
+
+
+class ClientRegistry:
+    """
+    Application-lifetime Google Cloud clients shared by every request.
+
+    Each client is created once, on first use (or at startup, by utils.start_clients), instead of once per call,
+    so requests no longer pay for authentication, endpoint discovery and TLS handshakes.
+    The GCS client uses a pooled, keep-alive HTTP session sized for concurrent downloads.
+    """
+
+    def __init__(self, project_id, region, pool_size = HTTP_POOL_SIZE):
+        self.project_id = project_id or None
+        self.region = region or None
+        self.pool_size = pool_size
+
+        self._lock = threading.Lock()
+        self._http_session = None
+        self._storage_client = None
+        self._aiplatform_initialized = False
+        self._index_endpoints = {}
+
+
+    def storage_client(self):
+        with self._lock:
+            if self._storage_client is None:
+                credentials, default_project = google.auth.default(scopes=storage.Client.SCOPE)
+
+                session = AuthorizedSession(credentials)
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+
+                self._storage_client = storage.Client(project=self.project_id or default_project,
+                                                      credentials=credentials, _http=session)
+                self._http_session = session
+
+            return self._storage_client
+
+
+    def index_endpoint(self, index_endpoint_name):
+        with self._lock:
+            if not self._aiplatform_initialized:
+                aiplatform.init(project=self.project_id, location=self.region)
+                self._aiplatform_initialized = True
+
+            if index_endpoint_name not in self._index_endpoints:
+                self._index_endpoints[index_endpoint_name] = aiplatform.MatchingEngineIndexEndpoint(index_endpoint_name=index_endpoint_name)
+
+            return self._index_endpoints[index_endpoint_name]
+
+
+    def refresh_index_endpoint(self, index_endpoint_name):
+        # re-reads the index endpoint from the API (its deployed indexes and their sync times), replacing the cached one
+        endpoint = aiplatform.MatchingEngineIndexEndpoint(index_endpoint_name=index_endpoint_name)
+
+        with self._lock:
+            self._index_endpoints[index_endpoint_name] = endpoint
+
+        return endpoint
+
+
+    def close(self):
+        # release the pooled connections; the registry can still be used afterwards, clients are then re-created
+        with self._lock:
+            if self._http_session is not None:
+                self._http_session.close()
+
+            self._http_session = None
+            self._storage_client = None
+            self._index_endpoints = {}
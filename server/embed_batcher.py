@@ -0,0 +1,137 @@
+import asyncio
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+
+class EmbeddingBatcher:
+    """
+    Collects the images of concurrent requests and embeds them together.
+
+    Images are queued by embed(); a background task takes the first waiting image, keeps collecting for up to
+    max_wait_ms (or until max_batch_size images are waiting), and runs represent_batch on the whole batch in a
+    dedicated thread. Each request's future is then resolved with its own embedding (or exception).
+
+    represent_batch (callable): takes a list of images and returns a list of the same length holding either
+                                the embedding or the exception raised for that image.
+    max_queue (int): images waiting for a batch at most; embed() raises asyncio.QueueFull beyond it (0: unbounded)
+    """
+
+    def __init__(self, represent_batch, max_batch_size = 8, max_wait_ms = 5, max_queue = 0):
+        self.represent_batch = represent_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_queue = max_queue
+
+        self._queue = None
+        self._task = None
+        self._executor = None
+
+        self._lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._num_images = 0
+        self._num_failures = 0
+
+
+    async def start(self):
+        if self._executor is None:
+            # the model runs one batch at a time, on a thread of its own so it never blocks the event loop
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._task = asyncio.create_task(self._run())
+
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+    async def run(self, func, *args):
+        # run func on the model thread, e.g. to load or warm up the model without racing a batch
+        await self.start()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+
+    async def embed(self, image):
+        # queue one image and wait for its embedding (raises asyncio.QueueFull if max_queue images are already waiting)
+
+        if self._task is None:
+            await self.start()
+
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((image, future))
+
+        return await future
+
+
+    async def _collect_batch(self):
+        loop = asyncio.get_running_loop()
+
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = await self._collect_batch()
+            batch = [(image, future) for image, future in batch if not future.cancelled()] # the client went away
+            if not batch:
+                continue
+
+            with self._lock:
+                self._batch_sizes[len(batch)] += 1
+                self._num_images += len(batch)
+
+            try:
+                results = await loop.run_in_executor(self._executor, self.represent_batch, [image for image, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+
+            for (_, future), result in zip(batch, results):
+                if future.cancelled():
+                    continue
+                if isinstance(result, Exception):
+                    with self._lock:
+                        self._num_failures += 1
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+    def stats(self):
+        with self._lock:
+            num_batches = sum(self._batch_sizes.values())
+            return {
+                "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+                "batches": num_batches,
+                "images": self._num_images,
+                "failures": self._num_failures,
+                "average_batch_size": round(self._num_images / num_batches, 3) if num_batches else 0.0,
+                "max_batch_size": max(self._batch_sizes) if self._batch_sizes else 0,
+                "batch_size_counts": {str(size): count for size, count in sorted(self._batch_sizes.items())},
+            }
@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+from local_index import load_embeddings, normalize_rows, kmeans, LocalExactIndex
+
+
+
+# this is an identity-level index: every identity of the gallery is summarized by a few prototype vectors (the
+# k-means centroids of its embeddings, or their mean with one prototype). A query is first scored against the
+# prototypes only, and the images of the top_identities best identities are then re-ranked exactly. The cost of a
+# query is O(identities) plus the images of a handful of identities, instead of O(images).
+#
+# The identity of every image is resolved once, at build time, from the label_map.json written by make_dataset.py
+# (image names start with "{label}_"), so the server does not parse file names per request.
+#
+# On-disk layout of an index directory:
+#   meta.json               dim, count, number of identities and prototypes, build time and size
+#   prototypes.npy          (num_prototypes, dim) float32, L2-normalized, grouped by identity
+#   prototype_offsets.npy   (num_identities + 1,) int64, identity i owns the prototypes prototype_offsets[i]:[i+1]
+#   vectors.npy             (count, dim) float32, L2-normalized, rows grouped by identity
+#   offsets.npy             (num_identities + 1,) int64, identity i owns the rows offsets[i]:offsets[i+1]
+#   identities.json         the identity names, by identity code
+#   ids.json                the image ids, in the same order as vectors.npy
+
+DEFAULT_PROTOTYPES = 1
+DEFAULT_TOP_IDENTITIES = 4
+
+
+
+def resolve_identities(ids, label_map = None):
+    """
+    Returns the identity name of every image id.
+
+    label_map (dict): identity name -> label, as written by make_dataset.py; the label is the prefix of the image
+                      names ("{label}_{identity}_{file}"), so identity names may contain underscores. Without it,
+                      the identity is read from the image name like the server does (the second "_" field).
+    """
+    if label_map is None:
+        return [image_id.split("_")[1] for image_id in ids]
+
+    names_of_labels = {str(label): name for name, label in label_map.items()}
+
+    identities = []
+    for image_id in ids:
+        label = image_id.split("_", 1)[0]
+        if label not in names_of_labels:
+            raise ValueError(f"The image {image_id} has label {label}, which is not in the label map")
+        identities.append(names_of_labels[label])
+
+    return identities
+
+
+def build_identity_index(ids, matrix, output_dir, label_map = None, num_prototypes = DEFAULT_PROTOTYPES, num_iterations = 10):
+    """
+    Groups the gallery by identity, computes the prototypes of every identity and saves the index under output_dir.
+
+    ids (List[str]): the image ids, one per row of matrix.
+    matrix (np.ndarray): (N, dim) embeddings.
+    label_map (dict): identity name -> label (see resolve_identities).
+    num_prototypes (int): prototypes per identity (at most the number of its images).
+
+    Returns the meta dictionary (also written to meta.json).
+    """
+    start_time = time.perf_counter()
+
+    matrix = normalize_rows(np.array(matrix, dtype=np.float32))
+
+    identity_of_rows = resolve_identities(ids, label_map)
+    names = sorted(set(identity_of_rows))
+    code_of_names = {name: code for code, name in enumerate(names)}
+    codes = np.asarray([code_of_names[name] for name in identity_of_rows], dtype=np.int64)
+
+    order = np.argsort(codes, kind="stable")
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(codes, minlength=len(names)))
+    vectors = matrix[order]
+
+    prototypes = []
+    prototype_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    for code in range(len(names)):
+        rows = vectors[offsets[code]:offsets[code + 1]]
+        if num_prototypes <= 1 or rows.shape[0] <= 1:
+            centroids = normalize_rows(rows.mean(axis=0, keepdims=True))
+        else:
+            centroids = kmeans(rows, num_prototypes, num_iterations = num_iterations, seed = code)
+        prototypes.append(centroids)
+        prototype_offsets[code + 1] = prototype_offsets[code] + centroids.shape[0]
+
+    prototypes = np.concatenate(prototypes).astype(np.float32)
+
+    os.makedirs(output_dir, exist_ok=True)
+    np.save(os.path.join(output_dir, "prototypes.npy"), prototypes)
+    np.save(os.path.join(output_dir, "prototype_offsets.npy"), prototype_offsets)
+    np.save(os.path.join(output_dir, "vectors.npy"), vectors)
+    np.save(os.path.join(output_dir, "offsets.npy"), offsets)
+    with open(os.path.join(output_dir, "identities.json"), 'w') as f:
+        json.dump(names, f)
+    with open(os.path.join(output_dir, "ids.json"), 'w') as f:
+        json.dump([ids[i] for i in order], f)
+
+    build_seconds = time.perf_counter() - start_time
+    size_bytes = sum(os.path.getsize(os.path.join(output_dir, name)) for name in os.listdir(output_dir) if name != "meta.json")
+
+    meta = {
+        "type": "identity",
+        "dim": int(matrix.shape[1]),
+        "count": int(matrix.shape[0]),
+        "num_identities": len(names),
+        "num_prototypes": int(prototypes.shape[0]),
+        "build_seconds": round(build_seconds, 3),
+        "size_bytes": int(size_bytes),
+    }
+    with open(os.path.join(output_dir, "meta.json"), 'w') as f:
+        json.dump(meta, f, indent=4)
+
+    return meta
+
+
+
+class IdentityIndex:
+    """
+    Two-stage search over an index directory written by build_identity_index: the prototypes select the
+    top_identities most similar identities, and only their images are scored exactly.
+
+    The image embeddings are memory-mapped, so only the pages of the selected identities are read from disk.
+    Scores are dot products, like the ones returned by LocalExactIndex and Vertex AI. identity_of() gives the
+    identity of an image id without parsing its name.
+    """
+
+    def __init__(self, index_dir, top_identities = DEFAULT_TOP_IDENTITIES):
+        with open(os.path.join(index_dir, "meta.json"), 'r') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(index_dir, "ids.json"), 'r') as f:
+            self.ids = json.load(f)
+        with open(os.path.join(index_dir, "identities.json"), 'r') as f:
+            self.identities = json.load(f)
+
+        self.prototypes = np.load(os.path.join(index_dir, "prototypes.npy"))
+        self.prototype_offsets = np.load(os.path.join(index_dir, "prototype_offsets.npy"))
+        self.offsets = np.load(os.path.join(index_dir, "offsets.npy"))
+        self.vectors = np.load(os.path.join(index_dir, "vectors.npy"), mmap_mode='r')
+
+        self.dim = self.meta["dim"]
+        self.top_identities = top_identities
+
+        counts = np.diff(self.offsets)
+        self._identity_by_id = dict(zip(self.ids, np.repeat(self.identities, counts).tolist()))
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def identity_of(self, image_id):
+        return self._identity_by_id[image_id]
+
+
+    def identity_scores(self, queries):
+        # (num_queries, num_identities): the score of every identity is the one of its most similar prototype
+        return np.maximum.reduceat(queries @ self.prototypes.T, self.prototype_offsets[:-1], axis=1)
+
+
+    def rerank(self, query, identity_codes, num_neighbors):
+        # exact search over the images of the given identities
+
+        rows = []
+        scores = []
+        for code in identity_codes:
+            start, end = int(self.offsets[code]), int(self.offsets[code + 1])
+            rows.append(np.arange(start, end))
+            scores.append(self.vectors[start:end] @ query)
+
+        rows = np.concatenate(rows)
+        scores = np.concatenate(scores)
+
+        k = min(num_neighbors, scores.shape[0])
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        return [(self.ids[rows[i]], float(scores[i])) for i in top]
+
+
+    def search(self, query_vector, num_neighbors, top_identities = None):
+        # top_identities: number of identities whose images are re-ranked; more gives better recall at a higher latency
+        return self.search_batch(np.asarray(query_vector, dtype=np.float32).reshape(1, -1), num_neighbors,
+                                 top_identities = top_identities)[0]
+
+
+    def search_batch(self, query_vectors, num_neighbors, top_identities = None):
+        # one (num_queries, num_prototypes) product selects the identities of every query; one list of (id, dot product) tuples per query
+
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        if queries.ndim != 2 or queries.shape[1] != self.dim:
+            raise ValueError(f"Queries have shape {queries.shape}, expected (num_queries, {self.dim})")
+
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+        top = self.top_identities if top_identities is None else top_identities
+        if top < 1:
+            raise ValueError(f"top_identities must be at least 1, got {top}")
+
+        identity_scores = self.identity_scores(queries)
+        top = min(top, identity_scores.shape[1])
+        selected = np.argpartition(-identity_scores, top - 1, axis=1)[:, :top]
+
+        return [self.rerank(query, np.sort(codes), num_neighbors) for query, codes in zip(queries, selected)]
+
+
+
+def evaluate_recall(index, exact_index, queries, num_neighbors = 5):
+    # the fraction of the exact num_neighbors nearest neighbors the two-stage search also returns
+
+    found = 0
+    for query in queries:
+        exact = {neighbor_id for neighbor_id, _ in exact_index.search(query, num_neighbors)}
+        found += len(exact & {neighbor_id for neighbor_id, _ in index.search(query, num_neighbors)})
+
+    return found / (len(queries) * num_neighbors)
+
+
+
+# builds an index offline from the output of create_embeddings.py and the label map of make_dataset.py, e.g.
+#   python identity_index.py embeddings/embeddings.json identity_index/ --label-map dataset/label_map.json --prototypes 3
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Build an identity (prototype) index from an embeddings file and the label map of the dataset.")
+    parser.add_argument("embeddings_path", help="the embeddings file written by create_embeddings.py, or a .npy directory written by local_index.py")
+    parser.add_argument("output_dir", help="the directory to write the index to")
+    parser.add_argument("--label-map", default=None, help="the label_map.json written by make_dataset.py (default: identities are read from the image names)")
+    parser.add_argument("--prototypes", type=int, default=DEFAULT_PROTOTYPES, help="number of prototypes per identity")
+    parser.add_argument("--iterations", type=int, default=10, help="number of k-means iterations (with several prototypes)")
+    parser.add_argument("--top-identities", type=int, default=DEFAULT_TOP_IDENTITIES, help="identities re-ranked per query, for the recall check")
+    parser.add_argument("--num-queries", type=int, default=200, help="number of gallery embeddings used to measure the recall")
+    args = parser.parse_args()
+
+    ids, matrix = load_embeddings(args.embeddings_path)
+    print(f"Loaded {len(ids)} embeddings of dimension {matrix.shape[1]}.")
+
+    label_map = None
+    if args.label_map:
+        with open(args.label_map, 'r') as f:
+            label_map = json.load(f)
+
+    meta = build_identity_index(ids, matrix, args.output_dir, label_map = label_map,
+                                num_prototypes = args.prototypes, num_iterations = args.iterations)
+
+    print(f"Built an index of {meta['num_identities']} identities ({meta['num_prototypes']} prototypes) in {meta['build_seconds']} s.")
+    print(f"Index size on disk: {meta['size_bytes'] / 2**20:.2f} MB ({args.output_dir})")
+
+    index = IdentityIndex(args.output_dir, top_identities = args.top_identities)
+    exact_index = LocalExactIndex(ids, matrix)
+    rng = np.random.default_rng(0)
+    queries = np.asarray(matrix)[rng.choice(len(ids), min(args.num_queries, len(ids)), replace=False)]
+    print(f"Recall@5 against exact search (top {args.top_identities} identities): {evaluate_recall(index, exact_index, queries):.3f}")
+
+
+
+if __name__ == "__main__":
+    main()
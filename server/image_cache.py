@@ -0,0 +1,202 @@
+import os
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class ImageCache:
+    """
+    Size-bounded LRU cache of base64-encoded gallery images, keyed by blob name.
+
+    Entries live in memory up to max_bytes; the least recently used ones are spilled to disk_dir (if given),
+    which is itself bounded by max_disk_bytes. A hit in either tier skips both the GCS download and the encoding.
+    The whole cache is tied to a namespace (the bucket and dataset prefix), and is emptied when it changes.
+    """
+
+    NAMESPACE_FILE = "NAMESPACE"
+
+    def __init__(self, max_bytes, disk_dir = None, max_disk_bytes = 0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir or None
+        self.max_disk_bytes = max_disk_bytes if self.disk_dir else 0
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict() # key -> base64 str, least recently used first
+        self._memory_bytes = 0
+        self._disk = OrderedDict() # key -> file size, least recently used first
+        self._disk_bytes = 0
+        self.namespace = None
+
+        self.counters = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "disk_evictions": 0, "invalidations": 0}
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._load_disk_tier()
+
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+    def _load_disk_tier(self):
+        # files kept from a previous run are reused only if they belong to the same namespace (see ensure_namespace);
+        # their keys are not stored, so they are tracked by file name, in the order they were last used (their mtime).
+        # Temporary files left by an interrupted write are deleted.
+        namespace_path = os.path.join(self.disk_dir, self.NAMESPACE_FILE)
+        if os.path.exists(namespace_path):
+            with open(namespace_path, 'r') as f:
+                self.namespace = f.read()
+
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if name == self.NAMESPACE_FILE:
+                continue
+            path = os.path.join(self.disk_dir, name)
+            if name.endswith(".tmp"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            entries.append((os.path.getmtime(path), name, os.path.getsize(path)))
+
+        for _, name, size in sorted(entries):
+            self._disk[name] = size
+            self._disk_bytes += size
+
+
+    def ensure_namespace(self, namespace):
+        # empty the cache if the dataset it was filled from is no longer the one being served
+
+        with self._lock:
+            if namespace == self.namespace:
+                return
+
+            if self.namespace is not None:
+                self.counters["invalidations"] += 1
+                logger.info(f"Image cache invalidated: dataset changed from '{self.namespace}' to '{namespace}'.")
+
+            self._clear()
+            self.namespace = namespace
+
+            if self.disk_dir:
+                with open(os.path.join(self.disk_dir, self.NAMESPACE_FILE), 'w') as f:
+                    f.write(namespace)
+
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+
+    def _clear(self):
+        self._memory.clear()
+        self._memory_bytes = 0
+
+        for name in self._disk:
+            try:
+                os.remove(os.path.join(self.disk_dir, name))
+            except OSError:
+                pass
+        self._disk.clear()
+        self._disk_bytes = 0
+
+
+    def get(self, key):
+        # returns the cached base64 string, or None on a miss
+
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.counters["hits"] += 1
+                return value
+
+            name = os.path.basename(self._disk_path(key)) if self.disk_dir else None
+            if name is None or name not in self._disk:
+                self.counters["misses"] += 1
+                return None
+            self._disk.move_to_end(name)
+
+        try:
+            path = os.path.join(self.disk_dir, name)
+            with open(path, 'r') as f:
+                value = f.read()
+            os.utime(path) # so that the order of use survives a restart (see _load_disk_tier)
+        except OSError:
+            with self._lock:
+                self.counters["misses"] += 1
+            return None
+
+        with self._lock:
+            self.counters["disk_hits"] += 1
+        self.put(key, value) # promote it back to memory
+
+        return value
+
+
+    def put(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+
+        spilled = []
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= len(self._memory.pop(key))
+
+            self._memory[key] = value
+            self._memory_bytes += size
+
+            while self._memory_bytes > self.max_bytes:
+                old_key, old_value = self._memory.popitem(last=False)
+                self._memory_bytes -= len(old_value)
+                self.counters["evictions"] += 1
+                if self.disk_dir:
+                    spilled.append((old_key, old_value))
+
+        for old_key, old_value in spilled:
+            self._write_to_disk(old_key, old_value)
+
+
+    def _write_to_disk(self, key, value):
+        size = len(value)
+        if size > self.max_disk_bytes:
+            return
+
+        path = self._disk_path(key)
+        name = os.path.basename(path)
+        try:
+            with open(path + ".tmp", 'w') as f:
+                f.write(value)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logger.warning(f"Could not write image cache entry to {path}: {e}")
+            return
+
+        with self._lock:
+            if name in self._disk:
+                self._disk_bytes -= self._disk.pop(name)
+            self._disk[name] = size
+            self._disk_bytes += size
+
+            while self._disk_bytes > self.max_disk_bytes:
+                old_name, old_size = self._disk.popitem(last=False)
+                self._disk_bytes -= old_size
+                self.counters["disk_evictions"] += 1
+                try:
+                    os.remove(os.path.join(self.disk_dir, old_name))
+                except OSError:
+                    pass
+
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters,
+                        entries=len(self._memory), bytes=self._memory_bytes,
+                        disk_entries=len(self._disk), disk_bytes=self._disk_bytes)
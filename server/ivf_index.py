@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+from local_index import load_embeddings, normalize_rows, kmeans, assign_to_centroids
+
+
+
+# this is an inverted file (IVF) index: the gallery is clustered with k-means, and every embedding is stored in the
+# list of its closest centroid. A query only scans the nprobe lists whose centroids are the most similar to it.
+#
+# On-disk layout of an index directory:
+#   meta.json       dim, count, nlist, build time and size
+#   centroids.npy   (nlist, dim) float32, L2-normalized
+#   vectors.npy     (count, dim) float32, L2-normalized, rows grouped by list
+#   offsets.npy     (nlist + 1,) int64, list i holds the rows offsets[i]:offsets[i+1]
+#   ids.json        the image ids, in the same order as vectors.npy
+
+DEFAULT_NPROBE = 8
+
+
+
+def build_ivf_index(ids, matrix, output_dir, nlist = None, num_iterations = 10):
+    """
+    Clusters the gallery into inverted lists and saves the index under output_dir.
+
+    ids (List[str]): the image ids, one per row of matrix.
+    matrix (np.ndarray): (N, dim) embeddings.
+    nlist (int): the number of inverted lists; defaults to 4 * sqrt(N).
+
+    Returns the meta dictionary (also written to meta.json).
+    """
+    start_time = time.perf_counter()
+
+    matrix = normalize_rows(np.array(matrix, dtype=np.float32))
+
+    if nlist is None:
+        nlist = max(1, int(4 * np.sqrt(matrix.shape[0])))
+
+    centroids = kmeans(matrix, nlist, num_iterations = num_iterations)
+    nlist = centroids.shape[0]
+
+    assignment = assign_to_centroids(matrix, centroids)
+    order = np.argsort(assignment, kind="stable")
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assignment, minlength=nlist))
+
+    os.makedirs(output_dir, exist_ok=True)
+    np.save(os.path.join(output_dir, "centroids.npy"), centroids)
+    np.save(os.path.join(output_dir, "vectors.npy"), matrix[order])
+    np.save(os.path.join(output_dir, "offsets.npy"), offsets)
+    with open(os.path.join(output_dir, "ids.json"), 'w') as f:
+        json.dump([ids[i] for i in order], f)
+
+    build_seconds = time.perf_counter() - start_time
+    size_bytes = sum(os.path.getsize(os.path.join(output_dir, name)) for name in os.listdir(output_dir) if name != "meta.json")
+
+    meta = {
+        "type": "ivf",
+        "dim": int(matrix.shape[1]),
+        "count": int(matrix.shape[0]),
+        "nlist": int(nlist),
+        "build_seconds": round(build_seconds, 3),
+        "size_bytes": int(size_bytes),
+    }
+    with open(os.path.join(output_dir, "meta.json"), 'w') as f:
+        json.dump(meta, f, indent=4)
+
+    return meta
+
+
+
+class IVFIndex:
+    """
+    Approximate nearest neighbor search over an index directory written by build_ivf_index.
+
+    The embeddings are memory-mapped, so only the pages of the probed lists are read from disk.
+    Scores are dot products, like the ones returned by LocalExactIndex and Vertex AI.
+    """
+
+    def __init__(self, index_dir, nprobe = DEFAULT_NPROBE):
+        with open(os.path.join(index_dir, "meta.json"), 'r') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(index_dir, "ids.json"), 'r') as f:
+            self.ids = json.load(f)
+
+        self.centroids = np.load(os.path.join(index_dir, "centroids.npy"))
+        self.offsets = np.load(os.path.join(index_dir, "offsets.npy"))
+        self.vectors = np.load(os.path.join(index_dir, "vectors.npy"), mmap_mode='r')
+
+        self.dim = self.meta["dim"]
+        self.nprobe = nprobe
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def search(self, query_vector, num_neighbors, nprobe = None):
+        # nprobe: number of inverted lists to scan; larger values give better recall at a higher latency
+
+        nprobe = self.nprobe if nprobe is None else nprobe
+        if nprobe < 1:
+            raise ValueError(f"nprobe must be at least 1, got {nprobe}")
+        nprobe = min(nprobe, self.centroids.shape[0])
+
+        query = np.asarray(query_vector, dtype=np.float32).reshape(-1)
+        if query.shape[0] != self.dim:
+            raise ValueError(f"Query has dimension {query.shape[0]}, the index has dimension {self.dim}")
+
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        centroid_scores = self.centroids @ query
+        probed = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+
+        rows = []
+        scores = []
+        for list_id in probed:
+            start, end = int(self.offsets[list_id]), int(self.offsets[list_id + 1])
+            if start == end:
+                continue
+            rows.append(np.arange(start, end))
+            scores.append(self.vectors[start:end] @ query)
+
+        if not scores:
+            return []
+
+        rows = np.concatenate(rows)
+        scores = np.concatenate(scores)
+
+        k = min(num_neighbors, scores.shape[0])
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        return [(self.ids[rows[i]], float(scores[i])) for i in top]
+
+
+    def search_batch(self, query_vectors, num_neighbors, nprobe = None):
+        # one list of (id, dot product) tuples per query
+        return [self.search(query_vector, num_neighbors, nprobe = nprobe) for query_vector in query_vectors]
+
+
+
+# builds an index offline from the output of create_embeddings.py, e.g.
+#   python ivf_index.py embeddings/embeddings.json ivf_index/ --nlist 1024
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Build an IVF index from an embeddings .jsonl file.")
+    parser.add_argument("embeddings_path", help="the embeddings file written by create_embeddings.py, or a .npy directory written by local_index.py")
+    parser.add_argument("output_dir", help="the directory to write the index to")
+    parser.add_argument("--nlist", type=int, default=None, help="number of inverted lists (default: 4 * sqrt(N))")
+    parser.add_argument("--iterations", type=int, default=10, help="number of k-means iterations")
+    args = parser.parse_args()
+
+    ids, matrix = load_embeddings(args.embeddings_path)
+    print(f"Loaded {len(ids)} embeddings of dimension {matrix.shape[1]}.")
+
+    meta = build_ivf_index(ids, matrix, args.output_dir, nlist = args.nlist, num_iterations = args.iterations)
+
+    print(f"Built an index with {meta['nlist']} lists in {meta['build_seconds']} s.")
+    print(f"Index size on disk: {meta['size_bytes'] / 2**20:.2f} MB ({args.output_dir})")
+
+
+
+if __name__ == "__main__":
+    main()
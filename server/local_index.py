@@ -0,0 +1,331 @@
+import os
+import json
+import argparse
+import numpy as np
+
+
+
+def normalize_rows(matrix):
+    # L2-normalize every row of a 2D array in place (all-zero rows are left as zeros)
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.maximum(norms, 1e-12, out=norms)
+    matrix /= norms
+
+    return matrix
+
+
+
+def parse_embedding_lines(lines):
+    # (ids, rows) of the JSON lines of an embeddings file: a list of str and a list of float32 vectors
+
+    ids = []
+    rows = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        item = json.loads(line)
+        ids.append(str(item['id']))
+        rows.append(np.asarray(item['embedding'], dtype=np.float32))
+
+    return ids, rows
+
+
+def load_embeddings_jsonl(path, storage_client = None):
+    """
+    Loads an embeddings file written by create_embeddings.py (one JSON object per line with 'id' and 'embedding').
+
+    path (str): a local path, or a gs://bucket/blob URI.
+    storage_client: the google.cloud.storage.Client a gs:// URI is read with (the server passes the one of its
+                    ClientRegistry); a new client is created if None.
+
+    Returns (ids, matrix) where ids is a list of str and matrix is a C-contiguous float32 array of shape (N, dim).
+    """
+    if path.startswith("gs://"):
+        if storage_client is None:
+            from google.cloud import storage
+            storage_client = storage.Client()
+
+        bucket_name, blob_name = path[len("gs://"):].split("/", 1)
+        lines = storage_client.bucket(bucket_name).blob(blob_name).download_as_text().splitlines()
+    else:
+        with open(path, 'r') as f:
+            lines = f.readlines()
+
+    ids, rows = parse_embedding_lines(lines)
+
+    if not rows:
+        raise ValueError(f"No embeddings found in {path}")
+
+    matrix = np.ascontiguousarray(np.stack(rows), dtype=np.float32)
+
+    return ids, matrix
+
+
+
+# a binary copy of the gallery, written by save_npy_dir, which loads in milliseconds with np.load(mmap_mode='r'):
+#   index.json       dim, count, and the shard files with their number of rows
+#   shard_00000.npy  (rows, dim) float32, L2-normalized; the rows of all shards, in order, follow ids.json
+#   ids.json         the image ids
+#   ids.npy          (optional, id_table=True) the same ids as fixed-width UTF-8 bytes, memory-mapped as an IdTable
+
+NPY_SHARD_ROWS = 65536
+
+
+
+class IdTable:
+    """
+    A read-only sequence of image ids backed by a fixed-width bytes array (np.dtype('S<n>')), usually memory-mapped:
+    the ids are decoded when they are read, so processes mapping the same file share one copy of them instead of
+    holding a Python list each.
+    """
+
+    def __init__(self, array):
+        self.array = array
+
+
+    @classmethod
+    def from_ids(cls, ids):
+        return cls(np.array([str(image_id).encode("utf-8") for image_id in ids], dtype=np.bytes_))
+
+
+    def __len__(self):
+        return self.array.shape[0]
+
+
+    def __getitem__(self, i):
+        return self.array[i].decode("utf-8")
+
+
+    def __iter__(self):
+        for value in self.array:
+            yield value.decode("utf-8")
+
+
+def save_npy_dir(ids, matrix, output_dir, shard_rows = NPY_SHARD_ROWS, id_table = False):
+    # returns the index.json dictionary; id_table: also write the ids as ids.npy (see IdTable)
+
+    if len(ids) != matrix.shape[0]:
+        raise ValueError(f"Got {len(ids)} ids for {matrix.shape[0]} embeddings")
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    shards = []
+    for start in range(0, matrix.shape[0], shard_rows):
+        shard = normalize_rows(np.array(matrix[start:start + shard_rows], dtype=np.float32))
+        file_name = f"shard_{len(shards):05d}.npy"
+        np.save(os.path.join(output_dir, file_name), shard)
+        shards.append({"file": file_name, "count": int(shard.shape[0])})
+
+    with open(os.path.join(output_dir, "ids.json"), 'w') as f:
+        json.dump([str(image_id) for image_id in ids], f)
+
+    meta = {"type": "npy", "dim": int(matrix.shape[1]), "count": int(matrix.shape[0]), "dtype": "float32",
+            "normalized": True, "shards": shards}
+    if id_table:
+        np.save(os.path.join(output_dir, "ids.npy"), IdTable.from_ids(ids).array)
+        meta["ids_file"] = "ids.npy"
+
+    with open(os.path.join(output_dir, "index.json"), 'w') as f:
+        json.dump(meta, f, indent=4)
+
+    return meta
+
+
+def load_npy_dir(path, mmap_mode = 'r'):
+    # returns (ids, shards): the shards are memory-mapped (mmap_mode=None reads them into memory), and so are the ids
+    # if the directory has an id table (an IdTable, otherwise a list). A symbolic link (see shared_gallery.py) is
+    # resolved once, so that every file is read from the same version of the gallery
+
+    path = os.path.realpath(path)
+    with open(os.path.join(path, "index.json"), 'r') as f:
+        meta = json.load(f)
+
+    if meta.get("ids_file"):
+        ids = IdTable(np.load(os.path.join(path, meta["ids_file"]), mmap_mode=mmap_mode))
+    else:
+        with open(os.path.join(path, "ids.json"), 'r') as f:
+            ids = json.load(f)
+
+    shards = [np.load(os.path.join(path, shard["file"]), mmap_mode=mmap_mode) for shard in meta["shards"]]
+
+    if sum(shard.shape[0] for shard in shards) != len(ids):
+        raise ValueError(f"The shards of {path} do not match its ids")
+
+    return ids, shards
+
+
+def load_embeddings(path):
+    # (ids, matrix) from an embeddings .jsonl file or a directory written by save_npy_dir
+
+    if os.path.isdir(path):
+        ids, shards = load_npy_dir(path)
+        return list(ids), shards[0] if len(shards) == 1 else np.concatenate(shards)
+
+    return load_embeddings_jsonl(path)
+
+
+
+class LocalExactIndex:
+    """
+    In-process exact nearest neighbor search over the whole gallery.
+
+    The gallery is kept as one contiguous, L2-normalized float32 matrix, so a query is a single
+    matrix-vector product followed by argpartition. Scores are dot products, i.e. the same
+    'distance' Vertex AI returns for an index built with DOT_PRODUCT_DISTANCE and UNIT_L2_NORM.
+    """
+
+    def __init__(self, ids, matrix, normalized = False):
+        # normalized: the rows are already L2-normalized (e.g. a memory-mapped gallery), use the matrix as is
+
+        if len(ids) != matrix.shape[0]:
+            raise ValueError(f"Got {len(ids)} ids for {matrix.shape[0]} embeddings")
+
+        self.ids = ids if isinstance(ids, IdTable) else list(ids)
+        if normalized and matrix.dtype == np.float32:
+            self.matrix = matrix
+        else:
+            self.matrix = normalize_rows(np.array(matrix, dtype=np.float32))
+        self.dim = self.matrix.shape[1]
+
+
+    @classmethod
+    def from_jsonl(cls, path, storage_client = None):
+        ids, matrix = load_embeddings_jsonl(path, storage_client = storage_client)
+        return cls(ids, matrix)
+
+
+    @classmethod
+    def from_npy_dir(cls, path):
+        # a single shard stays memory-mapped; several shards are concatenated in memory
+        ids, shards = load_npy_dir(path)
+        return cls(ids, shards[0] if len(shards) == 1 else np.concatenate(shards), normalized = True)
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def search(self, query_vector, num_neighbors):
+        # returns a list of (id, dot product) tuples sorted from the most to the least similar
+
+        query = np.asarray(query_vector, dtype=np.float32).reshape(-1)
+        if query.shape[0] != self.dim:
+            raise ValueError(f"Query has dimension {query.shape[0]}, the index has dimension {self.dim}")
+
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        scores = self.matrix @ query
+
+        k = min(num_neighbors, scores.shape[0])
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        return [(self.ids[i], float(scores[i])) for i in top]
+
+
+    def search_batch(self, query_vectors, num_neighbors):
+        # one (N, dim) x (dim, B) matrix product for B queries; returns one list of (id, dot product) tuples per query
+
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        if queries.ndim != 2 or queries.shape[1] != self.dim:
+            raise ValueError(f"Queries have shape {queries.shape}, expected (num_queries, {self.dim})")
+
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+        scores = queries @ self.matrix.T
+
+        k = min(num_neighbors, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        return [[(self.ids[i], float(score)) for i, score in zip(row, row_scores)] for row, row_scores in zip(top, top_scores)]
+
+
+
+def kmeans(data, num_clusters, num_iterations = 10, max_train_points = 100000, seed = 0, spherical = True):
+    """
+    k-means used to train the inverted lists of the IVF index and the product quantization codebooks.
+
+    data (np.ndarray): (N, dim) float32 array; only a random sample of max_train_points rows is used for training.
+    spherical (bool): if True, rows are assumed L2-normalized and clustered by dot product (centroids are
+                      re-normalized), otherwise clustered by euclidean distance.
+
+    Returns the (num_clusters, dim) float32 array of centroids.
+    """
+    rng = np.random.default_rng(seed)
+
+    if data.shape[0] > max_train_points:
+        sample = np.sort(rng.choice(data.shape[0], max_train_points, replace=False))
+        data = data[sample]
+
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    num_clusters = min(num_clusters, data.shape[0])
+
+    centroids = data[rng.choice(data.shape[0], num_clusters, replace=False)].copy()
+
+    for _ in range(num_iterations):
+        assignment = assign_to_centroids(data, centroids, spherical = spherical)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, data)
+        counts = np.bincount(assignment, minlength=num_clusters)
+
+        # re-seed empty clusters with random points so every centroid stays in use
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            sums[empty] = data[rng.choice(data.shape[0], len(empty), replace=False)]
+            counts[empty] = 1
+
+        if spherical:
+            centroids = normalize_rows(sums)
+        else:
+            centroids = sums / counts[:, None].astype(np.float32)
+
+    return centroids
+
+
+
+def assign_to_centroids(data, centroids, chunk_size = 8192, spherical = True):
+    # returns, for every row of data, the index of the closest centroid (largest dot product, or smallest euclidean distance)
+
+    if not spherical:
+        half_sq_norms = 0.5 * np.einsum('ij,ij->i', centroids, centroids)
+
+    assignment = np.empty(data.shape[0], dtype=np.int64)
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = np.asarray(data[start:start + chunk_size], dtype=np.float32)
+        scores = chunk @ centroids.T
+        if not spherical:
+            scores -= half_sq_norms # argmax of x.c - |c|^2/2 is the argmin of |x - c|^2
+        assignment[start:start + chunk_size] = np.argmax(scores, axis=1)
+
+    return assignment
+
+
+
+# converts the output of create_embeddings.py to the binary format once, e.g.
+#   python local_index.py embeddings/embeddings.json gallery_npy/
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Convert an embeddings .jsonl file to memory-mappable .npy shards.")
+    parser.add_argument("embeddings_path", help="the embeddings file written by create_embeddings.py")
+    parser.add_argument("output_dir", help="the directory to write the shards to")
+    parser.add_argument("--shard-rows", type=int, default=NPY_SHARD_ROWS, help="number of embeddings per shard")
+    args = parser.parse_args()
+
+    ids, matrix = load_embeddings_jsonl(args.embeddings_path)
+    meta = save_npy_dir(ids, matrix, args.output_dir, shard_rows = args.shard_rows)
+
+    print(f"Wrote {meta['count']} embeddings of dimension {meta['dim']} in {len(meta['shards'])} shards to {args.output_dir}")
+
+
+
+if __name__ == "__main__":
+    main()
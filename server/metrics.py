@@ -0,0 +1,208 @@
+import os
+import time
+import queue
+import logging
+import functools
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+from prometheus_client import Histogram, Gauge, Counter, CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+
+
+# Prometheus metrics of the server, served at GET /metrics:
+#   face_search_stage_seconds{stage}        time spent in every stage of a request (decode, to_array, embed, embed_batch,
+#                                           search, vote, fetch, thumbnail, base64, fetch_images)
+#   face_search_request_seconds{endpoint}   end-to-end time of the requests
+#   face_search_requests_in_flight{endpoint}
+#   face_search_cache_*{cache}              the counters of the image and result caches (read at scrape time)
+#   face_search_embedding_*                 the embedding batcher queue depth and batch counters
+#   face_search_admission_wait_seconds{stage}      time requests waited for a slot of a stage (see admission.py)
+#   face_search_admission_service_seconds{stage}   time requests held the slot, i.e. the service time of the stage
+#   face_search_admission_shed_total{stage,reason} requests rejected by admission control (queue_full, deadline)
+#   face_search_admission_waiting / _in_service{stage}
+# With several worker processes (PROMETHEUS_MULTIPROC_DIR set, see shared_gallery.py) the histograms, counters and the
+# in-flight gauge are aggregated over all workers; the metrics of StatsCollector are the ones of the worker scraped.
+
+MULTIPROCESS_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+STAGE_SECONDS = Histogram("face_search_stage_seconds", "Time spent in each stage of a request", ["stage"], buckets=LATENCY_BUCKETS)
+REQUEST_SECONDS = Histogram("face_search_request_seconds", "End-to-end request latency", ["endpoint"], buckets=LATENCY_BUCKETS)
+IN_FLIGHT = Gauge("face_search_requests_in_flight", "Requests being processed", ["endpoint"], multiprocess_mode="livesum")
+
+ADMISSION_WAIT_SECONDS = Histogram("face_search_admission_wait_seconds", "Time spent waiting for a slot of a stage", ["stage"],
+                                   buckets=LATENCY_BUCKETS)
+ADMISSION_SERVICE_SECONDS = Histogram("face_search_admission_service_seconds", "Time spent holding a slot of a stage", ["stage"],
+                                      buckets=LATENCY_BUCKETS)
+ADMISSION_SHED = Counter("face_search_admission_shed", "Requests rejected by admission control", ["stage", "reason"])
+
+
+
+@contextmanager
+def stage(name):
+    # times the enclosed block as one observation of the given stage
+
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(name).observe(time.perf_counter() - start_time)
+
+
+def timed(name):
+    # decorator: every call of the function is one observation of the given stage
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def track_request(endpoint):
+    # counts the request as in flight, and records its latency once it is done
+
+    IN_FLIGHT.labels(endpoint).inc()
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - start_time)
+        IN_FLIGHT.labels(endpoint).dec()
+
+
+
+class StatsCollector:
+    """
+    Exposes the counters the caches and the embedding batcher already keep (their stats() dictionaries)
+    as Prometheus metrics, read when /metrics is scraped so nothing is counted twice.
+
+    caches (dict): name -> object with stats() (ImageCache, ResultCache)
+    batcher: the EmbeddingBatcher
+    limiters (dict): stage -> StageLimiter (admission.py)
+    """
+
+    COUNTERS = ("hits", "disk_hits", "misses", "expirations", "evictions", "disk_evictions", "invalidations")
+    GAUGES = ("entries", "bytes", "disk_entries", "disk_bytes")
+
+    def __init__(self, caches, batcher, limiters = None):
+        self.caches = caches
+        self.batcher = batcher
+        self.limiters = limiters or {}
+
+
+    def collect(self):
+        cache_stats = {name: cache.stats() for name, cache in self.caches.items()}
+
+        for counter in self.COUNTERS:
+            family = CounterMetricFamily(f"face_search_cache_{counter}", f"Cache {counter.replace('_', ' ')}", labels=["cache"])
+            for name, stats in cache_stats.items():
+                if counter in stats:
+                    family.add_metric([name], stats[counter])
+            yield family
+
+        for gauge in self.GAUGES:
+            family = GaugeMetricFamily(f"face_search_cache_{gauge}", f"Cache {gauge.replace('_', ' ')}", labels=["cache"])
+            for name, stats in cache_stats.items():
+                if gauge in stats:
+                    family.add_metric([name], stats[gauge])
+            yield family
+
+        batcher_stats = self.batcher.stats()
+        yield GaugeMetricFamily("face_search_embedding_queue_depth", "Images waiting for the embedding model",
+                                value=batcher_stats["queue_depth"])
+        yield CounterMetricFamily("face_search_embedding_batches", "Batches run by the embedding model",
+                                  value=batcher_stats["batches"])
+        yield CounterMetricFamily("face_search_embedding_images", "Images embedded by the embedding model",
+                                  value=batcher_stats["images"])
+        yield CounterMetricFamily("face_search_embedding_failures", "Images the embedding model failed on",
+                                  value=batcher_stats["failures"])
+
+        waiting = GaugeMetricFamily("face_search_admission_waiting", "Requests waiting for a slot of a stage", labels=["stage"])
+        in_service = GaugeMetricFamily("face_search_admission_in_service", "Requests holding a slot of a stage", labels=["stage"])
+        for name, limiter in self.limiters.items():
+            limiter_stats = limiter.stats()
+            waiting.add_metric([name], limiter_stats["waiting"])
+            in_service.add_metric([name], limiter_stats["in_service"])
+        yield waiting
+        yield in_service
+
+
+_COLLECTOR = None
+
+
+def register_stats(caches, batcher, limiters = None):
+    # registers (once) the collector of the cache, batcher and admission counters
+    global _COLLECTOR
+
+    if _COLLECTOR is None:
+        _COLLECTOR = StatsCollector(caches, batcher, limiters)
+        REGISTRY.register(_COLLECTOR)
+
+    return _COLLECTOR
+
+
+def render_metrics():
+    # returns (body, content type) of the Prometheus text exposition
+
+    if not MULTIPROCESS_DIR:
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    if _COLLECTOR is not None:
+        registry.register(_COLLECTOR)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def stop_metrics():
+    # drops the live gauges of this worker from the multiprocess metrics once it exits
+    if MULTIPROCESS_DIR:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+
+_LOG_LISTENER = None
+
+
+def start_logging(level = "INFO"):
+    """
+    Routes the log records of the server through a queue: the request path only enqueues the record, and a
+    background thread (QueueListener) formats and writes it to stderr.
+    """
+    global _LOG_LISTENER
+
+    if _LOG_LISTENER is not None:
+        return _LOG_LISTENER
+
+    log_queue = queue.SimpleQueue()
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    root_logger = logging.getLogger()
+    root_logger.addHandler(QueueHandler(log_queue))
+    root_logger.setLevel(level)
+
+    _LOG_LISTENER = QueueListener(log_queue, handler, respect_handler_level=True)
+    _LOG_LISTENER.start()
+
+    return _LOG_LISTENER
+
+
+def stop_logging():
+    # flushes the queued records and stops the listener thread
+    global _LOG_LISTENER
+
+    if _LOG_LISTENER is not None:
+        _LOG_LISTENER.stop()
+        for handler in list(logging.getLogger().handlers):
+            if isinstance(handler, QueueHandler):
+                logging.getLogger().removeHandler(handler)
+        _LOG_LISTENER = None
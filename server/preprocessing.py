@@ -0,0 +1,99 @@
+import io
+import math
+import numpy as np
+from PIL import Image
+
+
+
+# Turns uploaded image bytes into the BGR uint8 array DeepFace expects, with as few full-image copies as possible:
+#   decode_image   decodes at a bounded resolution: JPEGs are downscaled by the decoder itself (draft mode, 1/2, 1/4
+#                  or 1/8 scale), and what is left (or any other format) with a cheap integer reduce(), so that a
+#                  large phone photo is never decoded, or held, at full resolution
+#   to_bgr_array   packs the pixels straight into BGR order, one copy from the Pillow image to the array
+# Used by the server (utils.py) and by the client.
+
+MAX_IMAGE_SIDE = 1600 # the longest side an image is decoded at; faces are detected and aligned at far lower resolutions
+MAX_IMAGE_PIXELS = 100_000_000 # images whose header declares more pixels are rejected before decoding
+
+
+
+def fit_size(size, max_side):
+    # the size of an image of the given size once it fits in a max_side x max_side box (aspect ratio kept)
+
+    width, height = size
+    scale = max_side / max(width, height)
+    if scale >= 1:
+        return width, height
+
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def open_bounded(image, max_side = MAX_IMAGE_SIDE, max_pixels = MAX_IMAGE_PIXELS):
+    """
+    Decodes an opened (not yet loaded) Pillow image so that its longest side is at most max_side pixels.
+
+    Raises ValueError if the image declares more than max_pixels pixels.
+    """
+    width, height = image.size
+    if max_pixels and width * height > max_pixels:
+        raise ValueError(f"The image is too large ({width}x{height} pixels, at most {max_pixels} pixels are accepted).")
+
+    if not max_side or max(width, height) <= max_side:
+        image.load()
+        return image
+
+    # the JPEG decoder downscales by the largest power of two that keeps the image at least the size that fits in the
+    # box (no-op for other formats), then reduce() averages blocks of pixels by the integer factor that brings the
+    # longest side under max_side. Unlike a resampling resize this costs less than the decode it follows, at the price
+    # of images being decoded at between max_side / 2 and max_side pixels per side.
+    image.draft("RGB", fit_size(image.size, max_side))
+    image.load()
+
+    factor = math.ceil(max(image.size) / max_side)
+    if factor > 1:
+        image = image.reduce(factor)
+
+    return image
+
+
+def decode_image(contents, max_side = MAX_IMAGE_SIDE, max_pixels = MAX_IMAGE_PIXELS):
+    # decode the uploaded bytes into a Pillow image of at most max_side pixels per side
+
+    return open_bounded(Image.open(io.BytesIO(contents)), max_side = max_side, max_pixels = max_pixels)
+
+
+def flatten_alpha(image, background = (255, 255, 255)):
+    # composite an image with transparency onto a solid background, so that transparent pixels are not read as black
+
+    image = image.convert("RGBA")
+    flat = Image.new("RGB", image.size, background)
+    flat.paste(image, mask=image.getchannel("A"))
+
+    return flat
+
+
+def to_bgr_array(image):
+    """
+    Converts a Pillow image to an (height, width, 3) uint8 array in BGR order.
+
+    RGB and RGBA images are packed into BGR by Pillow directly, so the array is the only copy of the pixels (the
+    alpha channel of an RGBA image is composited onto white first if the image has any transparency); grayscale,
+    palette, CMYK and 16-bit images are converted to RGB first.
+
+    The returned array is read-only (it is a view of the packed bytes): copy it before modifying it.
+    """
+    if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+        alpha = image.getchannel("A") if image.mode != "P" else image.convert("RGBA").getchannel("A")
+        if alpha.getextrema()[0] < 255:
+            image = flatten_alpha(image)
+
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGB")
+
+    width, height = image.size
+    return np.frombuffer(image.tobytes("raw", "BGR"), dtype=np.uint8).reshape(height, width, 3)
+
+
+def image_bytes_to_bgr(contents, max_side = MAX_IMAGE_SIDE, max_pixels = MAX_IMAGE_PIXELS):
+    # decode_image followed by to_bgr_array
+    return to_bgr_array(decode_image(contents, max_side = max_side, max_pixels = max_pixels))
@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+from local_index import load_embeddings, normalize_rows, kmeans, assign_to_centroids, LocalExactIndex
+
+
+
+# this is a compressed copy of the gallery used for in-process search. Every L2-normalized embedding is stored as
+#   fp16: 2 bytes per dimension
+#   int8: 1 byte per dimension plus one float32 scale per embedding
+#   pq:   one byte per sub-vector (product quantization); a query is scored with asymmetric distance tables,
+#         i.e. the float32 query against the quantized gallery
+# Optionally the top candidates are re-ranked against the full-precision embeddings; pq needs it, as its approximate
+# scores miss many of the exact neighbors (fp16 and int8 keep almost all of them).
+#
+# On-disk layout of an index directory:
+#   meta.json        dim, count, kind, memory footprint and recall measured at build time
+#   codes.npy        (count, dim) float16 / (count, dim) int8 / (count, num_subvectors) uint8
+#   scales.npy       (count,) float32, int8 only
+#   codebooks.npy    (num_subvectors, 256, dim / num_subvectors) float32, pq only
+#   vectors.npy      (count, dim) float32, L2-normalized, only written when re-ranking is enabled
+#   ids.json         the image ids, in the same order as the codes
+
+QUANTIZATION_KINDS = ("fp16", "int8", "pq")
+
+SCAN_CHUNK_SIZE = 16384 # number of codes decoded at once, bounds the temporary float32 memory of a scan
+
+
+
+def quantize(matrix, kind, num_subvectors = 64, num_iterations = 10):
+    """
+    Quantizes L2-normalized embeddings.
+
+    Returns a dictionary with 'codes' and, depending on kind, 'scales' (int8) or 'codebooks' (pq).
+    """
+    if kind == "fp16":
+        return {"codes": matrix.astype(np.float16)}
+
+    if kind == "int8":
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.rint(matrix / scales[:, None]).astype(np.int8)
+        return {"codes": codes, "scales": scales.astype(np.float32)}
+
+    if kind == "pq":
+        dim = matrix.shape[1]
+        if dim % num_subvectors:
+            raise ValueError(f"The dimension {dim} is not divisible by num_subvectors={num_subvectors}")
+
+        sub_dim = dim // num_subvectors
+        codebooks = np.empty((num_subvectors, 256, sub_dim), dtype=np.float32)
+        codes = np.empty((matrix.shape[0], num_subvectors), dtype=np.uint8)
+
+        for m in range(num_subvectors):
+            sub_vectors = np.ascontiguousarray(matrix[:, m * sub_dim:(m + 1) * sub_dim])
+            centroids = kmeans(sub_vectors, 256, num_iterations = num_iterations, seed = m, spherical = False)
+            codebooks[m, :centroids.shape[0]] = centroids
+            codebooks[m, centroids.shape[0]:] = 0 # fewer than 256 training points
+            codes[:, m] = assign_to_centroids(sub_vectors, centroids, spherical = False)
+
+        return {"codes": codes, "codebooks": codebooks}
+
+    raise ValueError(f"Unknown quantization kind: {kind}. Use one of {QUANTIZATION_KINDS}")
+
+
+
+def build_quantized_index(ids, matrix, output_dir, kind, num_subvectors = 64, keep_full_precision = True):
+    """
+    Quantizes the gallery and saves the index under output_dir.
+
+    keep_full_precision (bool): also store the float32 embeddings, which is required for re-ranking.
+
+    Returns the meta dictionary (also written to meta.json).
+    """
+    start_time = time.perf_counter()
+
+    matrix = normalize_rows(np.array(matrix, dtype=np.float32))
+    arrays = quantize(matrix, kind, num_subvectors = num_subvectors)
+
+    os.makedirs(output_dir, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(output_dir, f"{name}.npy"), array)
+    if keep_full_precision:
+        np.save(os.path.join(output_dir, "vectors.npy"), matrix)
+    with open(os.path.join(output_dir, "ids.json"), 'w') as f:
+        json.dump(list(ids), f)
+
+    meta = {
+        "type": "quantized",
+        "kind": kind,
+        "dim": int(matrix.shape[1]),
+        "count": int(matrix.shape[0]),
+        "num_subvectors": int(num_subvectors) if kind == "pq" else None,
+        "full_precision": bool(keep_full_precision),
+        "float32_bytes": int(matrix.nbytes),
+        "quantized_bytes": int(sum(array.nbytes for array in arrays.values())),
+        "build_seconds": round(time.perf_counter() - start_time, 3),
+    }
+    with open(os.path.join(output_dir, "meta.json"), 'w') as f:
+        json.dump(meta, f, indent=4)
+
+    return meta
+
+
+
+class QuantizedIndex:
+    """
+    Nearest neighbor search over an index directory written by build_quantized_index.
+
+    The codes are scanned exhaustively (in chunks, so the float32 copy never holds the whole gallery).
+    With rerank > 0 the best rerank candidates are re-scored against the memory-mapped float32 embeddings.
+    Scores are dot products, like the ones returned by LocalExactIndex and Vertex AI.
+    """
+
+    def __init__(self, index_dir, rerank = 0):
+        with open(os.path.join(index_dir, "meta.json"), 'r') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(index_dir, "ids.json"), 'r') as f:
+            self.ids = json.load(f)
+
+        self.kind = self.meta["kind"]
+        self.dim = self.meta["dim"]
+        self.codes = np.load(os.path.join(index_dir, "codes.npy"))
+        self.scales = np.load(os.path.join(index_dir, "scales.npy")) if self.kind == "int8" else None
+        self.codebooks = np.load(os.path.join(index_dir, "codebooks.npy")) if self.kind == "pq" else None
+
+        vectors_path = os.path.join(index_dir, "vectors.npy")
+        self.vectors = np.load(vectors_path, mmap_mode='r') if os.path.exists(vectors_path) else None
+
+        if rerank and self.vectors is None:
+            raise ValueError(f"Re-ranking needs the full-precision embeddings, which were not saved in {index_dir}")
+        self.rerank = rerank
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def approximate_scores(self, query):
+        # dot products of the (normalized, float32) query with every quantized embedding
+
+        scores = np.empty(self.codes.shape[0], dtype=np.float32)
+
+        if self.kind == "pq":
+            num_subvectors, _, sub_dim = self.codebooks.shape
+            # distance table: the dot product of every query sub-vector with every codeword, shape (num_subvectors, 256)
+            table = np.einsum('mkd,md->mk', self.codebooks, query.reshape(num_subvectors, sub_dim))
+            subvector_index = np.arange(num_subvectors)
+            for start in range(0, self.codes.shape[0], SCAN_CHUNK_SIZE):
+                chunk = self.codes[start:start + SCAN_CHUNK_SIZE]
+                scores[start:start + SCAN_CHUNK_SIZE] = table[subvector_index, chunk].sum(axis=1)
+            return scores
+
+        for start in range(0, self.codes.shape[0], SCAN_CHUNK_SIZE):
+            chunk = self.codes[start:start + SCAN_CHUNK_SIZE].astype(np.float32)
+            scores[start:start + SCAN_CHUNK_SIZE] = chunk @ query
+
+        if self.kind == "int8":
+            scores *= self.scales
+
+        return scores
+
+
+    def search(self, query_vector, num_neighbors, rerank = None):
+        # rerank: number of candidates re-scored in full precision (0 disables it, None uses the index default)
+
+        rerank = self.rerank if rerank is None else rerank
+
+        query = np.asarray(query_vector, dtype=np.float32).reshape(-1)
+        if query.shape[0] != self.dim:
+            raise ValueError(f"Query has dimension {query.shape[0]}, the index has dimension {self.dim}")
+
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        scores = self.approximate_scores(query)
+
+        num_candidates = min(max(num_neighbors, rerank), scores.shape[0])
+        top = np.argpartition(-scores, num_candidates - 1)[:num_candidates]
+
+        if rerank and self.vectors is not None:
+            top = np.sort(top) # read the memory-mapped rows in file order
+            scores = np.zeros_like(scores)
+            scores[top] = self.vectors[top] @ query
+
+        top = top[np.argsort(-scores[top])][:num_neighbors]
+
+        return [(self.ids[i], float(scores[i])) for i in top]
+
+
+    def search_batch(self, query_vectors, num_neighbors, rerank = None):
+        # one list of (id, dot product) tuples per query
+        return [self.search(query_vector, num_neighbors, rerank = rerank) for query_vector in query_vectors]
+
+
+
+def evaluate_recall(index, exact_index, queries, num_neighbors = 5):
+    # the average fraction of the exact top num_neighbors ids that the index also returns
+
+    recalls = []
+    for query in queries:
+        exact_ids = {neighbor_id for neighbor_id, _ in exact_index.search(query, num_neighbors)}
+        found_ids = {neighbor_id for neighbor_id, _ in index.search(query, num_neighbors)}
+        recalls.append(len(exact_ids & found_ids) / len(exact_ids))
+
+    return float(np.mean(recalls))
+
+
+
+# quantizes the output of create_embeddings.py offline, e.g.
+#   python quantized_index.py embeddings/embeddings.json pq_index/ --kind pq --num-subvectors 64
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Build a quantized index from an embeddings .jsonl file.")
+    parser.add_argument("embeddings_path", help="the embeddings file written by create_embeddings.py, or a .npy directory written by local_index.py")
+    parser.add_argument("output_dir", help="the directory to write the index to")
+    parser.add_argument("--kind", choices=QUANTIZATION_KINDS, default="int8")
+    parser.add_argument("--num-subvectors", type=int, default=64, help="number of PQ sub-vectors (pq only)")
+    parser.add_argument("--no-full-precision", action="store_true", help="do not store the float32 embeddings (disables re-ranking)")
+    parser.add_argument("--rerank", type=int, default=50, help="number of candidates re-ranked when measuring recall")
+    parser.add_argument("--num-queries", type=int, default=200, help="number of gallery embeddings used as queries to measure recall")
+    parser.add_argument("--num-neighbors", type=int, default=5)
+    args = parser.parse_args()
+
+    ids, matrix = load_embeddings(args.embeddings_path)
+    print(f"Loaded {len(ids)} embeddings of dimension {matrix.shape[1]}.")
+
+    meta = build_quantized_index(ids, matrix, args.output_dir, args.kind, num_subvectors = args.num_subvectors,
+                                 keep_full_precision = not args.no_full_precision)
+
+    print(f"Built a {args.kind} index in {meta['build_seconds']} s.")
+    print(f"Gallery memory: {meta['float32_bytes'] / 2**20:.2f} MB as float32, {meta['quantized_bytes'] / 2**20:.2f} MB quantized "
+          f"({meta['float32_bytes'] / meta['quantized_bytes']:.1f}x smaller)")
+
+    # measure recall against exact float32 search, using a sample of the gallery as queries
+    exact_index = LocalExactIndex(ids, matrix)
+    rng = np.random.default_rng(0)
+    queries = exact_index.matrix[rng.choice(len(ids), min(args.num_queries, len(ids)), replace=False)]
+
+    index = QuantizedIndex(args.output_dir)
+    meta["recall"] = {"without_rerank": evaluate_recall(index, exact_index, queries, args.num_neighbors)}
+    print(f"Recall@{args.num_neighbors} without re-ranking: {meta['recall']['without_rerank']:.4f}")
+
+    if index.vectors is not None and args.rerank:
+        index.rerank = args.rerank
+        meta["recall"][f"rerank_{args.rerank}"] = evaluate_recall(index, exact_index, queries, args.num_neighbors)
+        print(f"Recall@{args.num_neighbors} re-ranking the top {args.rerank}: {meta['recall'][f'rerank_{args.rerank}']:.4f}")
+
+    with open(os.path.join(args.output_dir, "meta.json"), 'w') as f:
+        json.dump(meta, f, indent=4)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import time
+import hashlib
+import threading
+import numpy as np
+import logging
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+
+class ResultCache:
+    """
+    TTL + LRU cache of search outcomes: the identity and the ids of the accepted neighbors of a query, not the
+    images, which are resolved through the image cache, so entries are a few hundred bytes each.
+
+    Keys are built by image_key (hash of the uploaded bytes) or embedding_key (hash of the embedding rounded
+    to float16), together with the search options. The cache is tied to a version string (the index and
+    dataset being served) and is emptied when it changes.
+    """
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (expiry time, response), least recently used first
+        self.version = None
+
+        self.counters = {"hits": 0, "misses": 0, "expirations": 0, "evictions": 0, "invalidations": 0}
+
+
+    @staticmethod
+    def image_key(contents, *options):
+        return hashlib.sha256(contents).hexdigest() + repr(options)
+
+
+    @staticmethod
+    def embedding_key(img_embd, *options):
+        # the embedding is rounded to float16, so the same query sent as JSON, float32 or float16 maps to the same key
+        rounded = np.asarray(img_embd, dtype=np.float32).reshape(-1).astype(np.float16)
+        return hashlib.sha256(rounded.tobytes()).hexdigest() + repr(options)
+
+
+    def ensure_version(self, version):
+        # empty the cache if the index or dataset it was filled from is no longer the one being served
+
+        with self._lock:
+            if version == self.version:
+                return
+
+            if self.version is not None:
+                self.counters["invalidations"] += 1
+                logger.info(f"Result cache invalidated: version changed from '{self.version}' to '{version}'.")
+
+            self._entries.clear()
+            self.version = version
+
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+
+            expiry, value = entry
+            if expiry < time.monotonic():
+                del self._entries[key]
+                self.counters["expirations"] += 1
+                self.counters["misses"] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return value
+
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, entries=len(self._entries))
@@ -1,30 +1,239 @@
 from utils import *
+from metrics import stage, track_request, register_stats, render_metrics, stop_metrics, start_logging, stop_logging
+from admission import BodySizeLimit, set_deadline
+from contextlib import asynccontextmanager
+
+
+logger = logging.getLogger("server")
+
+
+
+async def warm_up(app: FastAPI):
+    # warm up the embedding model in the background; /ready reports the server as ready once it is done
+
+    if WARMUP_EMBEDDING_MODEL:
+        try:
+            await EMBEDDING_BATCHER.run(warm_up_embedding_model)
+        except ImportError:
+            logger.warning("DeepFace is not installed, /faceimage is not available on this server.")
+        except Exception as e:
+            logger.error(f"Error warming up the embedding model: {e}")
+
+    app.state.ready = True
+
+
+async def watch_index_version():
+    # re-reads the sync time of the deployed Vertex AI index every INDEX_VERSION_CHECK_SECONDS, so that the result
+    # cache is emptied once index updates are served (see get_index_version)
+
+    while True:
+        await run_blocking(IO_EXECUTOR, refresh_index_version)
+        await asyncio.sleep(INDEX_VERSION_CHECK_SECONDS)
+
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # create the shared clients and load the search index once, before the first request is served
+    app.state.ready = False
+    start_logging(LOG_LEVEL)
+    register_stats({"image": IMAGE_CACHE, "result": RESULT_CACHE}, EMBEDDING_BATCHER, LIMITERS)
+    start_clients()
+    load_search_backend()
+    await EMBEDDING_BATCHER.start()
+    warm_up_task = asyncio.create_task(warm_up(app))
+    version_task = None
+    if SEARCH_BACKEND == "vertex" and RESULT_CACHE_SIZE > 0 and INDEX_VERSION_CHECK_SECONDS > 0:
+        version_task = asyncio.create_task(watch_index_version())
+    yield
+    warm_up_task.cancel()
+    if version_task is not None:
+        version_task.cancel()
+    await EMBEDDING_BATCHER.stop()
+    close_clients()
+    shutdown_executors()
+    stop_metrics()
+    stop_logging()
+
 
 
 # Create the FastAPI application instance
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# the endpoints receiving image uploads: they are shed before their body is read when the decode stage is saturated
+UPLOAD_PATHS = ("/faceimage", "/faceimage/stream")
+EMBED_PATHS = ("/embed", "/embed/stream")
+
+# the body size of every endpoint taking a request body is limited
+app.add_middleware(BodySizeLimit, max_bytes=MAX_UPLOAD_BYTES, paths=UPLOAD_PATHS)
+app.add_middleware(BodySizeLimit, max_bytes=MAX_EMBED_BYTES, paths=EMBED_PATHS)
+app.add_middleware(BodySizeLimit, max_bytes=MAX_BATCH_BYTES, paths=("/embed_batch",))
+
+
+
+# the endpoint label of the request metrics (image ids are not used as labels)
+def endpoint_label(path):
+    if path.startswith("/images/"):
+        return "/images/{image_id}"
+    if path in ("/embed", "/faceimage", "/embed/stream", "/faceimage/stream", "/embed_batch", "/ready", "/stats", "/metrics"):
+        return path
+    return "other"
+
+
+def request_timeout(request):
+    # REQUEST_DEADLINE (None if it is 0), or less if the client asked for it (X-Request-Timeout, in seconds); only a
+    # finite number of seconds above 0 can shorten the deadline, any other value of the header is ignored
+
+    timeout = REQUEST_DEADLINE if REQUEST_DEADLINE > 0 else None
+
+    try:
+        requested = float(request.headers["x-request-timeout"])
+    except (KeyError, ValueError):
+        return timeout
+
+    if not math.isfinite(requested) or requested <= 0:
+        return timeout
+    return requested if timeout is None else min(requested, timeout)
+
+
+@app.middleware("http")
+async def track_requests(request: Request, call_next):
+    # in-flight gauge and end-to-end latency histogram of every endpoint (see /metrics); for the streaming
+    # endpoints the latency is measured until the response starts, i.e. until the identity is known.
+    # The deadline of the request is set here for the stage limiters (see admission.py).
+    with track_request(endpoint_label(request.url.path)), set_deadline(request_timeout(request)):
+        if request.url.path in UPLOAD_PATHS:
+            try:
+                LIMITERS["decode"].check()
+            except Overloaded as e:
+                return JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers)
+
+        return await call_next(request)
 
 
 # --- API Endpoint ---
+# the request body of /embed and /embed/stream: JSON (DataPayload) or raw floats (see BINARY_EMBEDDING_TYPES)
+EMBED_REQUEST_BODY = {"requestBody": {"required": True, "content": {
+    "application/json": {"schema": DataPayload.model_json_schema()},
+    **{content_type: {"schema": {"type": "string", "format": "binary"}} for content_type in BINARY_EMBEDDING_TYPES}}}}
+
+
+async def parse_embedding_request(request, nprobe, thumbnail_size, thumbnail_quality, image_mode):
+    # returns (img_embd, payload): the checked embedding and the options of the request (JSON fields, or the
+    # query parameters when the embedding is sent as raw floats)
+
+    content_type = request.headers.get("content-type", "application/json").split(";")[0].strip().lower()
+    body = await request.body()
+
+    try:
+        if content_type in BINARY_EMBEDDING_TYPES:
+            img_embd = parse_binary_embedding(body, content_type)
+            payload = DataPayload(data=[], nprobe=nprobe, thumbnail_size=thumbnail_size,
+                                  thumbnail_quality=thumbnail_quality, image_mode=image_mode)
+        else:
+            payload = DataPayload.model_validate_json(body)
+            img_embd = payload.data
+
+        img_embd = check_embedding(img_embd)
+
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid embedding: {e}")
+
+    logger.debug("Received request for %s endpoint: Size of embedding: %d (%s)", request.url.path, len(img_embd), content_type)
+
+    return img_embd, payload
+
+
+async def embed_upload(contents, filename):
+    # decodes the uploaded image and embeds it (batched with the images of concurrent requests)
+
+    async with LIMITERS["decode"].slot():
+        # Open the image using Pillow from the bytes
+        try:
+            image = await run_blocking(CPU_EXECUTOR, decode_image, contents)
+            logger.debug("Successfully decoded image: %s (Format: %s)", filename, image.format)
+
+        except Exception as decode_error:
+            logger.warning(f"Error decoding image {filename}: {decode_error}")
+            raise HTTPException(status_code=400, detail=f"Invalid image file or format: {decode_error}")
+
+        img_array = await run_blocking(CPU_EXECUTOR, Pil_to_array, image)
+
+
+    # Generate the embedding of the image
+    async with LIMITERS["embed"].slot():
+        try:
+            with stage("embed"): # waiting for a batch and running it
+                img_embd = await EMBEDDING_BATCHER.embed(img_array)
+            logger.debug("Successfully embedded the image.")
+
+        except asyncio.QueueFull:
+            raise Overloaded(429, "The server is busy (embedding queue full), retry later.", retry_after = 1)
+        except Exception as e:
+            logger.error(f"Error embedding the image: {e}")
+            raise HTTPException(status_code=500, detail=f"Could not embed the image.")
+
+    return img_embd
+
+
+async def search(img_embd, nprobe):
+    # identify_embedding, admitted by the search stage limiter; returns (identity, img_paths_list)
+
+    async with LIMITERS["search"].slot():
+        return await run_blocking(IO_EXECUTOR, identify_embedding, img_embd, nprobe = nprobe)
+
+
+async def fetch_result(identified, thumbnail_size, thumbnail_quality, image_mode):
+    # build_result for the (identity, img_paths_list) of search, admitted by the fetch stage limiter; the images
+    # come from IMAGE_CACHE when they were fetched recently
+
+    most_frequent_name, img_paths_list = identified
+
+    async with LIMITERS["fetch"].slot():
+        return await run_blocking(IO_EXECUTOR, build_result, most_frequent_name, list(img_paths_list), thumbnail_size = thumbnail_size,
+                                  thumbnail_quality = thumbnail_quality, image_mode = image_mode)
+
+
+async def stream_result(img_embd, nprobe, thumbnail_size, thumbnail_quality, image_mode):
+    # identifies the embedding before answering (so search errors are still HTTP errors), then streams the
+    # identity and the images as NDJSON (see iter_result_events)
+
+    most_frequent_name, img_paths_list = await search(img_embd, nprobe)
+
+    return StreamingResponse(iter_result_events(most_frequent_name, img_paths_list, thumbnail_size = thumbnail_size,
+                                                thumbnail_quality = thumbnail_quality, image_mode = image_mode),
+                             media_type="application/x-ndjson", headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"})
+
+
+
 # this is to handle the case where the embedding is recieved, in which case the extraction of embedding is performed on the client side. 
-@app.post("/embed", response_model=dict)
-async def face_retrieval_by_emb(payload: DataPayload):
-    
-    img_embd = payload.data
-    print(f"Received request for /embed endpoint: Size of embedding: {len(img_embd)}")
+# The embedding is sent either as JSON (DataPayload), or as raw little-endian float32/float16 values (see BINARY_EMBEDDING_TYPES),
+# in which case the options of DataPayload are passed as query parameters.
+@app.post("/embed", response_model=dict, openapi_extra=EMBED_REQUEST_BODY)
+async def face_retrieval_by_emb(request: Request, nprobe: Optional[int] = Query(None, ge=1),
+                                thumbnail_size: Optional[int] = Query(None, ge=16, le=4096),
+                                thumbnail_quality: int = Query(THUMBNAIL_QUALITY, ge=1, le=95),
+                                image_mode: Literal["inline", "reference"] = "inline"):
 
+    img_embd, payload = await parse_embedding_request(request, nprobe, thumbnail_size, thumbnail_quality, image_mode)
 
     try:
-        
-       return_val = handle_embedding(img_embd)
+        # the same (rounded) embedding was identified recently: skip the vector search
+        cache_key = RESULT_CACHE.embedding_key(img_embd, payload.nprobe)
+        identified = get_cached_result(cache_key)
+        if identified is None:
+            identified = await search(img_embd, payload.nprobe)
+            cache_result(cache_key, identified)
 
-       return return_val
+        return await fetch_result(identified, payload.thumbnail_size, payload.thumbnail_quality, payload.image_mode)
 
 
     except HTTPException as http_exc:
         raise http_exc
     except Exception as e:
-        print(f"Unexpected error processing upload: {e}")
+        logger.exception(f"Unexpected error processing upload: {e}")
         raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {e}")
 
 
@@ -33,45 +242,174 @@ async def face_retrieval_by_emb(payload: DataPayload):
 
 # this is to handle the case where the actual image recieved, in which case the extraction of embedding is performed on the server side. 
 @app.post("/faceimage", response_model=dict)
-async def face_retrieval_by_img(file: UploadFile = File(...)):
+async def face_retrieval_by_img(file: UploadFile = File(...), nprobe: Optional[int] = Query(None, ge=1),
+                                thumbnail_size: Optional[int] = Query(None, ge=16, le=4096),
+                                thumbnail_quality: int = Query(THUMBNAIL_QUALITY, ge=1, le=95),
+                                image_mode: Literal["inline", "reference"] = "inline"):
     
-    print(f"Received request for /faceimage endpoint for file: {file.filename}")
+    logger.debug("Received request for /faceimage endpoint for file: %s", file.filename)
     try:
         contents = await file.read()
 
-        # Open the image using Pillow from the bytes
-        try:
-            image = Image.open(io.BytesIO(contents))
-            print(f"Successfully decoded image: {file.filename} (Format: {image.format})")
+        # the same image bytes were identified recently: skip decoding, embedding and search
+        cache_key = RESULT_CACHE.image_key(contents, EMBEDDING_MODEL, nprobe)
+        identified = get_cached_result(cache_key)
+        if identified is None:
+            img_embd = await embed_upload(contents, file.filename)
+            identified = await search(img_embd, nprobe)
+            cache_result(cache_key, identified)
+        else:
+            logger.debug("Using the cached identification of %s", file.filename)
 
-        except Exception as decode_error:
-            print(f"Error decoding image {file.filename}: {decode_error}")
-            raise HTTPException(status_code=400, detail=f"Invalid image file or format: {decode_error}")
+        return await fetch_result(identified, thumbnail_size, thumbnail_quality, image_mode)
 
 
-        # Generate the embedding of the image
-        try:
-            img_embd = generate_img_embedding(image)
-            print(f"Successfully embedded the image.")
+    except HTTPException as http_exc:
+        raise http_exc
+    except Exception as e:
+        logger.exception(f"Unexpected error processing upload for {file.filename}: {e}")
+        raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {e}")
+    finally:
+        await file.close()
 
-        except Exception as e:
-            print(f"Error embedding the image: {e}")
-            raise HTTPException(status_code=500, detail=f"Could not embed the image.")
 
 
-        
-        return_val = handle_embedding(img_embd)
 
-        return return_val
 
+# the streaming variants of /embed and /faceimage: the response is NDJSON, with the identity on its first line as soon
+# as the vote is done, then one line per image as its download completes (see iter_result_events). The result cache
+# is not used, as these responses are never assembled in full.
+@app.post("/embed/stream", openapi_extra=EMBED_REQUEST_BODY)
+async def face_retrieval_by_emb_stream(request: Request, nprobe: Optional[int] = Query(None, ge=1),
+                                       thumbnail_size: Optional[int] = Query(None, ge=16, le=4096),
+                                       thumbnail_quality: int = Query(THUMBNAIL_QUALITY, ge=1, le=95),
+                                       image_mode: Literal["inline", "reference"] = "inline"):
+
+    img_embd, payload = await parse_embedding_request(request, nprobe, thumbnail_size, thumbnail_quality, image_mode)
+
+    return await stream_result(img_embd, payload.nprobe, payload.thumbnail_size, payload.thumbnail_quality, payload.image_mode)
+
+
+@app.post("/faceimage/stream")
+async def face_retrieval_by_img_stream(file: UploadFile = File(...), nprobe: Optional[int] = Query(None, ge=1),
+                                       thumbnail_size: Optional[int] = Query(None, ge=16, le=4096),
+                                       thumbnail_quality: int = Query(THUMBNAIL_QUALITY, ge=1, le=95),
+                                       image_mode: Literal["inline", "reference"] = "inline"):
+
+    logger.debug("Received request for /faceimage/stream endpoint for file: %s", file.filename)
+    try:
+        contents = await file.read()
+    finally:
+        await file.close()
+
+    img_embd = await embed_upload(contents, file.filename)
+
+    return await stream_result(img_embd, nprobe, thumbnail_size, thumbnail_quality, image_mode)
+
+
+
+
+
+# this is to handle many embeddings at once (e.g. offline re-identification jobs): one multi-query vector search
+# is issued for the whole batch, and one result (identity, code, ids of the accepted neighbors) is returned per embedding.
+@app.post("/embed_batch", response_model=dict)
+async def face_retrieval_by_emb_batch(payload: BatchDataPayload):
+
+    logger.debug("Received request for /embed_batch endpoint: %d embeddings", len(payload.data))
+
+    if not payload.data:
+        raise HTTPException(status_code=400, detail="The batch is empty.")
+    if len(payload.data) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_QUERIES} embeddings can be sent in one batch.")
+
+    queries = np.asarray(payload.data, dtype=np.float32) if len({len(row) for row in payload.data}) == 1 else None
+    if queries is None or queries.shape[1] != get_embedding_dim():
+        raise HTTPException(status_code=400, detail=f"Every embedding must have dimension {get_embedding_dim()}")
+
+    try:
+        async with LIMITERS["search"].slot():
+            return await run_blocking(IO_EXECUTOR, handle_embedding_batch, queries, nprobe = payload.nprobe)
 
     except HTTPException as http_exc:
         raise http_exc
     except Exception as e:
-        print(f"Unexpected error processing upload for {file.filename}: {e}")
+        logger.exception(f"Unexpected error processing batch: {e}")
         raise HTTPException(status_code=500, detail=f"An unexpected server error occurred: {e}")
-    finally:
-        await file.close()
+
+
+
+
+
+# this serves a gallery image by id, so that search responses in the "reference" image mode only carry URLs.
+# The bytes are streamed from GCS, and the ETag/Cache-Control headers let browsers and proxies cache them.
+@app.get("/images/{image_id}")
+def get_image(image_id: str, request: Request,
+              thumbnail_size: Optional[int] = Query(None, ge=16, le=4096),
+              thumbnail_quality: int = Query(THUMBNAIL_QUALITY, ge=1, le=95)):
+
+    if not image_id or image_id.startswith("/") or ".." in image_id.split("/"):
+        raise HTTPException(status_code=400, detail=f"Invalid image id: {image_id}")
+
+    try:
+        blob = get_image_blob(image_id)
+    except Exception as e:
+        logger.error(f"Error reading image {image_id} from GCS: {e}")
+        raise HTTPException(status_code=502, detail=f"Could not read the image from storage: {e}")
+
+    if blob is None:
+        raise HTTPException(status_code=404, detail=f"Image not found: {image_id}")
+
+    etag = f'"{blob.etag or blob.md5_hash}'
+    if thumbnail_size:
+        etag += f'-{thumbnail_size}-{thumbnail_quality}'
+    etag += '"'
+
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={IMAGE_MAX_AGE}"}
+
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    if thumbnail_size:
+        encoded_img = encode_image_to_base64(BUCKET_NAME, DATASET_ADD + image_id, thumbnail_size, thumbnail_quality)
+        if encoded_img is None:
+            raise HTTPException(status_code=502, detail=f"Could not create the thumbnail of {image_id}")
+        return Response(content=base64.b64decode(encoded_img), media_type="image/jpeg", headers=headers)
+
+    if blob.size is not None:
+        headers["Content-Length"] = str(blob.size)
+
+    return StreamingResponse(iter_blob_chunks(blob), media_type=blob.content_type or "application/octet-stream", headers=headers)
+
+
+
+
+
+# readiness: 503 until the embedding model has been warmed up (use it as the startup/readiness probe)
+@app.get("/ready", response_model=dict)
+async def readiness():
+    if not app.state.ready:
+        raise HTTPException(status_code=503, detail="The server is warming up.")
+    return {"ready": True}
+
+
+
+
+
+# counters of the server-side caches, of the embedding batcher (queue depth, batch sizes) and of admission control
+@app.get("/stats", response_model=dict)
+async def server_stats():
+    return {"image_cache": IMAGE_CACHE.stats(), "result_cache": RESULT_CACHE.stats(), "embedding_batcher": EMBEDDING_BATCHER.stats(),
+            "admission": {name: limiter.stats() for name, limiter in LIMITERS.items()}}
+
+
+
+
+
+# Prometheus metrics: per-stage and per-endpoint latency histograms, in-flight requests, cache and batcher counters
+@app.get("/metrics")
+async def metrics():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
 
 
 
@@ -0,0 +1,148 @@
+import os
+import glob
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from local_index import load_embeddings, save_npy_dir
+
+
+
+# Multi-worker serving with one copy of the gallery, e.g.
+#   python server/shared_gallery.py embeddings/embeddings.json --workers 4
+# The gallery (an embeddings file or a .npy directory) is published once by this launcher to SHARED_GALLERY_DIR:
+# one L2-normalized float32 shard and the ids as a fixed-width bytes table (local_index.IdTable). The launcher then
+# starts uvicorn with that many worker processes, with SEARCH_BACKEND=local and LOCAL_EMBEDDINGS_PATH pointing at
+# it. Every worker memory-maps both files read-only, so the pages of the gallery are in memory once however many
+# workers there are. By default the directory is on /dev/shm (tmpfs), so the gallery never goes through the disk.
+# Everything else (the embedding model, the caches, the batcher) is still per worker.
+#
+# SHARED_GALLERY_DIR is a symbolic link to the current version of the gallery, a directory next to it
+# ("<SHARED_GALLERY_DIR>.v<time>-<pid>"): a new version is written in full to its own directory, then the link is
+# switched to it with one rename, so the path always resolves to a complete gallery.
+#
+# With several workers the Prometheus metrics are aggregated over all of them (prometheus_client multiprocess mode,
+# see serve); the cache, batcher and admission gauges of /metrics and /stats are still the ones of the worker that
+# answered.
+
+SHARED_GALLERY_DIR = os.environ.get("SHARED_GALLERY_DIR", os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+                                                                       "face_search_gallery"))
+
+
+
+def source_signature(source):
+    # identifies a version of the source gallery: its path and modification time (of index.json for a .npy directory);
+    # a gs:// file is identified by its URI only, publish it again with force=True after it changed
+
+    if source.startswith("gs://"):
+        return {"source": source, "source_mtime": None}
+
+    path = os.path.abspath(source)
+    stat_path = os.path.join(path, "index.json") if os.path.isdir(path) else path
+    return {"source": path, "source_mtime": os.path.getmtime(stat_path)}
+
+
+def publish_gallery(source, output_dir = SHARED_GALLERY_DIR, force = False):
+    """
+    Writes the gallery of source as a single memory-mappable shard with an id table to output_dir, unless output_dir
+    already holds the current version of source (force: write it anyway).
+
+    The gallery is written to a new version directory next to output_dir, and the output_dir symbolic link is then
+    replaced by one pointing at it (os.replace), so output_dir is never missing nor partial. The previous version is
+    kept for the workers still loading it, older ones are removed (workers that mapped them keep their pages).
+
+    Returns the index.json dictionary of the published gallery.
+    """
+    signature = source_signature(source)
+
+    meta_path = os.path.join(output_dir, "index.json")
+    if not force and os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta.get("ids_file") and all(meta.get(key) == value for key, value in signature.items()):
+            return meta
+
+    ids, matrix = load_embeddings(source)
+
+    output_dir = os.path.abspath(output_dir)
+    version_dir = f"{output_dir}.v{time.time_ns()}-{os.getpid()}"
+    meta = save_npy_dir(ids, matrix, version_dir, shard_rows = max(len(ids), 1), id_table = True)
+    meta.update(signature)
+    with open(os.path.join(version_dir, "index.json"), 'w') as f:
+        json.dump(meta, f, indent=4)
+
+    # a gallery published as a plain directory (before the versioned layout) can not be replaced by a link
+    if os.path.isdir(output_dir) and not os.path.islink(output_dir):
+        shutil.rmtree(output_dir)
+
+    previous_dir = os.path.realpath(output_dir) if os.path.islink(output_dir) else None
+
+    link_path = f"{output_dir}.link-{os.getpid()}"
+    if os.path.lexists(link_path):
+        os.remove(link_path)
+    os.symlink(os.path.basename(version_dir), link_path)
+    os.replace(link_path, output_dir)
+
+    remove_old_versions(output_dir, keep = (version_dir, previous_dir))
+
+    return meta
+
+
+def remove_old_versions(output_dir, keep):
+    # removes the version directories of output_dir other than the ones in keep
+    for path in glob.glob(f"{glob.escape(output_dir)}.v*"):
+        if path not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def prepare_metrics_dir():
+    # the directory where the workers write their Prometheus metrics (PROMETHEUS_MULTIPROC_DIR, or a new temporary
+    # one), emptied of the files of a previous run as prometheus_client requires
+
+    metrics_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR") or tempfile.mkdtemp(prefix="face_search_metrics-")
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(glob.escape(metrics_dir), "*.db")):
+        os.remove(path)
+
+    return metrics_dir
+
+
+def serve(gallery_dir, workers, host = "0.0.0.0", port = 8080, app = "server:app", app_dir = None):
+    # runs uvicorn with the given number of worker processes, all of them searching the gallery published to gallery_dir
+    import uvicorn
+
+    os.environ["SEARCH_BACKEND"] = "local"
+    os.environ["LOCAL_EMBEDDINGS_PATH"] = gallery_dir
+    if workers > 1:
+        # set before the workers import prometheus_client, so that /metrics reports the requests of every worker
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = prepare_metrics_dir()
+
+    uvicorn.run(app, host=host, port=port, workers=workers, app_dir=app_dir or os.path.dirname(os.path.abspath(__file__)))
+
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Publish the gallery to shared memory once, and serve it with several uvicorn workers.")
+    parser.add_argument("embeddings_path", help="the embeddings file written by create_embeddings.py, or a .npy directory written by local_index.py")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="number of uvicorn worker processes")
+    parser.add_argument("--gallery-dir", default=SHARED_GALLERY_DIR, help="where the gallery is published (default: on /dev/shm)")
+    parser.add_argument("--force", action="store_true", help="publish the gallery even if the published copy is up to date")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", "8080")))
+    parser.add_argument("--app", default="server:app", help="the ASGI app served by the workers")
+    parser.add_argument("--app-dir", default=None, help="the directory the app is imported from (default: this directory)")
+    args = parser.parse_args()
+
+    meta = publish_gallery(args.embeddings_path, args.gallery_dir, force = args.force)
+    size_bytes = meta["count"] * meta["dim"] * 4
+    print(f"Gallery of {meta['count']} embeddings of dimension {meta['dim']} ({size_bytes / 2**20:.1f} MB) published to {args.gallery_dir}")
+    print(f"Starting {args.workers} uvicorn workers...")
+
+    serve(args.gallery_dir, args.workers, host = args.host, port = args.port, app = args.app, app_dir = args.app_dir)
+
+
+
+if __name__ == "__main__":
+    main()
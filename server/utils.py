@@ -1,7 +1,7 @@
 import os
 import base64
-from fastapi import FastAPI, HTTPException, File, UploadFile
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, File, UploadFile, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from typing import List
 from PIL import Image
 import io
@@ -10,9 +10,26 @@ from google.cloud import storage
 import numpy as np
 import json
 from collections import Counter
-from pydantic import BaseModel 
-from typing import List, Any 
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Any, Optional, Literal
+from urllib.parse import quote, urlencode
 import math
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor, wait
+from local_index import LocalExactIndex
+from ivf_index import IVFIndex
+from quantized_index import QuantizedIndex
+from identity_index import IdentityIndex
+from clients import ClientRegistry
+from image_cache import ImageCache
+from embed_batcher import EmbeddingBatcher
+from admission import StageLimiter, Overloaded
+from result_cache import ResultCache
+from metrics import stage, timed
+import preprocessing
+import logging
 
 # --- Some Global Vars ---
 PROJECT_ID = ""
@@ -26,18 +43,156 @@ DATASET_ADD = ""
 
 NUM_NEIGHBORS = 5 # used for performing nearsest neighbor vector search using Vetrex AI
 
+EMBEDDING_DIM = int(os.environ.get("EMBEDDING_DIM", "4096")) # the dimension of the embeddings (VGG-Face), checked against every /embed query
+
+# /embed also accepts the embedding as raw little-endian floats, with one of these content types
+BINARY_EMBEDDING_TYPES = {
+    "application/x-float32": np.dtype('<f4'),
+    "application/octet-stream": np.dtype('<f4'),
+    "application/x-float16": np.dtype('<f2'),
+}
+
+SIMILARITY_THRESHOLD = 0.25 # the threshold used by the embedding model (VGG): neighbors with a lower score are rejected
+
+MAX_BATCH_QUERIES = int(os.environ.get("MAX_BATCH_QUERIES", "1024")) # the largest number of embeddings accepted by /embed_batch
+
+# which vector search backend answers the queries: "vertex" (Vertex AI Vector Search), "local" (in-process exact search),
+# "ivf" (in-process approximate search over an index built with ivf_index.py), "quantized" (in-process search over
+# fp16/int8/PQ codes built with quantized_index.py) or "identity" (in-process two-stage search over the identity
+# prototypes built with identity_index.py)
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", "vertex")
+# the embeddings file written by create_embeddings.py (local path or gs://bucket/blob), or a directory of .npy shards
+# written by local_index.py (memory-mapped, loads in milliseconds), used by the local backend
+LOCAL_EMBEDDINGS_PATH = os.environ.get("LOCAL_EMBEDDINGS_PATH", "embeddings/embeddings.json")
+# the index directory written by ivf_index.py, and the default number of inverted lists scanned per query
+IVF_INDEX_PATH = os.environ.get("IVF_INDEX_PATH", "ivf_index")
+IVF_NPROBE = int(os.environ.get("IVF_NPROBE", "8"))
+# the index directory written by quantized_index.py, and how many candidates are re-ranked in full precision (0: no re-ranking)
+QUANTIZED_INDEX_PATH = os.environ.get("QUANTIZED_INDEX_PATH", "quantized_index")
+QUANTIZED_RERANK = int(os.environ.get("QUANTIZED_RERANK", "0"))
+# the index directory written by identity_index.py, and the default number of identities whose images are re-ranked
+IDENTITY_INDEX_PATH = os.environ.get("IDENTITY_INDEX_PATH", "identity_index")
+IDENTITY_TOP = int(os.environ.get("IDENTITY_TOP", "4"))
+
+# the neighbor images are downloaded concurrently: at most IMAGE_FETCH_WORKERS downloads run at once across all requests,
+# and a request stops waiting for its images after IMAGE_FETCH_TIMEOUT seconds
+IMAGE_FETCH_WORKERS = int(os.environ.get("IMAGE_FETCH_WORKERS", "16"))
+IMAGE_FETCH_TIMEOUT = float(os.environ.get("IMAGE_FETCH_TIMEOUT", "10"))
+
+_FETCH_EXECUTOR = ThreadPoolExecutor(max_workers=IMAGE_FETCH_WORKERS, thread_name_prefix="image-fetch")
+
+# the base64-encoded gallery images are cached in memory (IMAGE_CACHE_BYTES) and, if IMAGE_CACHE_DIR is set,
+# spilled to local disk (IMAGE_CACHE_DISK_BYTES) when evicted from memory
+IMAGE_CACHE_BYTES = int(os.environ.get("IMAGE_CACHE_BYTES", str(256 * 2**20)))
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", "")
+IMAGE_CACHE_DISK_BYTES = int(os.environ.get("IMAGE_CACHE_DISK_BYTES", str(2 * 2**30)))
+
+# the JPEG quality of the thumbnails returned when a request asks for a thumbnail_size
+THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", "80"))
+
+# images served by reference (GET /images/{id}) are streamed in chunks of IMAGE_STREAM_CHUNK_BYTES,
+# and HTTP caches may keep them for IMAGE_MAX_AGE seconds
+IMAGE_STREAM_CHUNK_BYTES = int(os.environ.get("IMAGE_STREAM_CHUNK_BYTES", str(256 * 2**10)))
+IMAGE_MAX_AGE = int(os.environ.get("IMAGE_MAX_AGE", "86400"))
+
+IMAGE_CACHE = ImageCache(IMAGE_CACHE_BYTES, disk_dir = IMAGE_CACHE_DIR, max_disk_bytes = IMAGE_CACHE_DISK_BYTES)
+
+# the DeepFace model used by /faceimage, and how its inputs are batched: a batch is run as soon as
+# EMBED_BATCH_SIZE images are waiting, or EMBED_BATCH_WAIT_MS after its first image arrived
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "VGG-Face")
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "8"))
+EMBED_BATCH_WAIT_MS = float(os.environ.get("EMBED_BATCH_WAIT_MS", "5"))
+# load the DeepFace model and run it once at startup, so that the first /faceimage request does not pay for it
+WARMUP_EMBEDDING_MODEL = os.environ.get("WARMUP_EMBEDDING_MODEL", "1") == "1"
+
+# blocking work never runs on the event loop: image decoding runs on CPU_EXECUTOR, and vector search and
+# GCS calls run on IO_EXECUTOR (the DeepFace model has its own thread, see EmbeddingBatcher)
+CPU_WORKERS = int(os.environ.get("CPU_WORKERS", str(os.cpu_count() or 1)))
+IO_WORKERS = int(os.environ.get("IO_WORKERS", "32"))
+
+CPU_EXECUTOR = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu")
+IO_EXECUTOR = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+# the outcome of the search of /embed and /faceimage requests (identity and accepted image ids; the images themselves
+# go through IMAGE_CACHE) is cached for RESULT_CACHE_TTL seconds (at most RESULT_CACHE_SIZE of them), keyed by the hash
+# of the uploaded image or of the rounded embedding; 0 disables the cache. With Vertex AI, the sync time of the
+# deployed index is re-read every INDEX_VERSION_CHECK_SECONDS, and the cache is emptied when it changes (see
+# get_index_version)
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", "300"))
+INDEX_VERSION_CHECK_SECONDS = float(os.environ.get("INDEX_VERSION_CHECK_SECONDS", "60"))
+
+RESULT_CACHE = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+# uploaded images are decoded at most MAX_IMAGE_SIDE pixels per side (JPEGs are downscaled by the decoder), which is
+# plenty for face detection; images declaring more than MAX_IMAGE_PIXELS pixels are rejected before decoding
+MAX_IMAGE_SIDE = int(os.environ.get("MAX_IMAGE_SIDE", str(preprocessing.MAX_IMAGE_SIDE)))
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", str(preprocessing.MAX_IMAGE_PIXELS)))
+
+# admission control (see admission.py): at most <STAGE>_CONCURRENCY requests run each stage at once (0: unbounded),
+# at most ADMISSION_QUEUE wait for it, and a request must be done within REQUEST_DEADLINE seconds (0: no deadline; a
+# client can ask for less with an X-Request-Timeout header, in seconds); requests that can not make it are shed with a
+# 429/503 and Retry-After. Request bodies larger than MAX_UPLOAD_BYTES (image uploads), MAX_EMBED_BYTES (/embed,
+# /embed/stream) or MAX_BATCH_BYTES (/embed_batch) are rejected with a 413 before they are read.
+DECODE_CONCURRENCY = int(os.environ.get("DECODE_CONCURRENCY", str(CPU_WORKERS)))
+EMBED_CONCURRENCY = int(os.environ.get("EMBED_CONCURRENCY", str(2 * EMBED_BATCH_SIZE)))
+SEARCH_CONCURRENCY = int(os.environ.get("SEARCH_CONCURRENCY", str(IO_WORKERS)))
+FETCH_CONCURRENCY = int(os.environ.get("FETCH_CONCURRENCY", str(IO_WORKERS)))
+ADMISSION_QUEUE = int(os.environ.get("ADMISSION_QUEUE", "64"))
+REQUEST_DEADLINE = float(os.environ.get("REQUEST_DEADLINE", "30"))
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(20 * 2**20)))
+MAX_EMBED_BYTES = int(os.environ.get("MAX_EMBED_BYTES", str(2**20)))
+# room for a full batch sent as JSON, at most 32 bytes per value
+MAX_BATCH_BYTES = int(os.environ.get("MAX_BATCH_BYTES", str(32 * MAX_BATCH_QUERIES * EMBEDDING_DIM)))
+
+LIMITERS = {
+    "decode": StageLimiter("decode", DECODE_CONCURRENCY, ADMISSION_QUEUE),
+    "embed": StageLimiter("embed", EMBED_CONCURRENCY, ADMISSION_QUEUE),
+    "search": StageLimiter("search", SEARCH_CONCURRENCY, ADMISSION_QUEUE),
+    "fetch": StageLimiter("fetch", FETCH_CONCURRENCY, ADMISSION_QUEUE),
+}
+
+# the level of the server logs (DEBUG logs every step of every request)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+
+logger = logging.getLogger(__name__)
+
+_SEARCH_INDEX = None # the loaded in-process index, when SEARCH_BACKEND is not "vertex"
+_INDEX_VERSION = None # identifies the index loaded by load_search_backend (see get_index_version)
+_DEPLOYED_INDEX_SYNC_TIME = None # the last sync time of the deployed Vertex AI index (see refresh_index_version)
+_CLIENTS = None # the shared Vertex AI / GCS clients (see start_clients)
+
 class DataPayload(BaseModel):
     data: List[Any] 
+    nprobe: Optional[int] = Field(None, ge=1) # ivf backend: overrides IVF_NPROBE for this query; identity backend: overrides IDENTITY_TOP
+    thumbnail_size: Optional[int] = Field(None, ge=16, le=4096) # if set, return JPEG thumbnails of at most this many pixels per side
+    thumbnail_quality: int = Field(THUMBNAIL_QUALITY, ge=1, le=95)
+    image_mode: Literal["inline", "reference"] = "inline" # "reference": return image URLs (see GET /images/{id}) instead of base64 images
+
+
+class BatchDataPayload(BaseModel):
+    data: List[List[float]] # one embedding per query
+    nprobe: Optional[int] = Field(None, ge=1)
 
     
 
+def get_identity(img_path):
+    # the identity index resolved the identity of every image at build time (from label_map.json); otherwise
+    # image names are "{label}_{identity}_{original file name}" (see make_dataset.py)
+
+    if isinstance(_SEARCH_INDEX, IdentityIndex):
+        return _SEARCH_INDEX.identity_of(img_path)
+
+    return img_path.split("_")[1]
+
+
 def find_most_frequent_ID(img_paths_list):
     """
     img_paths_list: is a list of image names
 
     this function returns the most frequent name in that list. 
     """
-    names_list = [img_path.split("_")[1] for img_path in img_paths_list]
+    names_list = [get_identity(img_path) for img_path in img_paths_list]
 
     counts = Counter(names_list)
 
@@ -48,10 +203,51 @@ def find_most_frequent_ID(img_paths_list):
 
 
 
+def get_index_endpoint_name():
+    return f"projects/{PROJECT_ID}/locations/{REGION}/indexEndpoints/{INDEX_ENDPOINT_ID}"
+
+
+def start_clients():
+    # create the shared clients once for the lifetime of the application (called at startup)
+    global _CLIENTS
+
+    _CLIENTS = ClientRegistry(PROJECT_ID, REGION)
+
+    # connect eagerly so that the first request does not pay for it; failures are retried on first use
+    try:
+        if BUCKET_NAME:
+            _CLIENTS.storage_client()
+        if SEARCH_BACKEND == "vertex":
+            _CLIENTS.index_endpoint(get_index_endpoint_name())
+    except Exception as e:
+        logger.warning(f"Could not create the Google Cloud clients at startup: {e}")
+
+    return _CLIENTS
+
+
+def get_clients():
+    # returns the shared client registry, creating it on first use if the startup hook did not run
+
+    if _CLIENTS is None:
+        start_clients()
+
+    return _CLIENTS
+
+
+def close_clients():
+    # release the pooled connections of the shared clients (called at shutdown)
+    global _CLIENTS
+
+    if _CLIENTS is not None:
+        _CLIENTS.close()
+        _CLIENTS = None
+
+
+
 def load_json(bucket_name, source_blob_name):
     # load a .json file from GCS
 
-    storage_client = storage.Client()
+    storage_client = get_clients().storage_client()
 
     bucket = storage_client.bucket(bucket_name)
 
@@ -64,38 +260,247 @@ def load_json(bucket_name, source_blob_name):
         # print("JSON file loaded successfully:")
         # print(data)
     except json.JSONDecodeError as e:
-        print(f"Error decoding JSON: {e}")
+        logger.error(f"Error decoding JSON: {e}")
         
     return data
 
-    
-    
-def vector_search_NN(query_vector , NUM_NEIGHBORS = 3):
-    # Perform vector search using Vertex AI's vector search engine
+
+
+
+def load_search_backend():
+    # load the in-process index once (called at startup); a no-op for the Vertex AI backend
+    global _SEARCH_INDEX, _INDEX_VERSION
+
+    _INDEX_VERSION = None
+
+    if SEARCH_BACKEND == "vertex":
+        return None
+
+    if SEARCH_BACKEND == "local":
+        logger.info(f"Loading the local search index from {LOCAL_EMBEDDINGS_PATH}...")
+        if os.path.isdir(LOCAL_EMBEDDINGS_PATH):
+            _SEARCH_INDEX = LocalExactIndex.from_npy_dir(LOCAL_EMBEDDINGS_PATH)
+        else:
+            # a gs:// file is downloaded with the shared storage client
+            storage_client = get_clients().storage_client() if LOCAL_EMBEDDINGS_PATH.startswith("gs://") else None
+            _SEARCH_INDEX = LocalExactIndex.from_jsonl(LOCAL_EMBEDDINGS_PATH, storage_client = storage_client)
+        logger.info(f"Loaded {len(_SEARCH_INDEX)} embeddings of dimension {_SEARCH_INDEX.dim}.")
+        return _SEARCH_INDEX
+
+    if SEARCH_BACKEND == "ivf":
+        logger.info(f"Loading the IVF index from {IVF_INDEX_PATH}...")
+        _SEARCH_INDEX = IVFIndex(IVF_INDEX_PATH, nprobe = IVF_NPROBE)
+        logger.info(f"Loaded {len(_SEARCH_INDEX)} embeddings in {_SEARCH_INDEX.meta['nlist']} lists.")
+        return _SEARCH_INDEX
+
+    if SEARCH_BACKEND == "quantized":
+        logger.info(f"Loading the quantized index from {QUANTIZED_INDEX_PATH}...")
+        _SEARCH_INDEX = QuantizedIndex(QUANTIZED_INDEX_PATH, rerank = QUANTIZED_RERANK)
+        logger.info(f"Loaded {len(_SEARCH_INDEX)} {_SEARCH_INDEX.kind} embeddings ({_SEARCH_INDEX.meta['quantized_bytes'] / 2**20:.2f} MB).")
+        return _SEARCH_INDEX
+
+    if SEARCH_BACKEND == "identity":
+        logger.info(f"Loading the identity index from {IDENTITY_INDEX_PATH}...")
+        _SEARCH_INDEX = IdentityIndex(IDENTITY_INDEX_PATH, top_identities = IDENTITY_TOP)
+        logger.info(f"Loaded {len(_SEARCH_INDEX)} embeddings of {_SEARCH_INDEX.meta['num_identities']} identities "
+                    f"({_SEARCH_INDEX.meta['num_prototypes']} prototypes).")
+        return _SEARCH_INDEX
+
+    raise ValueError(f"Unknown SEARCH_BACKEND: {SEARCH_BACKEND}")
+
+
+def get_index_version():
+    """
+    Identifies the index and the dataset the server answers from, and RESULT_CACHE is emptied whenever this changes:
+    the backend, the GCS dataset, and
+      - for the in-process backends, the index location and its modification time when it was loaded (the loaded
+        index does not change until it is loaded again)
+      - for Vertex AI, the time the deployed index was last synced with its index (upserts, batch updates), re-read
+        in the background by refresh_index_version
+    Does no I/O for Vertex AI, so it can be called from the event loop.
+    """
+    global _INDEX_VERSION
+
+    if _INDEX_VERSION is None:
+        if SEARCH_BACKEND == "vertex":
+            index = f"vertex:{INDEX_ENDPOINT_ID}/{DEPLOYED_INDEX_ID}@{_DEPLOYED_INDEX_SYNC_TIME}"
+        else:
+            path = {"local": LOCAL_EMBEDDINGS_PATH, "ivf": IVF_INDEX_PATH, "quantized": QUANTIZED_INDEX_PATH,
+                    "identity": IDENTITY_INDEX_PATH}.get(SEARCH_BACKEND, "")
+            if os.path.isdir(path):
+                path = os.path.join(path, "index.json" if os.path.exists(os.path.join(path, "index.json")) else "meta.json")
+            mtime = os.path.getmtime(path) if os.path.exists(path) else 0
+            index = f"{SEARCH_BACKEND}:{path}@{mtime}"
+
+        _INDEX_VERSION = f"{index}|gs://{BUCKET_NAME}/{DATASET_ADD}"
+
+    return _INDEX_VERSION
+
+
+def read_deployed_index_sync_time():
+    # the time the deployed index was last synced with its index, read from the Vertex AI API
+
+    endpoint = get_clients().refresh_index_endpoint(get_index_endpoint_name())
+    for deployed_index in endpoint.deployed_indexes:
+        if deployed_index.id == DEPLOYED_INDEX_ID:
+            return str(deployed_index.index_sync_time)
+
+    raise ValueError(f"The index {DEPLOYED_INDEX_ID} is not deployed to {get_index_endpoint_name()}")
+
+
+def refresh_index_version():
+    # re-reads the sync time of the deployed Vertex AI index (blocking, run every INDEX_VERSION_CHECK_SECONDS by the
+    # server); RESULT_CACHE is emptied on its next use if it changed. If it can not be read, the version is kept.
+    global _DEPLOYED_INDEX_SYNC_TIME, _INDEX_VERSION
+
+    try:
+        sync_time = read_deployed_index_sync_time()
+    except Exception as e:
+        logger.warning(f"Could not read the sync time of the deployed index: {e}")
+        return
+
+    if sync_time != _DEPLOYED_INDEX_SYNC_TIME:
+        logger.info(f"The deployed index was synced at {sync_time}.")
+        _DEPLOYED_INDEX_SYNC_TIME = sync_time
+        _INDEX_VERSION = None
+
+
+def get_cached_result(key):
+    # the cached (identity, img_paths_list) of identify_embedding for key, or None; a cache filled from another index
+    # or dataset is emptied first
+
+    RESULT_CACHE.ensure_version(get_index_version())
+    return RESULT_CACHE.get(key)
+
+
+def cache_result(key, identified):
+    # identified: the (identity, img_paths_list) returned by identify_embedding
+
+    most_frequent_name, img_paths_list = identified
+    RESULT_CACHE.put(key, (most_frequent_name, tuple(img_paths_list)))
+
+
+def get_search_index():
+    # returns the in-process index, loading it on first use if the startup hook did not run
+
+    if _SEARCH_INDEX is None:
+        load_search_backend()
+
+    return _SEARCH_INDEX
+
+
+@timed("search")
+def vector_search_NN(query_vector , NUM_NEIGHBORS = 3, nprobe = None):
+    # Perform the nearest neighbor search with the configured backend (see SEARCH_BACKEND)
     # query_vector: a list containing the embd like [0,0.01,...]
     # NUM_NEIGHBORS: number of nearest neighbors to retrieve
+    # nprobe: number of inverted lists to scan (ivf backend, None means IVF_NPROBE), or of identities to re-rank
+    # (identity backend, None means IDENTITY_TOP)
+
+    if SEARCH_BACKEND == "vertex":
+        return vertex_search_NN(query_vector, NUM_NEIGHBORS = NUM_NEIGHBORS)
+
+    logger.debug("Searching for %d neighbors in the %s index...", NUM_NEIGHBORS, SEARCH_BACKEND)
+
+    search_index = get_search_index()
+    if SEARCH_BACKEND == "ivf":
+        list_neighbors = search_index.search(query_vector, NUM_NEIGHBORS, nprobe = nprobe)
+    elif SEARCH_BACKEND == "identity":
+        list_neighbors = search_index.search(query_vector, NUM_NEIGHBORS, top_identities = nprobe)
+    else:
+        list_neighbors = search_index.search(query_vector, NUM_NEIGHBORS)
+
+    if not list_neighbors:
+        logger.debug("No neighbors found.")
+        return None
+
+    logger.debug("Found %d neighbors.", len(list_neighbors))
+    return list_neighbors
+
+
+def get_embedding_dim():
+    # the dimension queries must have: the one of the loaded index, or EMBEDDING_DIM for Vertex AI
+
+    if SEARCH_BACKEND == "vertex":
+        return EMBEDDING_DIM
+
+    return get_search_index().dim
+
+
+def parse_binary_embedding(body, content_type):
+    # view the raw bytes of a binary /embed body as a float32 vector (no copy for float32 bodies)
+
+    dtype = BINARY_EMBEDDING_TYPES[content_type]
+    if len(body) % dtype.itemsize:
+        raise ValueError(f"The body has {len(body)} bytes, which is not a whole number of {dtype.name} values")
 
-    index_endpoint_name = f"projects/{PROJECT_ID}/locations/{REGION}/indexEndpoints/{INDEX_ENDPOINT_ID}"
+    return np.frombuffer(body, dtype=dtype).astype(np.float32, copy=False)
 
-    # Initialize the Vertex AI SDK
-    aiplatform.init(project=PROJECT_ID, location=REGION)
 
-    my_index_endpoint = aiplatform.MatchingEngineIndexEndpoint(index_endpoint_name=index_endpoint_name)
+def check_embedding(img_embd):
+    # converts a query embedding to a float32 vector and checks its dimension against the index, once per query
+
+    try:
+        query = np.asarray(img_embd, dtype=np.float32).reshape(-1)
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"The embedding must be a list of numbers: {e}")
+
+    dim = get_embedding_dim()
+    if query.shape[0] != dim:
+        raise HTTPException(status_code=400, detail=f"The embedding has dimension {query.shape[0]}, expected {dim}")
+
+    return query
+
+
+@timed("search")
+def vector_search_NN_batch(query_vectors, NUM_NEIGHBORS = 3, nprobe = None):
+    # Perform one multi-query nearest neighbor search with the configured backend
+    # query_vectors: a list of embeddings (or a (num_queries, dim) array)
+    # returns one list of (id, distance) tuples per query (empty if nothing was found)
+
+    logger.debug("Searching for %d neighbors of %d queries in the %s index...", NUM_NEIGHBORS, len(query_vectors), SEARCH_BACKEND)
+
+    if SEARCH_BACKEND == "vertex":
+        my_index_endpoint = get_clients().index_endpoint(get_index_endpoint_name())
+
+        response = my_index_endpoint.find_neighbors(
+            queries=np.asarray(query_vectors, dtype=np.float32).tolist(),
+            deployed_index_id=DEPLOYED_INDEX_ID,
+            num_neighbors=NUM_NEIGHBORS
+            )
+
+        return [[(neighbor.id, neighbor.distance) for neighbor in neighbors] for neighbors in (response or [])]
+
+    search_index = get_search_index()
+    if SEARCH_BACKEND == "ivf":
+        return search_index.search_batch(query_vectors, NUM_NEIGHBORS, nprobe = nprobe)
+    if SEARCH_BACKEND == "identity":
+        return search_index.search_batch(query_vectors, NUM_NEIGHBORS, top_identities = nprobe)
+
+    return search_index.search_batch(query_vectors, NUM_NEIGHBORS)
+
+
+def vertex_search_NN(query_vector , NUM_NEIGHBORS = 3):
+    # Perform vector search using Vertex AI's vector search engine
+    # query_vector: a list containing the embd like [0,0.01,...]
+    # NUM_NEIGHBORS: number of nearest neighbors to retrieve
+
+    my_index_endpoint = get_clients().index_endpoint(get_index_endpoint_name())
     
     
-    print(f"Searching for {NUM_NEIGHBORS} neighbors...")
+    logger.debug("Searching for %d neighbors...", NUM_NEIGHBORS)
 
     try:
         response = my_index_endpoint.find_neighbors(
-            queries=[query_vector],                
+            queries=[np.asarray(query_vector, dtype=np.float32).tolist()],                
             deployed_index_id=DEPLOYED_INDEX_ID, 
             num_neighbors=NUM_NEIGHBORS
             )
 
-        print("Search completed.")
+        logger.debug("Search completed.")
 
         if response and response[0]: # response is a list of lists of neighbors (one list per query)
-            print(f"Found {len(response[0])} neighbors:")
+            logger.debug("Found %d neighbors.", len(response[0]))
             
             list_neighbors = []
             for neighbor in response[0]:
@@ -107,158 +512,452 @@ def vector_search_NN(query_vector , NUM_NEIGHBORS = 3):
             return list_neighbors
                 
         else:
-            print("No neighbors found or empty response.")
+            logger.debug("No neighbors found or empty response.")
             return None
 
     except Exception as e:
-        print(f"An error occurred during the search: {e}")
+        # raised, not answered as "no neighbors": a failed search must not be cached as an unidentified query
+        logger.error(f"An error occurred during the search: {e}")
+        raise
 
 
 
-def Pil_to_array(image_pil):
-    # make the image in the compatible format to be passed to DeepFace
+async def run_blocking(executor, func, *args, **kwargs):
+    # run a blocking function on one of the executors and await its result from the event loop
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args, **kwargs))
 
-    # Convert the Pillow image to a NumPy array
-    image_np_rgb = np.array(image_pil)
 
-    # Extract the individual color channels (R, G, B)
-    red_channel = image_np_rgb[:, :, 0]
-    green_channel = image_np_rgb[:, :, 1]
-    blue_channel = image_np_rgb[:, :, 2]
+def shutdown_executors():
+    for executor in (CPU_EXECUTOR, IO_EXECUTOR, _FETCH_EXECUTOR):
+        executor.shutdown(wait=False, cancel_futures=True)
 
-    # Stack the channels in BGR order
-    return np.stack([blue_channel, green_channel, red_channel], axis=-1)
+
+@timed("decode")
+def decode_image(contents):
+    # decode the uploaded bytes into a Pillow image of at most MAX_IMAGE_SIDE pixels per side (see preprocessing.py)
+    return preprocessing.decode_image(contents, max_side = MAX_IMAGE_SIDE, max_pixels = MAX_IMAGE_PIXELS)
+
+
+@timed("to_array")
+def Pil_to_array(image_pil):
+    # make the image in the compatible format to be passed to DeepFace (a read-only BGR array, one copy of the pixels)
+    return preprocessing.to_bgr_array(image_pil)
 
 
 def generate_img_embedding(img_pil):
     from deepface import DeepFace
     # given an img_pil, it generates it's embedding
     
-    img_array = Pil_to_array(image_pil)
+    img_array = Pil_to_array(img_pil)
 
-    embd = DeepFace.represent(img_array)[0]['embedding']
+    embd = DeepFace.represent(img_array, model_name=EMBEDDING_MODEL)[0]['embedding']
 
     return embd
 
 
+@timed("embed_batch")
+def represent_images(img_arrays):
+    """
+    Embeds a batch of BGR image arrays with one DeepFace call (face detection and representation).
 
-def get_encoded_images_from_paths(paths):
+    Returns a list with, for every image, its embedding or the exception raised for it. If the batched call
+    fails (e.g. no face in one of the images, or a DeepFace version without batch support), the images
+    are embedded one by one so that a single bad image does not fail the others.
+    """
+    from deepface import DeepFace
+
+    if len(img_arrays) > 1:
+        try:
+            results = DeepFace.represent(list(img_arrays), model_name=EMBEDDING_MODEL)
+
+            # one list of detected faces per image
+            if len(results) == len(img_arrays) and all(isinstance(faces, list) and faces for faces in results):
+                return [faces[0]['embedding'] for faces in results]
+
+        except Exception as e:
+            logger.warning(f"Batched embedding of {len(img_arrays)} images failed, embedding them one by one: {e}")
+
+    embeddings = []
+    for img_array in img_arrays:
+        try:
+            embeddings.append(DeepFace.represent(img_array, model_name=EMBEDDING_MODEL)[0]['embedding'])
+        except Exception as e:
+            embeddings.append(e)
+
+    return embeddings
+
+
+def warm_up_embedding_model():
+    # build the DeepFace model and run one inference so that its graph is ready before the first request
+
+    from deepface import DeepFace
+
+    start_time = time.perf_counter()
+
+    DeepFace.build_model(EMBEDDING_MODEL)
+    DeepFace.represent(np.zeros((224, 224, 3), dtype=np.uint8), model_name=EMBEDDING_MODEL, enforce_detection=False)
+
+    logger.info(f"Warmed up the {EMBEDDING_MODEL} model in {time.perf_counter() - start_time:.2f} s.")
+
+
+EMBEDDING_BATCHER = EmbeddingBatcher(represent_images, max_batch_size = EMBED_BATCH_SIZE, max_wait_ms = EMBED_BATCH_WAIT_MS,
+                                     max_queue = max(EMBED_CONCURRENCY, 0))
+
+
+
+@timed("fetch_images")
+def get_encoded_images_from_paths(paths, thumbnail_size = None, thumbnail_quality = THUMBNAIL_QUALITY):
     """
     Encodes a list of image files specified by their paths into base64 strings.
+    The images are downloaded concurrently; the order of paths is preserved and images that fail
+    (or are not ready within IMAGE_FETCH_TIMEOUT seconds) are skipped.
 
     paths (List[str]): A list of paths to image files.
+    thumbnail_size (int): if set, encode JPEG thumbnails of at most thumbnail_size pixels per side instead of the originals.
 
     """
+    IMAGE_CACHE.ensure_namespace(f"{BUCKET_NAME}/{DATASET_ADD}")
+
+    futures = [_FETCH_EXECUTOR.submit(encode_image_to_base64, BUCKET_NAME, DATASET_ADD + img_path, thumbnail_size, thumbnail_quality)
+               for img_path in paths]
+
+    done, not_done = wait(futures, timeout=IMAGE_FETCH_TIMEOUT)
+    for future in not_done:
+        future.cancel()
+
     encoded_images: List[str] = []
-    for img_path in paths:
-        encoded_img = encode_image_to_base64(BUCKET_NAME , DATASET_ADD + img_path)
+    for img_path, future in zip(paths, futures):
+        encoded_img = future.result() if future in done and future.exception() is None else None
         if encoded_img:
             encoded_images.append(encoded_img)
         else:
             # Log or handle missing files if needed
-            print(f"Failed to load or encode image for return: {img_path}")
+            logger.warning(f"Failed to load or encode image for return: {img_path}")
     return encoded_images
 
 
-def encode_image_to_base64(bucket_name, blob_name):
+def make_thumbnail(image_bytes, thumbnail_size, thumbnail_quality = THUMBNAIL_QUALITY):
+    # returns the bytes of a JPEG copy of the image that fits in a thumbnail_size x thumbnail_size box
+
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft("RGB", (thumbnail_size, thumbnail_size)) # let the JPEG decoder downscale while decoding
+    image = image.convert("RGB")
+    image.thumbnail((thumbnail_size, thumbnail_size))
+
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=thumbnail_quality, optimize=True)
+
+    return output.getvalue()
+
+
+def encode_image_to_base64(bucket_name, blob_name, thumbnail_size = None, thumbnail_quality = THUMBNAIL_QUALITY):
     """
     Reads an image file (local or from Google Cloud Storage) and encodes it into a base64 string.
+    If thumbnail_size is set, a JPEG thumbnail of the image is encoded instead of the original.
 
     Returns str of the base64 encoded string of the image, otherwise None if the file doesn't exist or an error occurs.
+    Encoded images (and thumbnails) are kept in IMAGE_CACHE, so repeated hits skip the download, resizing and encoding.
     """
+    cache_key = f"{bucket_name}/{blob_name}"
+    if thumbnail_size:
+        cache_key += f"?thumbnail={thumbnail_size}&quality={thumbnail_quality}"
+
+    encoded_string = IMAGE_CACHE.get(cache_key)
+    if encoded_string is not None:
+        return encoded_string
+
     try:
-        client = storage.Client()
+        client = get_clients().storage_client()
 
         bucket = client.bucket(bucket_name)
         blob = bucket.blob(blob_name)
 
-        image_bytes = blob.download_as_bytes()
+        with stage("fetch"):
+            image_bytes = blob.download_as_bytes()
 
-        encoded_bytes = base64.b64encode(image_bytes)
-        encoded_string = encoded_bytes.decode('utf-8')
+        if thumbnail_size:
+            with stage("thumbnail"):
+                image_bytes = make_thumbnail(image_bytes, thumbnail_size, thumbnail_quality)
+
+        with stage("base64"):
+            encoded_bytes = base64.b64encode(image_bytes)
+            encoded_string = encoded_bytes.decode('utf-8')
+
+        IMAGE_CACHE.put(cache_key, encoded_string)
         
         return encoded_string
 
     except Exception as e:
-        print(f"Error encoding image from GCS {bucket_name}/{blob_name}: {e}")
+        logger.error(f"Error encoding image from GCS {bucket_name}/{blob_name}: {e}")
         return None
 
 
 
 
-def handle_embedding(img_embd):
-    # This function recieves an image embedding, performs vector search, and returns the results.
+def get_image_urls(paths, thumbnail_size = None, thumbnail_quality = THUMBNAIL_QUALITY):
+    # the (server-relative) URLs of the GET /images/{id} endpoint for the given image ids
+
+    query = ""
+    if thumbnail_size:
+        query = "?" + urlencode({"thumbnail_size": thumbnail_size, "thumbnail_quality": thumbnail_quality})
+
+    return [f"/images/{quote(img_path)}{query}" for img_path in paths]
+
 
+def get_image_blob(image_id):
+    # returns the GCS blob (with its metadata loaded) of a gallery image, or None if it does not exist
+
+    client = get_clients().storage_client()
+
+    return client.bucket(BUCKET_NAME).get_blob(DATASET_ADD + image_id)
+
+
+def iter_blob_chunks(blob, chunk_size = IMAGE_STREAM_CHUNK_BYTES):
+    # streams the content of a blob without holding all of it in memory
+
+    with blob.open("rb", chunk_size=chunk_size) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+UNIDENTIFIED_MESSAGE = "⚠️ The image query can not be identified!"
+IDENTIFIED_MESSAGE = "✅ The image query uccessfully identified!"
+
+
+def identify_embedding(img_embd, nprobe = None):
+    """
+    Performs the vector search and the identity vote for an image embedding, without fetching any image.
+
+    Returns (identity, img_paths_list): the identity is None if the query can not be identified, otherwise
+    img_paths_list holds the accepted neighbors (the images to return).
+    nprobe: optional per-request recall/latency trade-off of the ivf and identity backends
+    """
 
     # Perform vector search using Vector AI's search engine
     try:
-        nearest_neighbor_list = vector_search_NN(img_embd , NUM_NEIGHBORS = NUM_NEIGHBORS)
+        nearest_neighbor_list = vector_search_NN(img_embd , NUM_NEIGHBORS = NUM_NEIGHBORS, nprobe = nprobe)
 
     except Exception as e:
-        print(f"Error in Vector search. Err: {e}")
+        logger.error(f"Error in Vector search. Err: {e}")
         raise HTTPException(status_code=500, detail=f"CError in Vector search: {e}")
 
 
     if nearest_neighbor_list is None:
-        return {
-        "message": "⚠️ The image query can not be identified!",
-        "returned_images": [], 
-        "code": 0,
-        "identity": "Unknown"
-    }
+        return None, []
 
 
     # retrieve the path of the actual images from GCS based on the search result
-    print("The initial candidates: ", nearest_neighbor_list)
-    
-    img_paths_list = []
+    logger.debug("The initial candidates: %s", nearest_neighbor_list)
     
-    for n in nearest_neighbor_list:
+    # threshold and identity vote
+    with stage("vote"):
+        img_paths_list = []
+        
+        for n in nearest_neighbor_list:
 
-        if n[1]>= 0.25: # the threshold used by the embedding model (VGG)
-            img_paths_list.append(n[0])
-        else:
-            print("This retrieved image not selected: ", n)
+            if n[1]>= SIMILARITY_THRESHOLD: # the threshold used by the embedding model (VGG)
+                img_paths_list.append(n[0])
+            else:
+                logger.debug("This retrieved image not selected: %s", n)
+
+        if img_paths_list:
+            try:
+                most_frequent_name, freq = find_most_frequent_ID(img_paths_list)
+
+            except Exception as e:
+                logger.error(f"Error in finding the most frequent ID. Err: {e}")
+                raise HTTPException(status_code=500, detail=f"Error in finding the most frequent ID. Err: {e}")
 
     
     if len(img_paths_list)<1: # all rejected 
-            return {
-        "message": "⚠️ The image query can not be identified!",
-        "returned_images": [], 
-        "code": 0,
-        "identity": "Unknown"
-    }
+        return None, []
 
 
+    logger.debug("Most frequent name: %s, freq: %d", most_frequent_name, freq)
 
-    try:
-        most_frequent_name, freq = find_most_frequent_ID(img_paths_list)
 
-        print(f"Most frequent name: {most_frequent_name}, freq: {freq}")
+    if freq < math.ceil(NUM_NEIGHBORS/2): # the fraction of accepted images is too low
+        return None, []
 
+    return most_frequent_name, img_paths_list
 
-        if freq < math.ceil(NUM_NEIGHBORS/2): # the fraction of accepted images is too low
-            return {
-        "message": "⚠️ The image query can not be identified!",
-        "returned_images": [], 
-        "code": 0,
-        "identity": "Unknown"}
 
+def handle_embedding(img_embd, nprobe = None, thumbnail_size = None, thumbnail_quality = THUMBNAIL_QUALITY, image_mode = "inline"):
+    # This function recieves an image embedding, performs vector search, and returns the results.
+    # nprobe: optional per-request recall/latency trade-off of the ivf and identity backends
+    # thumbnail_size, thumbnail_quality: if thumbnail_size is set, return resized JPEG previews instead of the originals
+    # image_mode: "inline" returns the images as base64 strings, "reference" returns their ids and URLs only
 
-    except Exception as e:
-        print(f"Error in finding the most frequent ID. Err: {e}")
-        raise HTTPException(status_code=500, detail=f"Error in finding the most frequent ID. Err: {e}")
+    most_frequent_name, img_paths_list = identify_embedding(img_embd, nprobe = nprobe)
 
+    return build_result(most_frequent_name, img_paths_list, thumbnail_size = thumbnail_size,
+                        thumbnail_quality = thumbnail_quality, image_mode = image_mode)
+
+
+def build_result(most_frequent_name, img_paths_list, thumbnail_size = None, thumbnail_quality = THUMBNAIL_QUALITY, image_mode = "inline"):
+    # the response of handle_embedding for the outcome of identify_embedding (fetches the images in the "inline" mode)
+
+    if most_frequent_name is None:
+        return {
+        "message": UNIDENTIFIED_MESSAGE,
+        "returned_images": [], 
+        "code": 0,
+        "identity": "Unknown"
+    }
 
 
     # Return a success response
-    print(f"Encoding images to return...")
-    returned_images = get_encoded_images_from_paths(img_paths_list)
-    print(f"Prepared {len(returned_images)} images to return.")
+    if image_mode == "reference":
+        return {
+            "message": IDENTIFIED_MESSAGE,
+            "returned_images": [],
+            "returned_image_ids": img_paths_list,
+            "returned_image_urls": get_image_urls(img_paths_list, thumbnail_size = thumbnail_size, thumbnail_quality = thumbnail_quality),
+            "code": 1,
+            "identity": most_frequent_name
+        }
+
+    logger.debug("Encoding images to return...")
+    returned_images = get_encoded_images_from_paths(img_paths_list, thumbnail_size = thumbnail_size, thumbnail_quality = thumbnail_quality)
+    logger.debug("Prepared %d images to return.", len(returned_images))
 
     return {
-        "message": "✅ The image query uccessfully identified!",
+        "message": IDENTIFIED_MESSAGE,
         "returned_images": returned_images, 
         "code": 1,
         "identity": most_frequent_name
     }
+
+
+async def iter_result_events(most_frequent_name, img_paths_list, thumbnail_size = None, thumbnail_quality = THUMBNAIL_QUALITY,
+                             image_mode = "inline"):
+    """
+    The streamed (NDJSON) form of a handle_embedding result, one JSON object per line:
+      {"event": "identity", "message", "code", "identity", "returned_image_ids"[, "returned_image_urls"]}
+          as soon as the vote is done
+      {"event": "image", "index", "id", "image"}
+          for every image, in the order their downloads complete (index is the position in returned_image_ids)
+      {"event": "done", "returned", "missing"}
+          once every image was sent, failed, or IMAGE_FETCH_TIMEOUT expired (missing lists the ids not sent)
+    The images are fetched holding a slot of the fetch stage, like the ones of build_result; if the stage sheds the
+    request (see admission.py), no image is sent and all of them are listed as missing.
+    In the "reference" image mode the identity event carries the image URLs, and no image events are sent.
+    """
+    identified = most_frequent_name is not None
+
+    identity_event = {
+        "event": "identity",
+        "message": IDENTIFIED_MESSAGE if identified else UNIDENTIFIED_MESSAGE,
+        "code": 1 if identified else 0,
+        "identity": most_frequent_name if identified else "Unknown",
+        "returned_image_ids": img_paths_list,
+    }
+    if image_mode == "reference":
+        identity_event["returned_image_urls"] = get_image_urls(img_paths_list, thumbnail_size = thumbnail_size,
+                                                               thumbnail_quality = thumbnail_quality)
+    yield json.dumps(identity_event) + "\n"
+
+    if image_mode == "reference" or not img_paths_list:
+        yield json.dumps({"event": "done", "returned": 0, "missing": []}) + "\n"
+        return
+
+    IMAGE_CACHE.ensure_namespace(f"{BUCKET_NAME}/{DATASET_ADD}")
+
+    async def fetch(index, img_path):
+        encoded_img = await asyncio.wrap_future(_FETCH_EXECUTOR.submit(encode_image_to_base64, BUCKET_NAME, DATASET_ADD + img_path,
+                                                                       thumbnail_size, thumbnail_quality))
+        return index, img_path, encoded_img
+
+    missing = set(img_paths_list)
+    try:
+        async with LIMITERS["fetch"].slot():
+            tasks = [asyncio.ensure_future(fetch(index, img_path)) for index, img_path in enumerate(img_paths_list)]
+            try:
+                for next_done in asyncio.as_completed(tasks, timeout=IMAGE_FETCH_TIMEOUT):
+                    index, img_path, encoded_img = await next_done
+                    if encoded_img is None:
+                        logger.warning(f"Failed to load or encode image for return: {img_path}")
+                        continue
+                    missing.discard(img_path)
+                    yield json.dumps({"event": "image", "index": index, "id": img_path, "image": encoded_img}) + "\n"
+
+            except asyncio.TimeoutError:
+                logger.warning(f"Gave up on {len(missing)} images after {IMAGE_FETCH_TIMEOUT} s.")
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    except Overloaded as e:
+        logger.warning(f"Did not fetch {len(missing)} images: {e.detail}")
+
+    yield json.dumps({"event": "done", "returned": len(img_paths_list) - len(missing),
+                      "missing": [img_path for img_path in img_paths_list if img_path in missing]}) + "\n"
+
+
+
+def handle_embedding_batch(img_embds, nprobe = None):
+    """
+    Identifies many embeddings with one multi-query vector search.
+
+    The threshold filtering and the identity vote of handle_embedding are applied to the whole batch at once,
+    on (num_queries, NUM_NEIGHBORS) arrays. No images are returned, only the ids of the accepted neighbors.
+    """
+    try:
+        batch_neighbors = vector_search_NN_batch(img_embds, NUM_NEIGHBORS = NUM_NEIGHBORS, nprobe = nprobe)
+
+    except Exception as e:
+        logger.error(f"Error in Vector search. Err: {e}")
+        raise HTTPException(status_code=500, detail=f"Error in Vector search: {e}")
+
+    # threshold and identity vote, for the whole batch
+    with stage("vote"):
+        num_queries = len(img_embds)
+        batch_neighbors = list(batch_neighbors) + [[]] * (num_queries - len(batch_neighbors))
+
+        # (num_queries, NUM_NEIGHBORS) arrays of scores and identity codes; missing neighbors get a score of -inf
+        scores = np.full((num_queries, NUM_NEIGHBORS), -np.inf, dtype=np.float32)
+        identity_codes = np.zeros((num_queries, NUM_NEIGHBORS), dtype=np.int64)
+        identities = {} # identity name -> code, each distinct neighbor id is parsed once per batch
+        codes_of_ids = {}
+
+        for row, neighbors in enumerate(batch_neighbors):
+            for col, (neighbor_id, distance) in enumerate(neighbors[:NUM_NEIGHBORS]):
+                scores[row, col] = distance
+                if neighbor_id not in codes_of_ids:
+                    codes_of_ids[neighbor_id] = identities.setdefault(get_identity(neighbor_id), len(identities))
+                identity_codes[row, col] = codes_of_ids[neighbor_id]
+
+        accepted = scores >= SIMILARITY_THRESHOLD
+
+        # vote: count the accepted neighbors of every identity, per query
+        votes = np.zeros((num_queries, max(len(identities), 1)), dtype=np.int64)
+        rows = np.broadcast_to(np.arange(num_queries)[:, None], accepted.shape)
+        np.add.at(votes, (rows[accepted], identity_codes[accepted]), 1)
+
+        best_codes = np.argmax(votes, axis=1)
+        best_freqs = votes[np.arange(num_queries), best_codes]
+        identified = best_freqs >= math.ceil(NUM_NEIGHBORS/2)
+
+    names = list(identities)
+    results = []
+    for row in range(num_queries):
+        if not identified[row]:
+            results.append({
+                "message": UNIDENTIFIED_MESSAGE,
+                "returned_image_ids": [],
+                "code": 0,
+                "identity": "Unknown"})
+            continue
+
+        results.append({
+            "message": IDENTIFIED_MESSAGE,
+            "returned_image_ids": [neighbor_id for (neighbor_id, _), ok in zip(batch_neighbors[row], accepted[row]) if ok],
+            "code": 1,
+            "identity": names[best_codes[row]]})
+
+    logger.debug("Identified %d out of %d queries.", int(identified.sum()), num_queries)
+
+    return {"results": results}
@@ -0,0 +1,74 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "server"))
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks"))
+
+# the configuration of utils.py is read from the environment when it is imported, so it is set before any test module
+# imports the server
+os.environ.update(NO_GCE_CHECK="True", WARMUP_EMBEDDING_MODEL="0", SEARCH_BACKEND="vertex", LOG_LEVEL="WARNING",
+                  RESULT_CACHE_SIZE="0", EMBEDDING_DIM="64")
+
+import fakes
+
+
+
+# Shared fixtures: a small clustered gallery, and the FastAPI app served in-process (TestClient) against the stand-ins
+# of benchmarks/fakes.py, like benchmarks/bench_server.py does.
+
+GALLERY_DIM = 64
+
+
+def make_gallery(num_identities = 20, images_per_identity = 10, dim = GALLERY_DIM, noise = 0.5, seed = 0):
+    # (ids, matrix, centroids): one cluster of embeddings per identity, ids named like the images of make_dataset.py
+
+    rng = np.random.default_rng(seed)
+    centroids = rng.standard_normal((num_identities, dim)).astype(np.float32)
+    centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+
+    labels = np.repeat(np.arange(num_identities), images_per_identity)
+    matrix = centroids[labels] + np.float32(noise / np.sqrt(dim)) * rng.standard_normal((labels.shape[0], dim), dtype=np.float32)
+    ids = [f"{label}_person{label}_{i % images_per_identity}.jpg" for i, label in enumerate(labels)]
+
+    return ids, matrix, centroids
+
+
+def recall_at(index_results, exact_results):
+    # the fraction of the exact neighbors found by the index, over a list of queries
+
+    found = sum(len({i for i, _ in exact} & {i for i, _ in approximate}) for approximate, exact in zip(index_results, exact_results))
+    return found / sum(len(exact) for exact in exact_results)
+
+
+@pytest.fixture(scope="session")
+def gallery():
+    return make_gallery()
+
+
+@pytest.fixture(scope="session")
+def api(tmp_path_factory):
+    # a TestClient of server.app, with the Vertex AI index, GCS and DeepFace replaced by the stand-ins of fakes.py
+
+    from fastapi.testclient import TestClient
+
+    gallery_dir = str(tmp_path_factory.mktemp("gallery"))
+    ids, matrix, centroids = fakes.build_gallery(gallery_dir, num_identities = 5, images_per_identity = 4, dim = GALLERY_DIM,
+                                                 image_size = 32)
+    sys.modules["deepface"] = fakes.make_fake_deepface(centroids)
+
+    import utils
+    import server
+
+    storage_client = fakes.LocalStorageClient(gallery_dir)
+    index_endpoint = fakes.FakeIndexEndpoint(ids, matrix)
+    utils.ClientRegistry = lambda project_id, region: fakes.FakeClientRegistry(storage_client, index_endpoint)
+    for module in (utils, server):
+        module.BUCKET_NAME = "test"
+        module.DATASET_ADD = ""
+
+    with TestClient(server.app) as client:
+        client.centroids = centroids
+        yield client
@@ -0,0 +1,164 @@
+import json
+import asyncio
+import numpy as np
+import pytest
+
+import utils
+from admission import StageLimiter, Overloaded, set_deadline, current_deadline
+
+
+
+def saturated_limiter(name, queue_full = False, service_time = 0.0):
+    # a limiter whose only slot is taken (and whose queue is full), with the given recent service time
+
+    limiter = StageLimiter(name, 1, 1)
+    limiter._in_service = 1
+    limiter._waiting = 1 if queue_full else 0
+    limiter._service_time = service_time
+    return limiter
+
+
+def run_with_held_slot(limiter, scenario):
+    # runs scenario() while another request holds the only slot of limiter
+
+    async def main():
+        held = asyncio.Event()
+        release = asyncio.Event()
+
+        async def hold():
+            async with limiter.slot():
+                held.set()
+                await release.wait()
+
+        holder = asyncio.ensure_future(hold())
+        await held.wait()
+        try:
+            return await scenario()
+        finally:
+            release.set()
+            await holder
+
+    return asyncio.run(main())
+
+
+def test_full_queue_is_shed_with_429():
+    limiter = StageLimiter("search", 1, 1)
+
+    async def scenario():
+        async def queued():
+            async with limiter.slot():
+                pass
+
+        waiter = asyncio.ensure_future(queued())
+        await asyncio.sleep(0)
+        assert limiter.stats()["waiting"] == 1
+
+        try:
+            with pytest.raises(Overloaded) as e:
+                async with limiter.slot():
+                    pass
+        finally:
+            waiter.cancel()
+        return e.value
+
+    error = run_with_held_slot(limiter, scenario)
+
+    assert error.status_code == 429
+    assert int(error.headers["Retry-After"]) >= 1
+    assert limiter.stats()["shed"] == {"queue_full": 1, "deadline": 0}
+
+
+def test_deadline_reached_while_waiting_is_shed_with_503():
+    limiter = StageLimiter("search", 1, 4)
+
+    async def scenario():
+        with set_deadline(0.05), pytest.raises(Overloaded) as e:
+            async with limiter.slot():
+                pass
+        return e.value
+
+    error = run_with_held_slot(limiter, scenario)
+
+    assert error.status_code == 503
+    assert "Retry-After" in error.headers
+    assert limiter.stats()["shed"]["deadline"] == 1
+
+
+def test_expected_wait_beyond_the_deadline_is_shed_without_waiting():
+    limiter = saturated_limiter("search", service_time = 10.0)
+
+    with set_deadline(1.0), pytest.raises(Overloaded) as e:
+        limiter.check()
+
+    assert e.value.status_code == 503
+    assert e.value.headers["Retry-After"] == "10"
+
+
+def test_zero_timeout_is_a_deadline():
+    with set_deadline(0):
+        assert current_deadline() is not None
+    with set_deadline(None):
+        assert current_deadline() is None
+
+
+@pytest.mark.parametrize("header, expected", [("2.5", 2.5), ("1000", utils.REQUEST_DEADLINE), ("0", utils.REQUEST_DEADLINE),
+                                              ("-1", utils.REQUEST_DEADLINE), ("nan", utils.REQUEST_DEADLINE),
+                                              ("inf", utils.REQUEST_DEADLINE), ("abc", utils.REQUEST_DEADLINE)])
+def test_only_a_positive_finite_header_shortens_the_deadline(header, expected):
+    import server
+
+    class FakeRequest:
+        headers = {"x-request-timeout": header}
+
+    assert server.request_timeout(FakeRequest()) == expected
+
+
+@pytest.mark.parametrize("header, status_code", [("1", 503), ("-1", 200), ("0", 200), ("nan", 200), ("abc", 200)])
+def test_api_sheds_searches_that_can_not_make_the_deadline(api, monkeypatch, header, status_code):
+    monkeypatch.setitem(utils.LIMITERS, "search", saturated_limiter("search", service_time = 10.0))
+
+    response = api.post("/embed", json={"data": api.centroids[0].tolist(), "image_mode": "reference"},
+                        headers={"X-Request-Timeout": header})
+
+    assert response.status_code == status_code
+    if status_code == 503:
+        assert response.headers["Retry-After"] == "10"
+
+
+def test_api_sheds_uploads_before_reading_them(api, monkeypatch):
+    monkeypatch.setitem(utils.LIMITERS, "decode", saturated_limiter("decode", queue_full = True))
+
+    response = api.post("/faceimage", files={"file": ("face.jpg", b"not read")})
+
+    assert response.status_code == 429
+    assert "Retry-After" in response.headers
+
+
+@pytest.mark.parametrize("path, max_bytes", [("/faceimage", utils.MAX_UPLOAD_BYTES), ("/faceimage/stream", utils.MAX_UPLOAD_BYTES),
+                                             ("/embed", utils.MAX_EMBED_BYTES), ("/embed/stream", utils.MAX_EMBED_BYTES),
+                                             ("/embed_batch", utils.MAX_BATCH_BYTES)])
+def test_api_rejects_oversized_bodies(api, path, max_bytes):
+    response = api.post(path, content=b"0" * (max_bytes + 1), headers={"Content-Type": "application/json"})
+
+    assert response.status_code == 413
+
+
+def test_api_accepts_bodies_within_the_limit(api):
+    embedding = np.asarray(api.centroids[0], dtype='<f4')
+
+    assert api.post("/embed", content=embedding.tobytes(), params={"image_mode": "reference"},
+                    headers={"Content-Type": "application/x-float32"}).status_code == 200
+    assert api.post("/embed_batch", json={"data": [embedding.tolist()] * 4}).status_code == 200
+
+
+def test_stream_images_are_fetched_under_the_fetch_limiter(api, monkeypatch):
+    monkeypatch.setitem(utils.LIMITERS, "fetch", saturated_limiter("fetch", queue_full = True))
+
+    response = api.post("/embed/stream", json={"data": api.centroids[0].tolist(), "image_mode": "inline"})
+    events = [json.loads(line) for line in response.text.splitlines()]
+
+    assert response.status_code == 200
+    assert [event["event"] for event in events] == ["identity", "done"]
+    assert events[-1]["returned"] == 0
+    assert events[-1]["missing"] == events[0]["returned_image_ids"]
+    assert utils.LIMITERS["fetch"].stats()["shed"]["queue_full"] == 1
@@ -0,0 +1,98 @@
+import os
+import sys
+import json
+import numpy as np
+import pytest
+
+from conftest import ROOT_DIR
+
+sys.path.insert(0, ROOT_DIR)
+import create_embeddings
+
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    # a dataset folder of three images, and the manifest records of a run that embedded them
+
+    records = []
+    for name, status in (("0_person0_0.jpg", "ok"), ("0_person0_1.jpg", "failed"), ("1_person1_0.jpg", "ok")):
+        path = tmp_path / name
+        path.write_bytes(name.encode())
+        records.append(dict({"id": name, "status": status, "model": "VGG-Face"}, **create_embeddings.describe_file(str(path))))
+
+    return str(tmp_path), records
+
+
+def test_unchanged_images_are_not_embedded_again(dataset):
+    dataset_path, records = dataset
+    img_names = sorted(os.listdir(dataset_path))
+
+    unchanged, to_embed, deleted = create_embeddings.plan_incremental_update(dataset_path, img_names, records, "VGG-Face")
+
+    assert [record["id"] for record in unchanged] == ["0_person0_0.jpg", "1_person1_0.jpg"]
+    assert deleted == []
+
+
+def test_failed_images_are_embedded_again(dataset):
+    dataset_path, records = dataset
+    img_names = sorted(os.listdir(dataset_path))
+
+    _, to_embed, _ = create_embeddings.plan_incremental_update(dataset_path, img_names, records, "VGG-Face")
+
+    assert to_embed == ["0_person0_1.jpg"]
+
+
+def test_modified_deleted_and_other_model_images(dataset):
+    dataset_path, records = dataset
+    with open(os.path.join(dataset_path, "1_person1_0.jpg"), 'ab') as f:
+        f.write(b"edited")
+    os.remove(os.path.join(dataset_path, "0_person0_0.jpg"))
+    img_names = sorted(os.listdir(dataset_path))
+
+    unchanged, to_embed, deleted = create_embeddings.plan_incremental_update(dataset_path, img_names, records, "VGG-Face")
+    assert (unchanged, to_embed, deleted) == ([], ["0_person0_1.jpg", "1_person1_0.jpg"], ["0_person0_0.jpg"])
+
+    _, to_embed, _ = create_embeddings.plan_incremental_update(dataset_path, img_names, records, "Facenet")
+    assert to_embed == img_names
+
+
+def test_jsonl_skips_bad_embeddings_and_writes_the_others(tmp_path):
+    output_path = str(tmp_path / "embeddings.json")
+    image_data = [{"id": "a", "embedding": np.ones(3)}, {"id": "bad", "embedding": [0.1, "x", 0.3]},
+                  {"id": "nan", "embedding": [1.0, float("nan"), 2.0]}, {"id": "b", "embedding": [1.0, 2.0]},
+                  {"id": "c", "embedding": [1.0, 2.0, 3.0], "crowding_tag": "x"}, {"id": "d", "embedding": [0.5, 0.25, 1.0]}]
+
+    create_embeddings.create_embeddings_jsonl(image_data, output_path)
+
+    with open(output_path, 'r') as f:
+        lines = [json.loads(line) for line in f]
+    assert [line["id"] for line in lines] == ["a", "b", "c", "d"]
+    assert lines[3]["embedding"] == [0.5, 0.25, 1.0]
+
+
+def test_non_finite_rows_are_rejected():
+    with pytest.raises(ValueError):
+        create_embeddings.format_embedding_lines(["a"], [[np.inf, 1.0]])
+
+
+def test_npy_export_matches_the_output_file(tmp_path):
+    # the lines kept from a previous run are parsed from the output file, the embeddings of the run are taken as written
+    from local_index import load_embeddings_jsonl, load_npy_dir
+
+    rng = np.random.default_rng(0)
+    kept = rng.standard_normal((3, 8)).astype(np.float32)
+    new = rng.standard_normal((4, 8)).astype(np.float32)
+    output_path = str(tmp_path / "embeddings.json")
+    with open(output_path, 'w') as f:
+        f.writelines(create_embeddings.format_embedding_lines(["k0", "k1", "k2"], kept))
+    kept_bytes = os.path.getsize(output_path)
+    with open(output_path, 'a') as f:
+        f.writelines(create_embeddings.format_embedding_lines(["n0", "n1", "n2", "n3"], new))
+
+    create_embeddings.export_npy_dir(output_path, str(tmp_path / "npy"), kept_bytes, [(["n0", "n1"], new[:2]), (["n2", "n3"], new[2:])])
+
+    ids, matrix = load_embeddings_jsonl(output_path)
+    npy_ids, shards = load_npy_dir(str(tmp_path / "npy"))
+    assert list(npy_ids) == ids
+    np.testing.assert_allclose(np.concatenate(shards), matrix / np.linalg.norm(matrix, axis=1, keepdims=True), atol=1e-6)
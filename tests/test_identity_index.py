@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from conftest import make_gallery, recall_at
+from local_index import LocalExactIndex
+from identity_index import IdentityIndex, build_identity_index, resolve_identities, evaluate_recall
+
+
+
+@pytest.fixture(scope="module")
+def identity(gallery, tmp_path_factory):
+    ids, matrix, _ = gallery
+    index_dir = str(tmp_path_factory.mktemp("identity"))
+    build_identity_index(ids, matrix, index_dir, num_prototypes = 2)
+    return IdentityIndex(index_dir, top_identities = 2), LocalExactIndex(ids, matrix)
+
+
+def test_reranking_every_identity_matches_exact_search(gallery, identity):
+    _, matrix, _ = gallery
+    index, exact = identity
+
+    queries = matrix[::7]
+    results = index.search_batch(queries, 5, top_identities = index.meta["num_identities"])
+
+    assert recall_at(results, [exact.search(query, 5) for query in queries]) == 1.0
+
+
+def test_recall_grows_with_top_identities(identity):
+    index, exact = identity
+
+    rng = np.random.default_rng(1)
+    queries = rng.standard_normal((50, index.dim))
+    exact_results = [exact.search(query, 5) for query in queries]
+
+    recalls = [recall_at(index.search_batch(queries, 5, top_identities = top), exact_results) for top in (1, 4, 20)]
+
+    assert recalls == sorted(recalls)
+    assert recalls[-1] == 1.0
+
+
+def test_queries_near_an_identity_find_its_images(gallery, identity):
+    _, _, centroids = gallery
+    index, exact = identity
+
+    queries = centroids + 0.05 * np.random.default_rng(2).standard_normal(centroids.shape)
+
+    assert evaluate_recall(index, exact, queries) == 1.0
+    for code, query in enumerate(queries):
+        assert {index.identity_of(image_id) for image_id, _ in index.search(query, 5)} == {f"person{code}"}
+
+
+def test_search_batch_matches_search(gallery, identity):
+    _, matrix, _ = gallery
+    index, _ = identity
+
+    queries = matrix[:10]
+
+    assert index.search_batch(queries, 5) == [index.search(query, 5) for query in queries]
+
+
+@pytest.mark.parametrize("top_identities", [0, -1])
+def test_invalid_top_identities_is_rejected(gallery, identity, top_identities):
+    _, matrix, _ = gallery
+    index, _ = identity
+
+    with pytest.raises(ValueError):
+        index.search(matrix[0], 5, top_identities = top_identities)
+
+
+def test_label_map_resolves_names_with_underscores(tmp_path):
+    ids, matrix, _ = make_gallery(num_identities = 3, images_per_identity = 2)
+    ids = [image_id.replace("person", "first_last_") for image_id in ids]
+    label_map = {f"first_last_{label}": label for label in range(3)}
+
+    assert resolve_identities(ids, label_map)[::2] == ["first_last_0", "first_last_1", "first_last_2"]
+    with pytest.raises(ValueError):
+        resolve_identities(["7_someone_0.jpg"], label_map)
+
+    build_identity_index(ids, matrix, str(tmp_path), label_map = label_map)
+    index = IdentityIndex(str(tmp_path))
+
+    assert index.meta["num_identities"] == 3
+    assert index.identity_of(ids[-1]) == "first_last_2"
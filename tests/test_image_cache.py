@@ -0,0 +1,84 @@
+import os
+
+from image_cache import ImageCache
+
+
+
+def value(char, size = 10):
+    return char * size
+
+
+def test_memory_tier_evicts_least_recently_used_by_bytes():
+    cache = ImageCache(max_bytes = 30)
+    for key in "abc":
+        cache.put(key, value(key))
+
+    assert cache.get("a") == value("a") # a is now the most recently used
+    cache.put("d", value("d"))
+
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in "acd"] == [value(key) for key in "acd"]
+    assert cache.stats()["bytes"] == 30
+    assert cache.stats()["evictions"] == 1
+
+
+def test_entries_larger_than_the_budget_are_not_cached():
+    cache = ImageCache(max_bytes = 5)
+    cache.put("a", value("a"))
+
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_evicted_entries_are_spilled_to_disk(tmp_path):
+    cache = ImageCache(max_bytes = 10, disk_dir = str(tmp_path), max_disk_bytes = 100)
+    cache.put("a", value("a"))
+    cache.put("b", value("b"))
+
+    assert cache.get("a") == value("a")
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_disk_tier_evicts_least_recently_used(tmp_path):
+    # one entry fits in memory, three on disk
+    cache = ImageCache(max_bytes = 10, disk_dir = str(tmp_path), max_disk_bytes = 30)
+    for key in "abcd":
+        cache.put(key, value(key)) # memory: d, disk: a b c
+
+    # a disk hit makes a the most recently used entry of the disk tier; promoting it to memory spills d, so the
+    # disk tier must drop b, the least recently used, and not a
+    assert cache.get("a") == value("a")
+
+    assert cache.get("b") is None
+    assert cache.stats()["disk_evictions"] == 1
+    cache.put("e", value("e")) # spills a back to the disk tier
+    assert cache.get("a") == value("a")
+
+
+def test_disk_tier_is_reused_and_temporary_files_are_deleted(tmp_path):
+    cache = ImageCache(max_bytes = 10, disk_dir = str(tmp_path), max_disk_bytes = 100)
+    cache.ensure_namespace("bucket/dataset")
+    cache.put("a", value("a"))
+    cache.put("b", value("b"))
+
+    (tmp_path / "0123abcd.tmp").write_text("x" * 50) # an interrupted write
+
+    reopened = ImageCache(max_bytes = 10, disk_dir = str(tmp_path), max_disk_bytes = 100)
+    reopened.ensure_namespace("bucket/dataset")
+
+    assert not (tmp_path / "0123abcd.tmp").exists()
+    assert reopened.stats()["disk_bytes"] == 10
+    assert reopened.get("a") == value("a")
+
+
+def test_namespace_change_empties_both_tiers(tmp_path):
+    cache = ImageCache(max_bytes = 10, disk_dir = str(tmp_path), max_disk_bytes = 100)
+    cache.ensure_namespace("bucket/old")
+    cache.put("a", value("a"))
+    cache.put("b", value("b"))
+
+    cache.ensure_namespace("bucket/new")
+
+    assert cache.get("a") is None and cache.get("b") is None
+    assert cache.stats()["invalidations"] == 1
+    assert sorted(os.listdir(tmp_path)) == [ImageCache.NAMESPACE_FILE]
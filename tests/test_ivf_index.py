@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from conftest import recall_at
+from local_index import LocalExactIndex
+from ivf_index import IVFIndex, build_ivf_index
+
+
+
+@pytest.fixture(scope="module")
+def ivf(gallery, tmp_path_factory):
+    ids, matrix, _ = gallery
+    index_dir = str(tmp_path_factory.mktemp("ivf"))
+    build_ivf_index(ids, matrix, index_dir, nlist = 16)
+    return IVFIndex(index_dir, nprobe = 4), LocalExactIndex(ids, matrix)
+
+
+def test_scanning_every_list_matches_exact_search(gallery, ivf):
+    _, matrix, _ = gallery
+    index, exact = ivf
+
+    queries = matrix[::7]
+    results = [index.search(query, 5, nprobe = index.meta["nlist"]) for query in queries]
+
+    assert recall_at(results, [exact.search(query, 5) for query in queries]) == 1.0
+
+
+def test_recall_grows_with_nprobe(gallery, ivf):
+    _, matrix, centroids = gallery
+    index, exact = ivf
+
+    rng = np.random.default_rng(1)
+    queries = centroids[rng.integers(len(centroids), size=50)] + 0.1 * rng.standard_normal((50, centroids.shape[1]))
+    exact_results = [exact.search(query, 5) for query in queries]
+
+    recalls = [recall_at([index.search(query, 5, nprobe = nprobe) for query in queries], exact_results) for nprobe in (1, 4, 16)]
+
+    assert recalls == sorted(recalls)
+    assert recalls[-1] == 1.0
+
+
+def test_results_are_sorted_dot_products(gallery, ivf):
+    _, matrix, _ = gallery
+    index, _ = ivf
+
+    results = index.search(matrix[3], 5)
+    scores = [score for _, score in results]
+
+    assert scores == sorted(scores, reverse=True)
+    assert results[0][1] == pytest.approx(1.0, abs=1e-5)
+
+
+@pytest.mark.parametrize("nprobe", [0, -1])
+def test_invalid_nprobe_is_rejected(gallery, ivf, nprobe):
+    _, matrix, _ = gallery
+    index, _ = ivf
+
+    with pytest.raises(ValueError):
+        index.search(matrix[0], 5, nprobe = nprobe)
+
+
+@pytest.mark.parametrize("nprobe", ["0", "-3"])
+def test_api_rejects_invalid_nprobe(api, nprobe):
+    embedding = api.centroids[0].tolist()
+
+    assert api.post("/embed", params={"nprobe": nprobe}, content=np.asarray(embedding, dtype='<f4').tobytes(),
+                    headers={"Content-Type": "application/x-float32"}).status_code == 422
+    assert api.post("/embed", json={"data": embedding, "nprobe": int(nprobe)}).status_code == 422
+    assert api.post("/embed_batch", json={"data": [embedding], "nprobe": int(nprobe)}).status_code == 422
+
+
+def test_api_accepts_valid_nprobe(api):
+    response = api.post("/embed", json={"data": api.centroids[0].tolist(), "nprobe": 2, "image_mode": "reference"})
+
+    assert response.status_code == 200
+    assert response.json()["identity"] == "person0"
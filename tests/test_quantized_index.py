@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from conftest import make_gallery, recall_at
+from local_index import LocalExactIndex
+from quantized_index import QuantizedIndex, build_quantized_index, QUANTIZATION_KINDS
+
+
+
+@pytest.fixture(scope="module")
+def quantized(tmp_path_factory):
+    # one index directory of every kind, over a gallery large enough to train the 256 PQ codewords of every sub-vector
+
+    ids, matrix, centroids = make_gallery(num_identities = 50, images_per_identity = 40)
+    index_dirs = {}
+    for kind in QUANTIZATION_KINDS:
+        index_dirs[kind] = str(tmp_path_factory.mktemp(kind))
+        build_quantized_index(ids, matrix, index_dirs[kind], kind, num_subvectors = 16)
+
+    rng = np.random.default_rng(1)
+    queries = centroids[rng.integers(len(centroids), size=50)] + 0.1 * rng.standard_normal((50, centroids.shape[1]))
+
+    return index_dirs, LocalExactIndex(ids, matrix), queries
+
+
+@pytest.mark.parametrize("kind, min_recall", [("fp16", 0.99), ("int8", 0.95), ("pq", 0.4)])
+def test_recall_against_exact_search(quantized, kind, min_recall):
+    index_dirs, exact, queries = quantized
+    index = QuantizedIndex(index_dirs[kind])
+
+    recall = recall_at(index.search_batch(queries, 10), [exact.search(query, 10) for query in queries])
+
+    assert recall >= min_recall
+
+
+@pytest.mark.parametrize("kind", QUANTIZATION_KINDS)
+def test_reranking_recovers_the_exact_top_k(quantized, kind):
+    index_dirs, exact, queries = quantized
+    index = QuantizedIndex(index_dirs[kind], rerank = 50)
+
+    for query in queries:
+        results = index.search(query, 10)
+        exact_results = exact.search(query, 10)
+
+        assert [image_id for image_id, _ in results] == [image_id for image_id, _ in exact_results]
+        assert [score for _, score in results] == pytest.approx([score for _, score in exact_results], abs=1e-5)
+
+
+def test_pq_needs_reranking(quantized):
+    index_dirs, exact, queries = quantized
+    index = QuantizedIndex(index_dirs["pq"])
+    exact_results = [exact.search(query, 10) for query in queries]
+
+    recall = recall_at(index.search_batch(queries, 10), exact_results)
+    reranked_recall = recall_at(index.search_batch(queries, 10, rerank = 50), exact_results)
+
+    assert recall < 0.9
+    assert reranked_recall == 1.0
+
+
+@pytest.mark.parametrize("kind", QUANTIZATION_KINDS)
+def test_codes_are_smaller_than_float32(quantized, kind):
+    index_dirs, _, _ = quantized
+    meta = QuantizedIndex(index_dirs[kind]).meta
+
+    assert meta["quantized_bytes"] < meta["float32_bytes"]
+
+
+def test_reranking_needs_the_full_precision_embeddings(gallery, tmp_path):
+    ids, matrix, _ = gallery
+    build_quantized_index(ids, matrix, str(tmp_path), "int8", keep_full_precision = False)
+
+    with pytest.raises(ValueError):
+        QuantizedIndex(str(tmp_path), rerank = 10)
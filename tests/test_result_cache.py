@@ -0,0 +1,135 @@
+import pytest
+
+import utils
+from result_cache import ResultCache
+
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # a controllable time.monotonic for the TTL
+
+    now = [1000.0]
+    monkeypatch.setattr("result_cache.time.monotonic", lambda: now[0])
+    return now
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = ResultCache(max_entries = 4, ttl_seconds = 10)
+    cache.put("a", ("person0", ("0_person0_1.jpg",)))
+
+    clock[0] += 9
+    assert cache.get("a") == ("person0", ("0_person0_1.jpg",))
+    clock[0] += 2
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = ResultCache(max_entries = 2, ttl_seconds = 10)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats()["evictions"] == 1
+
+
+def test_version_change_empties_the_cache(clock):
+    cache = ResultCache(max_entries = 4, ttl_seconds = 10)
+    cache.ensure_version("v1")
+    cache.put("a", 1)
+
+    cache.ensure_version("v1")
+    assert cache.get("a") == 1
+
+    cache.ensure_version("v2")
+    assert cache.get("a") is None
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_embedding_key_ignores_the_encoding_of_the_query():
+    embedding = [0.1, -0.2, 0.3]
+
+    assert ResultCache.embedding_key(embedding, 4) == ResultCache.embedding_key([float(x) for x in embedding], 4)
+    assert ResultCache.embedding_key(embedding, 4) != ResultCache.embedding_key(embedding, 8)
+
+
+def test_deployed_index_sync_invalidates_cached_results(monkeypatch):
+    monkeypatch.setattr(utils, "SEARCH_BACKEND", "vertex")
+    monkeypatch.setattr(utils, "RESULT_CACHE", ResultCache(max_entries = 4, ttl_seconds = 60))
+    monkeypatch.setattr(utils, "_INDEX_VERSION", None)
+    monkeypatch.setattr(utils, "_DEPLOYED_INDEX_SYNC_TIME", None)
+
+    sync_time = ["2026-01-01 00:00:00"]
+    monkeypatch.setattr(utils, "read_deployed_index_sync_time", lambda: sync_time[0])
+
+    utils.refresh_index_version()
+    assert utils.get_cached_result("query") is None
+    utils.cache_result("query", ("person0", ["0_person0_1.jpg"]))
+
+    utils.refresh_index_version() # not synced since
+    assert utils.get_cached_result("query") == ("person0", ("0_person0_1.jpg",))
+
+    sync_time[0] = "2026-01-01 00:05:00" # an upsert was applied
+    utils.refresh_index_version()
+    assert utils.get_cached_result("query") is None
+
+
+def test_failed_version_read_keeps_the_cache(monkeypatch):
+    monkeypatch.setattr(utils, "SEARCH_BACKEND", "vertex")
+    monkeypatch.setattr(utils, "RESULT_CACHE", ResultCache(max_entries = 4, ttl_seconds = 60))
+    monkeypatch.setattr(utils, "_INDEX_VERSION", None)
+    monkeypatch.setattr(utils, "_DEPLOYED_INDEX_SYNC_TIME", "2026-01-01 00:00:00")
+
+    def unavailable():
+        raise RuntimeError("the API is unavailable")
+    monkeypatch.setattr(utils, "read_deployed_index_sync_time", unavailable)
+
+    utils.get_cached_result("query")
+    utils.cache_result("query", ("person0", ["0_person0_1.jpg"]))
+    utils.refresh_index_version()
+
+    assert utils.get_cached_result("query") == ("person0", ("0_person0_1.jpg",))
+
+
+def test_cache_holds_the_identification_not_the_images(api, monkeypatch):
+    cache = ResultCache(max_entries = 4, ttl_seconds = 60)
+    monkeypatch.setattr(utils, "RESULT_CACHE", cache)
+
+    request = {"data": api.centroids[1].tolist(), "image_mode": "inline"}
+    first = api.post("/embed", json=request)
+    second = api.post("/embed", json=request)
+
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json()
+    assert first.json()["identity"] == "person1" and all(first.json()["returned_images"])
+    assert cache.stats()["hits"] == 1
+
+    (identity, image_ids), = [value for _, value in cache._entries.values()]
+    assert identity == "person1"
+    assert len(image_ids) == len(first.json()["returned_images"])
+    assert all(image_id.startswith("1_person1_") for image_id in image_ids)
+
+
+def test_failed_search_is_not_cached(api, monkeypatch):
+    cache = ResultCache(max_entries = 4, ttl_seconds = 60)
+    monkeypatch.setattr(utils, "RESULT_CACHE", cache)
+
+    index_endpoint = utils.get_clients().index_endpoint(utils.get_index_endpoint_name())
+    find_neighbors = index_endpoint.find_neighbors
+
+    def unavailable(**kwargs):
+        monkeypatch.setattr(index_endpoint, "find_neighbors", find_neighbors) # fails once, then recovers
+        raise RuntimeError("Vertex AI is unavailable")
+    monkeypatch.setattr(index_endpoint, "find_neighbors", unavailable)
+
+    request = {"data": api.centroids[2].tolist(), "image_mode": "reference"}
+    first = api.post("/embed", json=request)
+    second = api.post("/embed", json=request)
+
+    assert first.status_code == 500
+    assert second.status_code == 200 and second.json()["identity"] == "person2"
+    assert cache.stats()["hits"] == 0